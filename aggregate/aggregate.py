@@ -30,6 +30,15 @@ import siepicfab_ebeam_zep
 draw_waveguides = True
 run_number_designs = 100
 
+# Write each design to a GDS shard as soon as it is placed, instead of keeping
+# all of them in memory; the output is then Shuksan.gds, without an image, and
+# python merge_stream.py Shuksan.gds makes Shuksan.oas and Shuksan.png, see merge_stream.py
+merge_streaming = False
+
+# Replace identical cells (e.g., static copies of the same grating coupler in
+# many designs) by a single cell, see cell_dedup.py
+merge_identical_cells = True
+
 # Configuration for the Technology to use
 tech = ["SiEPICfab_EBeam_ZEP"]
 tech = tech[0]
@@ -200,29 +209,33 @@ top_cell.insert(CellInstArray(cell_date.cell_index(), t))
 
 # Load all the layouts, without the libraries (no PCells)
 disable_libraries()
+import sys
+sys.path.insert(0, path)
+from dbu_normalize import normalize_dbu
+from submission_profile import profile_layout, check_budgets, summary
+from opt_in_manifest import OptInManifest
+from git_dates import commit_dates
+manifest = OptInManifest()
+if merge_streaming:
+    from merge_stream import ShardWriter
+    shards = ShardWriter(layout, os.path.join(path, filename_out + '_shards'))
+else:
+    shards = None
 # Origins for the layouts
 x,y = 2.5e6,cell_Height+cell_Gap_Height
 design_count = 0
 subcell_instances = []
 course_cells = []  # list of each of the student designs
 cells_course = []  # into which course cell the design should go into
-import subprocess
-import pandas as pd
+# the time of the last commit of each file, from a single git log
+submission_dates = commit_dates(os.path.join(path, '..'), ['submissions', 'framework'])
 for f in [f for f in files_in if '.oas' in f.lower() or '.gds' in f.lower()]:
     basefilename = os.path.basename(f)
 
-    # GitHub Action gets the actual time committed.  This can be done locally
-    # via git restore-mtime.  Then we can load the time from the file stamp
-
-    filedate = datetime.fromtimestamp(os.path.getmtime(f)).strftime("%Y%m%d_%H%M")
+    # files that are not committed, e.g., in a local run, are dated by their modification time
+    filedate = submission_dates.get(os.path.normpath(f)) or datetime.fromtimestamp(os.path.getmtime(f))
+    filedate = filedate.strftime("%Y%m%d_%H%M")
     log("\nLoading: %s, dated %s" % (os.path.basename(f), filedate))
-
-    # Tried to get it from GitHub but that didn't work:
-    # get the time the file was last updated from the Git repository 
-    # a = subprocess.run(['git', '-C', os.path.dirname(f), 'log', '-1', '--pretty=%ci',  basefilename], stdout = subprocess.PIPE) 
-    # filedate = pd.to_datetime(str(a.stdout.decode("utf-8"))).strftime("%Y%m%d_%H%M")
-    #filedate = os.path.getctime(os.path.dirname(f)) # .strftime("%Y%m%d_%H%M")
-    
   
     # Load layout  
     layout2 = pya.Layout()
@@ -246,18 +259,25 @@ for f in [f for f in files_in if '.oas' in f.lower() or '.gds' in f.lower()]:
     if round(layout2.dbu,10) != dbu:
         log('  - WARNING: The database unit (%s dbu) in the layout does not match the required dbu of %s.' % (layout2.dbu, dbu))
         print('  - WARNING: The database unit (%s dbu) in the layout does not match the required dbu of %s.' % (layout2.dbu, dbu))
-        # Step 1: change the DBU to match, but that magnifies the layout
-        wrong_dbu = layout2.dbu
-        layout2.dbu = dbu
-        # Step 2: scale the layout
+        # change the DBU to match, and scale the layout by the ratio of the DBUs
         try:
-            # determine the scaling required
-            scaling = round(wrong_dbu / dbu, 10)
-            layout2.transform (pya.ICplxTrans(scaling, 0, False, 0, 0))
-            log('  - WARNING: Database resolution has been corrected and the layout scaled by %s' % scaling) 
-        except:
-            print('ERROR IN EBeam_merge.py: Incorrect DBU and scaling unsuccessful')
+            report = normalize_dbu(layout2, dbu)
+        except Exception as e:
+            log('  - ERROR: Incorrect DBU and scaling unsuccessful, skipping: %s' % e)
+            print('ERROR IN EBeam_merge.py: Incorrect DBU and scaling unsuccessful: %s' % e)
+            continue
+        log('  - WARNING: Database resolution has been corrected and the layout scaled by %s' % report['ratio']) 
+        if report['snapped_vertices']:
+            log('  - WARNING: %s vertices were not on the %g nm grid, and have been snapped; e.g., (cell, layer, x, y):' % (report['snapped_vertices'], dbu*1e3))
+            for location in report['locations']:
+                log('    - %s, %s, %s, %s' % location)
     
+    # complexity of the design; larger designs are rejected by run_verification.py
+    profile = profile_layout(layout2)
+    log('  - profile: %s' % summary(profile))
+    for error in check_budgets(profile):
+        log('  - WARNING: %s' % error)
+
     # check that there is one top cell in the layout
     num_top_cells = len(layout2.top_cells())
     if num_top_cells > 1:
@@ -311,6 +331,7 @@ for f in [f for f in files_in if '.oas' in f.lower() or '.gds' in f.lower()]:
                     
             # Delete non-text geometries in the Text layer
             layer_index = layout2.find_layer(int(layer_text.split('/')[0]), int(layer_text.split('/')[1]))
+            labels = []
             if type(layer_index) != type(None):
                 s = cell.begin_shapes_rec(layer_index)
                 shapes_to_delete = []
@@ -324,6 +345,7 @@ for f in [f for f in files_in if '.oas' in f.lower() or '.gds' in f.lower()]:
                             subcell2.shapes(layerTextN).insert(pya.Text(text, 0, 0))
                         elif text.startswith('opt_in'):
                             log('  - measurement label: %s' % text )
+                            labels.append((text, s.trans() * pya.Point(s.shape().text.x, s.shape().text.y)))
                     else:
                         shapes_to_delete.append( s.shape() )
                     s.next()
@@ -347,8 +369,16 @@ for f in [f for f in files_in if '.oas' in f.lower() or '.gds' in f.lower()]:
                 log('  - WARNING: Cell was clipped to maximum size of %s X %s' % (cell_Width, cell_Height) )
                 log('  - clipped bounding box: %s' % bbox2.to_s() )
 
-            # copy
-            subcell.copy_tree(layout2.cell(cell2))  
+            # measurement labels, in the coordinates of subcell2
+            for text, p in labels:
+                if bbox2.contains(p):
+                    manifest.add(subcell2, text, p - pya.Vector(bbox.p1), course, os.path.basename(f))
+
+            # copy, or write to the shard and reference it with a ghost cell
+            if shards:
+                subcell.insert(CellInstArray(shards.add(layout2, cell2).cell_index(), Trans(Trans.R0, 0, 0)))
+            else:
+                subcell.copy_tree(layout2.cell(cell2))  
             
             log('  - Placed at position: %s, %s' % (x,y) )
             
@@ -367,7 +397,8 @@ for f in [f for f in files_in if '.oas' in f.lower() or '.gds' in f.lower()]:
             cells_course.append (cell_course)
                 
             # Measure the height of the cell that was added, and move up
-            y += max (cell_Height, subcell.bbox().height()) + cell_Gap_Height
+            # (a ghost cell has no bounding box, so include the clipped design's)
+            y += max (cell_Height, (subcell.bbox() + bbox2).height()) + cell_Gap_Height
             # move right and bottom when we reach the top of the chip
             if y + cell_Height > chip_Height1 and x == 0:
                 y = cell_Height + cell_Gap_Height
@@ -388,6 +419,18 @@ for f in [f for f in files_in if '.oas' in f.lower() or '.gds' in f.lower()]:
                 y = br_cutout2_y
 
 
+# Merge the identical cells of the designs; the designs are not in the layout
+# when they are streamed to shards
+if merge_identical_cells and not shards:
+    from cell_dedup import deduplicate_cells
+    log('\nMerging identical cells:')
+    courses = {}
+    for d in range(design_count):
+        courses.setdefault(cells_course[d].name, []).append(course_cells[d])
+    stats = deduplicate_cells(layout, courses)
+    for name, s in stats.items():
+        log('  - %s: %s -> %s cells, %s -> %s bytes (OASIS), saved %s bytes' % (name, 
+            s['cells_before'], s['cells_after'], s['bytes_before'], s['bytes_after'], s['bytes_before'] - s['bytes_after']))
 
 # Enable libraries, to create waveguides, laser, etc
 enable_libraries()
@@ -528,7 +571,21 @@ for row in range(0, n_lasers):
 import os 
 path = os.path.dirname(os.path.realpath(__file__))
 filename = 'Shuksan' # top_cell_name
-file_out = export_layout(top_cell, path, filename, relative_path = '.', format='oas', screenshot=True)
+if shards:
+    file_out = os.path.join(path, filename + '.gds')
+    size = shards.write(top_cell, file_out)
+    log('\nStreamed %s designs to %s: %s bytes (%s bytes of designs)' % (len(shards.paths), file_out, size, shards.bytes))
+else:
+    file_out = export_layout(top_cell, path, filename, relative_path = '.', format='oas', screenshot=True)
+entries, missing = manifest.write(top_cell, os.path.join(path, filename + '_opt_in'))
+log('\nopt_in manifest: %s labels, in %s' % (len(entries), filename + '_opt_in.json, .csv'))
+for name in missing:
+    log('  - WARNING: design %s is not placed, its labels are not in the manifest' % name)
+try:
+    import resource
+    log('Peak memory: %.0f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+except ImportError:
+    pass
 
 
 from SiEPIC._globals import Python_Env
@@ -536,7 +593,10 @@ if Python_Env == "Script":
     from SiEPIC.utils import klive
     klive.show(file_out, technology=tech)
 
-# Create an image of the layout
-top_cell.image(os.path.join(path,filename+'.png'))
+# Create an image of the layout; the streamed layout only has the ghost cells of the designs
+if shards:
+    log('Shuksan.oas and Shuksan.png: python merge_stream.py %s' % file_out)
+else:
+    top_cell.image(os.path.join(path,filename+'.png'))
 
 print('Completed %s designs' % design_count)
@@ -0,0 +1,127 @@
+'''
+Merging of identical cells, for aggregate.py
+
+The submissions contain static copies of the same PDK cells (grating couplers,
+y-branches, terminators, tapers), which copy_tree turns into separate cells of
+the merged layout: ebeam_gc_te1550, ebeam_gc_te1550$1, ... Each cell is hashed
+from its shapes and its child instances, bottom-up so that the hash of a child
+is used instead of its name, and the cells with the same hash are replaced by
+one of them:
+
+  stats = deduplicate_cells(layout, {'ELEC413': [design1, design2], 'edX': [design3]})
+  for name, s in stats.items():
+      print(name, s['cells_before'], s['cells_after'], s['bytes_before'], s['bytes_after'])
+
+Only cells with the same base name (the name without the $N suffix) are merged,
+so that the components keep their names for the netlist extraction.
+Ghost cells, library proxies and PCell variants are never merged.
+'''
+
+import hashlib
+import pya
+
+
+def base_name(name):
+    """
+    Returns:
+        str: The cell name without the $N suffix added by KLayout for duplicate names.
+    """
+    return name.split('$')[0]
+
+
+def cell_hash(cell, child_hashes):
+    """
+    Canonical hash of the contents of a cell.
+
+    Args:
+        cell (pya.Cell): The cell.
+        child_hashes (dict): cell index -> hash, for the cells it instantiates.
+
+    Returns:
+        str: The hash; the same for cells with the same shapes and instances,
+        independent of their order and of the names of the child cells.
+    """
+    layout = cell.layout()
+    h = hashlib.sha1(base_name(cell.name).encode())
+    for layer_index in sorted(layout.layer_indexes(), key=lambda li: layout.get_info(li).to_s()):
+        shapes = cell.shapes(layer_index)
+        if shapes.is_empty():
+            continue
+        h.update(('\nL%s' % layout.get_info(layer_index).to_s()).encode())
+        for s in sorted(shape.to_s() for shape in shapes.each()):
+            h.update(('\n' + s).encode())
+    instances = []
+    for inst in cell.each_inst():
+        array = inst.cell_inst
+        array.cell_index = 0  # the child is identified by its hash
+        instances.append('%s %s' % (child_hashes[inst.cell_index], array.to_s()))
+    h.update('\nI'.encode())
+    for s in sorted(instances):
+        h.update(('\n' + s).encode())
+    return h.hexdigest()
+
+
+def is_mergeable(cell):
+    return not (cell.is_ghost_cell() or cell.is_proxy() or cell.is_pcell_variant())
+
+
+def course_size(layout, cells):
+    """
+    Returns:
+        int: The number of cells in the hierarchy of the cells.
+        int: The size of the hierarchy of the cells, written as OASIS [bytes].
+    """
+    called = set()
+    options = pya.SaveLayoutOptions()
+    options.format = 'OASIS'
+    options.write_context_info = False
+    options.clear_cells()
+    for cell in cells:
+        called.add(cell.cell_index())
+        called.update(cell.called_cells())
+        options.add_cell(cell.cell_index())
+    if not cells:
+        return 0, 0
+    return len(called), len(layout.write_bytes(options))
+
+
+def deduplicate_cells(layout, courses):
+    """
+    Replaces identical cells in the layout by a single cell.
+
+    Args:
+        layout (pya.Layout): The merged layout.
+        courses (dict): course name -> list of the design cells (pya.Cell) of the course;
+            these cells are referenced by the caller, and are never deleted.
+
+    Returns:
+        dict: course name -> {'cells_before', 'cells_after', 'bytes_before', 'bytes_after'}
+    """
+    stats = {}
+    for course, cells in courses.items():
+        n, size = course_size(layout, cells)
+        stats[course] = {'cells_before': n, 'bytes_before': size}
+
+    keep = set(cell.cell_index() for cells in courses.values() for cell in cells)
+    hashes = {}    # cell index -> hash
+    canonical = {} # hash -> cell index that is kept
+    for cell_index in list(layout.each_cell_bottom_up()):
+        cell = layout.cell(cell_index)
+        if not is_mergeable(cell) or cell_index in keep:
+            hashes[cell_index] = 'cell %s' % cell_index
+            continue
+        h = cell_hash(cell, hashes)
+        hashes[cell_index] = h
+        if h not in canonical:
+            canonical[h] = cell_index
+            continue
+        # point the instances to the kept cell; the children of this cell
+        # have already been merged, so they are shared with the kept cell
+        for inst in list(cell.each_parent_inst()):
+            inst.child_inst().cell_index = canonical[h]
+        layout.delete_cell(cell_index)
+
+    for course, cells in courses.items():
+        n, size = course_size(layout, cells)
+        stats[course].update({'cells_after': n, 'bytes_after': size})
+    return stats
@@ -0,0 +1,117 @@
+'''
+Conversion of a layout to another database unit, for aggregate.py
+
+The layout is scaled by the exact ratio of the database units, e.g., 5 for a
+5 nm layout or 1/10 for a 0.1 nm layout converted to 1 nm:
+ - integer ratios are exact: every coordinate is multiplied by the ratio;
+ - for the other ratios, the coordinates that are not a multiple of the
+   denominator are snapped to the nearest grid point. These vertices are
+   counted and located before the layout is scaled.
+The layout is processed cell by cell, without flattening it:
+
+  report = normalize_dbu(layout2, 0.001)
+  print(report['ratio'], report['snapped_vertices'], report['locations'])
+'''
+
+from fractions import Fraction
+import pya
+
+
+def dbu_ratio(dbu_from, dbu_to):
+    """
+    Returns:
+        Fraction: The exact scaling from database unit dbu_from to dbu_to,
+        e.g., 1/10 from 0.0001 to 0.001.
+    """
+    if dbu_from <= 0 or dbu_to <= 0:
+        raise ValueError('Invalid database unit: %s, %s' % (dbu_from, dbu_to))
+    return Fraction(repr(round(dbu_from, 10))) / Fraction(repr(round(dbu_to, 10)))
+
+
+def off_grid_vertices(cell, grid, max_locations=10):
+    """
+    Finds the vertices and instance positions of a cell (not of its children)
+    that are not on a multiple of the grid.
+
+    Args:
+        cell (pya.Cell): The cell.
+        grid (int): The grid [dbu].
+        max_locations (int): The number of vertices to locate.
+
+    Returns:
+        int: The number of off-grid vertices.
+        list: (layer or 'instance', pya.Point) of the first max_locations.
+    """
+    layout = cell.layout()
+    count, locations = 0, []
+    def off_grid(points):
+        return [p for p in points if p.x % grid or p.y % grid]
+    for layer_index in layout.layer_indexes():
+        if cell.shapes(layer_index).is_empty():
+            continue
+        layer = layout.get_info(layer_index).to_s()
+        # polygons and boxes, checked in C++
+        iterator = cell.begin_shapes_rec(layer_index)
+        iterator.max_depth = 0
+        iterator.shape_flags = pya.Shapes.SPolygons | pya.Shapes.SBoxes
+        region = pya.Region(iterator)
+        region.merged_semantics = False
+        markers = region.grid_check(grid, grid)
+        count += markers.count()
+        for ep in markers.each():
+            if len(locations) >= max_locations:
+                break
+            locations.append((layer, ep.first.p1))
+        # paths (the spine, not the outline) and texts
+        points = []
+        for shape in cell.shapes(layer_index).each(pya.Shapes.SPaths | pya.Shapes.STexts):
+            points += list(shape.path.each_point()) if shape.is_path() else [shape.text_pos]
+        points = off_grid(points)
+        count += len(points)
+        locations += [(layer, p) for p in points[:max_locations - len(locations)]]
+    points = []
+    for inst in cell.each_inst():
+        array = inst.cell_inst
+        points.append(pya.Point(array.trans.disp.x, array.trans.disp.y) if not array.is_complex() else
+                      pya.Point(round(array.cplx_trans.disp.x), round(array.cplx_trans.disp.y)))
+        if array.is_regular_array():
+            points += [pya.Point(array.a.x, array.a.y), pya.Point(array.b.x, array.b.y)]
+    points = off_grid(points)
+    count += len(points)
+    locations += [('instance', p) for p in points[:max_locations - len(locations)]]
+    return count, locations
+
+
+def normalize_dbu(layout, dbu, max_locations=10):
+    """
+    Converts a layout to the database unit dbu, keeping its dimensions.
+
+    Args:
+        layout (pya.Layout): The layout, modified.
+        dbu (float): The new database unit [µm].
+        max_locations (int): The number of snapped vertices to locate.
+
+    Returns:
+        dict:
+            ratio (Fraction): The scaling of the coordinates.
+            snapped_vertices (int): The number of vertices and instance positions
+                that were snapped to the grid, counted once per cell.
+            locations (list): (cell name, layer or 'instance', x [µm], y [µm]) of the
+                first snapped vertices, in the coordinates of their cell.
+    """
+    ratio = dbu_ratio(layout.dbu, dbu)
+    report = {'ratio': ratio, 'snapped_vertices': 0, 'locations': []}
+    if ratio.denominator > 1:
+        # with ratio p/q, c*p/q is an integer only if c is a multiple of q
+        for cell in layout.each_cell():
+            count, locations = off_grid_vertices(cell, ratio.denominator,
+                                                 max_locations - len(report['locations']))
+            report['snapped_vertices'] += count
+            report['locations'] += [(cell.name, layer, round(p.x * layout.dbu, 6), round(p.y * layout.dbu, 6))
+                                    for layer, p in locations]
+    layout.dbu = dbu
+    if ratio != 1:
+        # transforms the shapes and instances of each cell once
+        magnification = ratio.numerator if ratio.denominator == 1 else float(ratio)
+        layout.transform(pya.ICplxTrans(magnification, 0, False, 0, 0))
+    return report
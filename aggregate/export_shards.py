@@ -0,0 +1,197 @@
+'''
+Per-design shards of the merged layout
+
+Splits the merged layout into one file per design, the cells placed in the
+course cells (ELEC413, edX, openEBL, SiEPIC_Passives), so that a design can be
+looked at after fabrication without loading the whole chip. Each shard is a
+hierarchical clip of the top cell to the extent of the design, plus a margin,
+so that it includes the routing and the labels around the design:
+
+  python export_shards.py                       # Shuksan.oas -> Shuksan_designs/
+  python export_shards.py --filter emilymuller --format gds
+
+The clips are made by a pool of processes, each with its own copy of the
+merged layout. The index, Shuksan_designs/index.json, has for each design:
+design, course, bbox [µm, in the top cell], path (relative to the index),
+bytes, and its opt_in labels.
+'''
+
+import os
+import re
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import pya
+
+from opt_in_manifest import cell_trans
+
+courses = ['ELEC413', 'edX', 'openEBL', 'SiEPIC_Passives']  # the course cells of aggregate.py
+margin = 10  # µm, around each design, for the routing that ends at its edge
+layer_text = '10/0'
+
+# the merged layout of each worker process, read once by _init
+_layout = None
+
+
+def designs(layout, courses=courses):
+    """
+    Returns:
+        list: (design cell name, course, pya.Box in the top cell [dbu]) of each
+        cell placed in a course cell, in the order of the course cells.
+    """
+    top_cell = layout.top_cell()
+    found = []
+    for course in courses:
+        if not layout.has_cell(course):
+            continue
+        course_cell = layout.cell(course)
+        for index in course_cell.each_child_cell():
+            cell = layout.cell(index)
+            trans = cell_trans(cell, top_cell)
+            if trans is None or cell.bbox().empty():
+                continue
+            found.append((cell.name, course, (trans * cell.bbox())))
+    return found
+
+
+def _init(layout_path):
+    global _layout
+    _layout = pya.Layout()
+    _layout.read(layout_path)
+
+
+def opt_in_labels(cell, layer):
+    """
+    Returns:
+        list: (opt_in, x, y [µm]) of the opt_in labels in cell and below.
+    """
+    dbu = cell.layout().dbu
+    labels = []
+    it = cell.begin_shapes_rec(layer)
+    while not it.at_end():
+        shape = it.shape()
+        if shape.is_text() and shape.text_string.startswith('opt_in'):
+            p = it.trans() * pya.Point(shape.text_pos.x, shape.text_pos.y)
+            labels.append((shape.text_string, round(p.x * dbu, 3), round(p.y * dbu, 3)))
+        it.next()
+    return labels
+
+
+def export_shard(name, box, path):
+    """
+    Clips the top cell of the merged layout of this process to box, and writes
+    the clip, named <design>_shard, to path (GDS or OASIS, from its extension).
+
+    Args:
+        box (list): left, bottom, right, top [dbu], in the top cell.
+
+    Returns:
+        int: The size of the file [bytes].
+        list: The opt_in labels of the clip, see opt_in_labels().
+    """
+    layout = _layout
+    clip = layout.cell(layout.clip(layout.top_cell().cell_index(), pya.Box(*box)))
+    clip.name = name + '_shard'
+    options = pya.SaveLayoutOptions()
+    # GDS2 unless the format is set, whatever the extension
+    options.set_format_from_filename(path)
+    options.select_cell(clip.cell_index())
+    options.write_context_info = False
+    layout.write(path, options)
+    labels = opt_in_labels(clip, layout.layer(pya.LayerInfo(*[int(v) for v in layer_text.split('/')])))
+    # the clip cells are only used by this shard; the cells fully inside it are kept
+    layout.prune_cell(clip.cell_index(), -1)
+    return os.path.getsize(path), labels
+
+
+def _export(args):
+    return export_shard(*args)
+
+
+def export_shards(layout_path, directory, file_format='oas', pattern=None, margin=margin, workers=None):
+    """
+    Writes a shard of every design of the merged layout, and the index.
+
+    Args:
+        layout_path (str): The merged layout, e.g. Shuksan.oas.
+        directory (str): Where the shards and index.json are written.
+        file_format (str): 'oas' or 'gds'.
+        pattern (str): Only the designs matching this regular expression.
+        margin (float): Around each design [µm].
+        workers (int): Number of processes, None for the number of CPUs.
+
+    Returns:
+        dict: The index, as written to index.json.
+    """
+    layout = pya.Layout()
+    layout.read(layout_path)
+    grow = int(round(margin / layout.dbu))
+    found = [d for d in designs(layout) if not pattern or re.search(pattern, d[0])]
+    os.makedirs(directory, exist_ok=True)
+    tasks = [(name, [box.left - grow, box.bottom - grow, box.right + grow, box.top + grow],
+              os.path.join(directory, '%s.%s' % (re.sub(r'[^\w.-]', '_', name), file_format)))
+             for name, course, box in found]
+    if workers == 1:
+        _init(layout_path)
+        results = [_export(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=(layout_path,)) as executor:
+            results = list(executor.map(_export, tasks))
+
+    dbu = layout.dbu
+    index = {'layout': os.path.abspath(layout_path), 'top_cell': layout.top_cell().name, 'dbu': dbu,
+             'margin': margin, 'designs': []}
+    for (name, course, box), (_, _, path), (size, labels) in zip(found, tasks, results):
+        index['designs'].append({'design': name, 'course': course,
+                                 'bbox': [round(v * dbu, 3) for v in (box.left, box.bottom, box.right, box.top)],
+                                 'path': os.path.basename(path), 'bytes': size,
+                                 'opt_in': [{'opt_in': t, 'x': x, 'y': y} for t, x, y in labels]})
+    with open(os.path.join(directory, 'index.json'), 'w') as file:
+        json.dump(index, file, indent=1)
+    return index
+
+
+def shard_path(directory, design):
+    """
+    Returns:
+        str: The path of the shard of a design, from the index in directory; None if there is none.
+    """
+    with open(os.path.join(directory, 'index.json')) as file:
+        for entry in json.load(file)['designs']:
+            if entry['design'] == design:
+                return os.path.join(directory, entry['path'])
+    return None
+
+
+def main(argv=None):
+    path = os.path.dirname(os.path.realpath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--layout', default=os.path.join(path, 'Shuksan.oas'),
+                        help='merged layout (default: Shuksan.oas)')
+    parser.add_argument('--output', default=None,
+                        help='directory of the shards and index.json (default: Shuksan_designs next to the layout)')
+    parser.add_argument('--format', default='oas', choices=['oas', 'gds'])
+    parser.add_argument('--filter', default=None,
+                        help='only export the designs matching this regular expression')
+    parser.add_argument('--margin', type=float, default=margin,
+                        help='around each design [µm]')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes (default: number of CPUs)')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.layout):
+        print('Layout file not found: %s. The merged layout is not in the repository: '
+              'run aggregate.py first, or give its path with --layout.' % args.layout)
+        return 1
+    directory = args.output or os.path.splitext(args.layout)[0] + '_designs'
+    index = export_shards(args.layout, directory, args.format, args.filter, args.margin, args.workers)
+    entries = index['designs']
+    print('%s designs written to %s, %.1f MB' % (len(entries), directory, sum(e['bytes'] for e in entries) / 1e6))
+    for e in entries:
+        print(' %-40s %-16s %8.0f kB, %s opt_in labels' % (e['design'], e['course'], e['bytes'] / 1e3, len(e['opt_in'])))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
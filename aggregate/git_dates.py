@@ -0,0 +1,71 @@
+'''
+Commit dates of the submitted files, for aggregate.py
+
+The date of each file is the time of the last commit that changed it, from a
+single git log of the folders, rather than one git log per file or the
+modification times restored by git restore-mtime:
+
+  dates = commit_dates(repo, ['submissions', 'framework'])
+  dates[os.path.join(repo, 'submissions', 'x.gds')]   # datetime
+
+The clone needs the full history (fetch-depth: 0 in the GitHub Action), otherwise
+the files are dated by the oldest commit that was fetched.
+'''
+
+import os
+import subprocess
+from datetime import datetime
+
+marker = '\x01'  # starts the timestamp line of each commit, which cannot be a file name
+
+
+def git_log(repo, paths):
+    """
+    Returns:
+        str: The output of git log, with the commit timestamp of each commit
+        followed by the files that it changed, relative to the top of the repository.
+    """
+    return subprocess.run(['git', '-C', repo, '-c', 'core.quotepath=off', 'log', '--name-only',
+                           '--format=' + marker + '%ct', '--'] + list(paths),
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+                          text=True, encoding='utf-8').stdout
+
+
+def parse_log(text):
+    """
+    Reads the output of git_log() in a single pass.
+
+    Returns:
+        dict: The timestamp of the last commit of each file, by path relative to the repository.
+    """
+    timestamps = {}
+    timestamp = 0
+    for line in text.splitlines():
+        if line.startswith(marker):
+            timestamp = int(line[1:])
+        elif line:
+            # the commits are not strictly in time order across merged branches
+            if timestamp > timestamps.get(line, -1):
+                timestamps[line] = timestamp
+    return timestamps
+
+
+def commit_dates(repo, paths):
+    """
+    Args:
+        repo (str): A folder in the repository.
+        paths (list): The folders (or files) to date, relative to repo.
+
+    Returns:
+        dict: The local time (datetime) of the last commit of each file, by absolute path;
+        empty if repo is not a git repository or git is not installed.
+    """
+    try:
+        top = subprocess.run(['git', '-C', repo, 'rev-parse', '--show-toplevel'],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+                             text=True).stdout.strip()
+        text = git_log(repo, paths)
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    return {os.path.normpath(os.path.join(top, f)): datetime.fromtimestamp(t)
+            for f, t in parse_log(text).items()}
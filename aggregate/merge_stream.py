@@ -0,0 +1,234 @@
+'''
+Out-of-core merge of the submitted designs, for aggregate.py
+
+Each design is written to its own GDS file (a shard) as soon as it is placed,
+and is represented in the merged layout by an empty ghost cell of the same
+name, so that only the top-level framework, lasers and routing stay in memory.
+The output is the GDS of the merged layout, followed by the cells of all the
+shards, concatenated record by record:
+
+  shards = ShardWriter(layout, directory)
+  ghost = shards.add(layout2, cell_index)   # instantiate ghost in the merged layout
+  ...
+  shards.write(top_cell, 'Shuksan.gds')
+
+The merge never holds more than one design, so its peak memory does not grow
+with the number of designs. OASIS files cannot be concatenated, and an image
+needs the whole layout, so the OASIS file and the image are made afterwards, by
+a separate and optional step that reads the merged GDS in full:
+
+  python merge_stream.py Shuksan.gds          # Shuksan.oas and Shuksan.png
+
+The cell names of the shards are reserved in the merged layout, by empty ghost
+cells that are never written, so that the cells created later (waveguides,
+library cells) get other names.
+'''
+
+import os
+import sys
+import shutil
+import struct
+import argparse
+import pya
+
+# GDSII record types
+GDS_ENDLIB = 0x04
+GDS_BGNSTR = 0x05
+GDS_UNITS = 0x03
+
+
+def gds_records(file):
+    """
+    Reads the record headers of a GDS file, skipping over the data.
+
+    Yields:
+        (offset, length, record type) of each record, up to and including ENDLIB.
+    """
+    file.seek(0)
+    offset = 0
+    while True:
+        header = file.read(4)
+        if len(header) < 4:
+            raise ValueError('GDS file ends without ENDLIB: %s' % file.name)
+        length, record_type = struct.unpack('>HB', header[:3])
+        if length < 4:
+            raise ValueError('Invalid GDS record at %s in %s' % (offset, file.name))
+        yield offset, length, record_type
+        if record_type == GDS_ENDLIB:
+            return
+        offset += length
+        file.seek(offset)
+
+
+def gds_library(file):
+    """
+    Returns:
+        bytes: the UNITS record.
+        int: the offset of the first cell (BGNSTR).
+        int: the offset of ENDLIB.
+    """
+    units, first = None, None
+    for offset, length, record_type in gds_records(file):
+        if record_type == GDS_UNITS:
+            file.seek(offset)
+            units = file.read(length)
+        elif record_type == GDS_BGNSTR and first is None:
+            first = offset
+        elif record_type == GDS_ENDLIB:
+            return units, offset if first is None else first, offset
+
+
+def copy_range(source, destination, start, stop, chunk_size=1 << 20):
+    source.seek(start)
+    while start < stop:
+        data = source.read(min(chunk_size, stop - start))
+        if not data:
+            raise ValueError('Unexpected end of %s' % source.name)
+        destination.write(data)
+        start += len(data)
+
+
+def concatenate_gds(top_path, shard_paths, output_path):
+    """
+    Writes the cells of the top GDS file and of the shards into one GDS file,
+    without loading them. All the files must have the same units.
+
+    Returns:
+        int: The size of the output [bytes].
+    """
+    with open(top_path, 'rb') as top, open(output_path + '.part', 'wb') as output:
+        units, first, end = gds_library(top)
+        copy_range(top, output, 0, end)
+        for shard_path in shard_paths:
+            with open(shard_path, 'rb') as shard:
+                shard_units, first, end = gds_library(shard)
+                if shard_units != units:
+                    raise ValueError('Database units of %s differ from the merged layout' % shard_path)
+                copy_range(shard, output, first, end)
+        output.write(struct.pack('>HBB', 4, GDS_ENDLIB, 0))
+    os.replace(output_path + '.part', output_path)
+    return os.path.getsize(output_path)
+
+
+class ShardWriter:
+    """
+    Writes the designs to shards in a directory, and reserves their cell names
+    in the merged layout.
+
+    Args:
+        layout (pya.Layout): The merged layout.
+        directory (str): Where the shards are written; it is created, and removed by write().
+    """
+
+    def __init__(self, layout, directory):
+        self.layout = layout
+        self.directory = directory
+        self.paths = []
+        self.names = []  # of the ghost cell of each shard
+        self.bytes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _reserve(self, name):
+        name = self.layout.unique_cell_name(name)
+        self.layout.create_cell(name).ghost_cell = True
+        return name
+
+    def add(self, layout2, cell_index):
+        """
+        Writes a cell of another layout, and its hierarchy, to a shard, with its
+        cells renamed to names that are unique in the merged layout.
+        The cells are copied to a new layout first, so that the shard contains
+        only what is used by the cell, and layout2 is not modified.
+
+        Returns:
+            pya.Cell: The ghost cell in the merged layout, with the name of the cell.
+        """
+        layout3 = pya.Layout()
+        layout3.dbu = layout2.dbu
+        cell = layout3.create_cell(layout2.cell(cell_index).name)
+        cell.copy_tree(layout2.cell(cell_index))
+        for child_index in cell.called_cells():
+            child = layout3.cell(child_index)
+            child.name = self._reserve(child.name)
+        cell.name = self._reserve(cell.name)
+
+        path = os.path.join(self.directory, '%05d.gds' % len(self.paths))
+        options = pya.SaveLayoutOptions()
+        options.format = 'GDS2'
+        options.write_context_info = False
+        layout3.write(path, options)
+        self.paths.append(path)
+        self.names.append(cell.name)
+        self.bytes += os.path.getsize(path)
+        return self.layout.cell(cell.name)
+
+    def write(self, top_cell, output_path):
+        """
+        Writes the merged layout, top_cell and the cells it uses, followed by the shards
+        that it uses, to a GDS file, see convert_layout() for OASIS. The shards of the
+        designs that were not placed are left out, as export_layout() leaves out their cells;
+        paths is then the shards that were written.
+
+        Returns:
+            int: The size of the output [bytes].
+        """
+        top_path = os.path.join(self.directory, 'top.gds')
+        options = pya.SaveLayoutOptions()
+        options.format = 'GDS2'
+        options.select_cell(top_cell.cell_index())
+        self.layout.write(top_path, options)
+        used = {self.layout.cell(index).name for index in top_cell.called_cells()}
+        self.paths = [path for path, name in zip(self.paths, self.names) if name in used]
+        try:
+            return concatenate_gds(top_path, self.paths, output_path)
+        finally:
+            shutil.rmtree(self.directory)
+
+
+def convert_layout(gds_path, output_path=None, image_path=None, technology='SiEPICfab_EBeam_ZEP'):
+    """
+    Writes the merged GDS file as OASIS, and saves its image. This reads the whole
+    layout, so it is kept out of the merge.
+
+    Args:
+        output_path (str): The OASIS file, None for none.
+        image_path (str): The image, None for none (Cell.image of SiEPIC.extend).
+        technology (str): For the layer colours of the image.
+    """
+    layout = pya.Layout()
+    layout.read(gds_path)
+    top_cell = layout.top_cell()
+    if output_path:
+        options = pya.SaveLayoutOptions()
+        options.set_format_from_filename(output_path)
+        options.write_context_info = False
+        # as SiEPIC.scripts.export_layout does
+        options.oasis_compression_level = 10
+        options.oasis_permissive = True
+        layout.write(output_path, options)
+    if image_path:
+        import SiEPIC.extend  # Cell.image
+        import siepicfab_ebeam_zep  # registers the technology
+        # the technology adds the cells of its libraries as other top cells
+        layout.technology_name = technology
+        top_cell.image(image_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Converts the GDS of a streaming merge to OASIS, with its image')
+    parser.add_argument('gds', help='the merged layout, e.g. Shuksan.gds')
+    parser.add_argument('--output', default=None, help='OASIS file (default: next to the GDS, .oas)')
+    parser.add_argument('--image', default=None, help='image (default: next to the GDS, .png)')
+    parser.add_argument('--no-image', action='store_true', help='only write the OASIS file')
+    args = parser.parse_args(argv)
+
+    base = os.path.splitext(args.gds)[0]
+    output_path = args.output or base + '.oas'
+    image_path = None if args.no_image else args.image or base + '.png'
+    convert_layout(args.gds, output_path, image_path)
+    print('Wrote %s%s' % (output_path, ', ' + image_path if image_path else ''))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
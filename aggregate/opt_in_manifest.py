@@ -0,0 +1,104 @@
+'''
+Manifest of the opt_in measurement labels of the merged layout, for aggregate.py
+
+The labels are collected while the designs are loaded, in the coordinates of
+each design cell, and are written with their position on the chip once the
+design cells are placed, so that the measurement tools do not need to load
+the merged layout to find them:
+
+  manifest = OptInManifest()
+  manifest.add(design_cell, 'opt_in_TE_1310_device_x_MZI1', Point(10, 20), 'ELEC413', 'x.gds')
+  ...
+  manifest.write(top_cell, 'Shuksan_opt_in')   # Shuksan_opt_in.json, Shuksan_opt_in.csv
+
+Each entry has: opt_in, x, y [µm, in the top cell], design (cell name),
+course, file.
+'''
+
+import csv
+import json
+import pya
+
+fields = ['opt_in', 'x', 'y', 'design', 'course', 'file']
+
+
+def cell_trans(cell, top_cell):
+    """
+    Returns:
+        pya.ICplxTrans: The transformation from the cell to top_cell, following
+        the first instance of each cell; None if the cell is not placed under top_cell.
+    """
+    layout = cell.layout()
+    trans = pya.ICplxTrans()
+    while cell.cell_index() != top_cell.cell_index():
+        parents = list(cell.each_parent_inst())
+        if not parents:
+            return None
+        trans = parents[0].child_inst().cplx_trans * trans
+        cell = layout.cell(parents[0].parent_cell_index())
+    return trans
+
+
+def load_manifest(path):
+    """
+    Returns:
+        list: The entries (dict) of a manifest written as JSON.
+    """
+    with open(path) as file:
+        return json.load(file)['labels']
+
+
+class OptInManifest:
+    """
+    Collects the opt_in labels of the designs, in design cell coordinates.
+    """
+
+    def __init__(self):
+        self.designs = {}  # cell index -> (cell, course, file, [(opt_in, pya.Point)])
+
+    def add(self, cell, opt_in, point, course, file):
+        """
+        Args:
+            cell (pya.Cell): The design cell, in the merged layout.
+            opt_in (str): The label.
+            point (pya.Point): The position of the label in the cell [dbu].
+            course (str): The course of the design.
+            file (str): The submitted file.
+        """
+        self.designs.setdefault(cell.cell_index(), (cell, course, file, []))[3].append((opt_in, point))
+
+    def entries(self, top_cell):
+        """
+        Returns:
+            list: The labels (dict), with their position in top_cell [µm].
+            list: The names of the design cells that are not placed.
+        """
+        dbu = top_cell.layout().dbu
+        entries, missing = [], []
+        for cell, course, file, labels in self.designs.values():
+            trans = cell_trans(cell, top_cell)
+            if trans is None:
+                missing.append(cell.name)
+                continue
+            for opt_in, point in labels:
+                p = trans * point
+                entries.append({'opt_in': opt_in, 'x': round(p.x * dbu, 3), 'y': round(p.y * dbu, 3),
+                                'design': cell.name, 'course': course, 'file': file})
+        return entries, missing
+
+    def write(self, top_cell, path_base):
+        """
+        Writes path_base.json and path_base.csv.
+
+        Returns:
+            list: The labels (dict) that were written.
+            list: The names of the design cells that are not placed.
+        """
+        entries, missing = self.entries(top_cell)
+        with open(path_base + '.json', 'w') as file:
+            json.dump({'top_cell': top_cell.name, 'dbu': top_cell.layout().dbu, 'labels': entries}, file, indent=1)
+        with open(path_base + '.csv', 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(entries)
+        return entries, missing
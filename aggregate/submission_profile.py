@@ -0,0 +1,141 @@
+'''
+Complexity profile of a submitted layout, and resource budgets
+
+One submission with, e.g., a flattened spiral with millions of vertices, or a
+deep hierarchy, slows down the verification and the merge for everyone.
+The profile counts, per file:
+ - shapes per layer, vertices, cells, instances and the hierarchy depth;
+ - the same counts for the flattened layout (each cell times the number of
+   times it is placed), and the blowup, flattened / hierarchical vertices;
+ - an estimate of the memory used by the layout, hierarchical and flattened.
+
+run_verification.py rejects the files that exceed the budgets, and
+aggregate.py logs the profile of each design. Usage:
+  python submission_profile.py ../submissions/*.gds
+'''
+
+import os
+import sys
+import pya
+
+# Budgets, per file; a design that exceeds one of them is rejected by run_verification.py
+budgets = {
+    'vertices': 5e6,          # stored in the file
+    'flat_vertices': 50e6,    # after flattening
+    'shapes': 1e6,
+    'flat_instances': 1e6,
+    'depth': 20,              # levels of hierarchy below the top cell
+    'memory_MB': 200,         # estimated, hierarchical
+}
+
+# Estimate of the memory used by KLayout [bytes]
+bytes_per_vertex = 8
+bytes_per_shape = 40
+bytes_per_instance = 64
+bytes_per_cell = 600
+
+
+def shape_vertices(shape):
+    """
+    Returns:
+        int: The number of vertices of a shape; the spine of a path counts twice (its outline).
+    """
+    if shape.is_box():
+        return 4
+    if shape.is_polygon() or shape.is_simple_polygon():
+        return shape.polygon.num_points()
+    if shape.is_path():
+        return 2 * shape.path.num_points()
+    return 1
+
+
+def profile_layout(layout):
+    """
+    Profiles the hierarchy of the top cells of a layout.
+
+    Returns:
+        dict: cells, depth, shapes, flat_shapes, vertices, flat_vertices,
+        instances, flat_instances, blowup, memory_MB, flat_memory_MB, and
+        layers: {layer: [shapes, flat shapes]}
+    """
+    # number of times each cell is placed, and its depth below the top cells
+    multiplicity = {c.cell_index(): 1 for c in layout.top_cells()}
+    depth = {c.cell_index(): 0 for c in layout.top_cells()}
+    p = {'cells': layout.cells(), 'depth': 0, 'shapes': 0, 'flat_shapes': 0,
+         'vertices': 0, 'flat_vertices': 0, 'instances': 0, 'flat_instances': 0, 'layers': {}}
+    layers = [(li, layout.get_info(li).to_s()) for li in layout.layer_indexes()]
+    for cell_index in layout.each_cell_top_down():
+        cell = layout.cell(cell_index)
+        n = multiplicity.get(cell_index, 0)
+        d = depth.get(cell_index, 0)
+        p['depth'] = max(p['depth'], d)
+        for inst in cell.each_inst():
+            child = inst.cell_index
+            multiplicity[child] = multiplicity.get(child, 0) + n * inst.size()
+            depth[child] = max(depth.get(child, 0), d + 1)
+            p['instances'] += 1
+            p['flat_instances'] += n * inst.size()
+        for layer_index, layer in layers:
+            shapes = cell.shapes(layer_index)
+            if shapes.is_empty():
+                continue
+            count = shapes.size()
+            vertices = sum(shape_vertices(shape) for shape in shapes.each())
+            counts = p['layers'].setdefault(layer, [0, 0])
+            counts[0] += count
+            counts[1] += n * count
+            p['shapes'] += count
+            p['flat_shapes'] += n * count
+            p['vertices'] += vertices
+            p['flat_vertices'] += n * vertices
+    p['blowup'] = p['flat_vertices'] / p['vertices'] if p['vertices'] else 1
+    p['memory_MB'] = (p['vertices'] * bytes_per_vertex + p['shapes'] * bytes_per_shape
+                      + p['instances'] * bytes_per_instance + p['cells'] * bytes_per_cell) / 1e6
+    p['flat_memory_MB'] = (p['flat_vertices'] * bytes_per_vertex + p['flat_shapes'] * bytes_per_shape) / 1e6
+    return p
+
+
+def profile_file(path):
+    """
+    Loads a layout file and profiles it.
+
+    Returns:
+        dict: See profile_layout; with the file size [bytes] as file_size.
+    """
+    layout = pya.Layout()
+    layout.read(path)
+    p = profile_layout(layout)
+    p['file_size'] = os.path.getsize(path)
+    return p
+
+
+def check_budgets(p, budgets=budgets):
+    """
+    Returns:
+        list: Error messages, one for each budget that the profile exceeds.
+    """
+    return ['Error: %s of %s exceeds the budget of %s for a design' % (key.replace('_', ' '), '%.0f' % p[key], '%.0f' % limit)
+            for key, limit in budgets.items() if p[key] > limit]
+
+
+def summary(p):
+    """
+    Returns:
+        str: One line, with the main numbers of a profile.
+    """
+    return ('%s cells, depth %s, %s shapes, %s vertices (%s flattened, blowup %.1f), '
+            '%s instances (%s flattened), ~%.1f MB' % (p['cells'], p['depth'], p['shapes'], p['vertices'],
+            p['flat_vertices'], p['blowup'], p['instances'], p['flat_instances'], p['memory_MB']))
+
+
+if __name__ == "__main__":
+    over = 0
+    for path in sys.argv[1:]:
+        p = profile_file(path)
+        print('%s: %s' % (os.path.basename(path), summary(p)))
+        for layer, (count, flat_count) in sorted(p['layers'].items()):
+            print('  %-8s %10s shapes %12s flattened' % (layer, count, flat_count))
+        for error in check_budgets(p):
+            print('  ' + error)
+            over += 1
+    sys.exit(1 if over else 0)
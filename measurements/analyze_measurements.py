@@ -0,0 +1,357 @@
+'''
+Headless batch analysis of the sweepLaser measurements.
+
+Extracts per-channel metrics from every matched device in a process pool,
+and writes a single summary table, e.g.:
+  python analyze_measurements.py --output summary.csv
+'''
+
+import os
+import re
+import csv
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.fft import next_fast_len
+from scipy.ndimage import median_filter, uniform_filter1d
+
+CONST_NoiseFloor = -50  # only plot files that exceed the measurement noise floor
+CONST_SmoothingWidth = 0.05  # nm, moving average before finding peaks and nulls
+CONST_BaselineWidth = 2  # nm, running median used as the baseline under narrow features
+CONST_Passband = 10  # dB, below the peak transmission, where the spectrum is analyzed
+CONST_MinProminence = 3  # dB, smallest peak or null that is counted
+CONST_MinPeriods = 3  # times the FSR fits in the passband, for the FSR to be measured
+CONST_MinFringeDepth = 1.3  # dB, peak to peak, of the strongest period for it to be an FSR; the setup has ~1 dB, ~12 nm ripples
+
+SUMMARY_COLUMNS = ['device', 'type', 'file', 'channel', 'above_noise_floor',
+                   'peak_dB', 'peak_wavelength_nm', 'insertion_loss_dB',
+                   'fsr_nm', 'extinction_ratio_dB',
+                   'resonance_wavelength_nm', 'resonance_fwhm_nm', 'q_factor']
+
+
+def load_mat_spectrum(mat_file_path):
+    """
+    Reads the spectrum data from a sweepLaser .mat file.
+
+    Args:
+        mat_file_path (str): Path to the .mat file.
+
+    Returns:
+        numpy.ndarray: The wavelengths [nm].
+        dict: channel number -> transmission [dB], for the channels in the file.
+    """
+    import scipy.io  # not needed to import the constants, e.g. by the viewer
+    mat_data = scipy.io.loadmat(mat_file_path)
+    test_result = mat_data.get("testResult")
+    test_result_inner = test_result[0, 0]
+    rows_data = test_result_inner["rows"]
+    rows_inner = rows_data[0, 0]
+    wavelengths = test_result[0][0][0]['wavelength'].flatten()[0].flatten()
+
+    channels = {}
+    for i in range(1, 5):
+        channel_key = f"channel_{i}"
+        if channel_key in rows_inner.dtype.names:
+            channels[i] = rows_inner[channel_key].flatten()
+    return wavelengths, channels
+
+
+def device_type(device):
+    """
+    Classifies a device from its name, to select the metrics that apply.
+
+    Returns:
+        str: 'ring' for PCM_RingDoubler*, 'mzi' for MZIs, otherwise 'other'.
+    """
+    if device.startswith('PCM_RingDoubler'):
+        return 'ring'
+    if 'mzi' in device.lower():
+        return 'mzi'
+    return 'other'
+
+
+def _samples(wavelengths, width):
+    step = abs(wavelengths[-1] - wavelengths[0]) / max(len(wavelengths) - 1, 1)
+    return max(int(round(width / step)), 1) if step else 1, step
+
+
+def _smooth(wavelengths, spectrum):
+    n, step = _samples(wavelengths, CONST_SmoothingWidth)
+    return uniform_filter1d(spectrum, size=n, mode='nearest')
+
+
+def _passband(wavelengths, smooth):
+    """
+    Returns:
+        slice: the contiguous range around the peak of the running-median envelope,
+        that is within CONST_Passband of that peak.
+    """
+    n, step = _samples(wavelengths, CONST_BaselineWidth)
+    envelope = median_filter(smooth, size=2 * n + 1, mode='nearest')
+    peak = int(np.argmax(envelope))
+    outside = np.flatnonzero(envelope < envelope[peak] - CONST_Passband)
+    start = outside[outside < peak].max() + 1 if (outside < peak).any() else 0
+    stop = outside[outside > peak].min() if (outside > peak).any() else len(smooth)
+    return slice(start, stop)
+
+
+def estimate_fsr(wavelengths, spectrum):
+    """
+    Estimates the free spectral range from the strongest period of the spectrum, in
+    linear units relative to a parabolic envelope in dB, which removes the grating
+    couplers but not the long periods. A period is only counted if it fits
+    CONST_MinPeriods times in the spectrum, and if its ripple is at least
+    CONST_MinFringeDepth deep, so that the small ripple of the setup is not an FSR.
+
+    Returns:
+        float: The FSR [nm], or None if there is no such period.
+    """
+    span = abs(wavelengths[-1] - wavelengths[0])
+    if len(spectrum) < 16 or not span:
+        return None
+    step = span / (len(spectrum) - 1)
+    x = (wavelengths - wavelengths.mean()) / span
+    ratio = 10 ** ((spectrum - np.polyval(np.polyfit(x, spectrum, 2), x)) / 10)
+    window = np.hanning(len(ratio))
+    # zero-padded, to interpolate the long periods, which are only a few frequency bins
+    length = next_fast_len(4 * len(ratio), real=True)
+    amplitude = np.abs(np.fft.rfft((ratio / ratio.mean() - 1) * window, n=length)) * 2 / window.sum()
+    frequencies = np.fft.rfftfreq(length, d=step)
+    valid = np.flatnonzero(frequencies >= CONST_MinPeriods / span)
+    # only the local maxima: the tail of a longer period, which does not fit CONST_MinPeriods
+    # times, is not one, however fine the frequency grid
+    valid = valid[(amplitude[valid] >= amplitude[valid - 1])
+                  & (amplitude[valid] >= amplitude[np.minimum(valid + 1, len(amplitude) - 1)])]
+    if not len(valid):
+        return None
+    best = int(valid[np.argmax(amplitude[valid])])
+    # the relative amplitude m of the fringes, (1 + m cos) in linear units
+    depth = 10 * np.log10((1 + amplitude[best]) / max(1 - amplitude[best], 1e-12))
+    if depth < CONST_MinFringeDepth:
+        return None
+    offset = 0
+    if best < len(frequencies) - 1:
+        # parabolic interpolation of the log amplitude between frequency bins
+        left, center, right = np.log(amplitude[best - 1:best + 2] + 1e-300)
+        curvature = left - 2 * center + right
+        offset = np.clip(0.5 * (left - right) / curvature, -0.5, 0.5) if curvature < 0 else 0
+    return float(1 / (frequencies[best] + offset * frequencies[1]))
+
+
+def mzi_metrics(wavelengths, spectrum):
+    """
+    Estimates the free spectral range of an MZI spectrum within the passband, and the
+    extinction ratio from the nulls that are one FSR apart.
+
+    Returns:
+        dict: fsr_nm and extinction_ratio_dB, None if they cannot be estimated.
+    """
+    from scipy.signal import find_peaks
+    smooth = _smooth(wavelengths, spectrum)
+    band = _passband(wavelengths, smooth)
+    wavelengths, smooth = wavelengths[band], smooth[band]
+    fsr = estimate_fsr(wavelengths, smooth)
+    if not fsr:
+        return {'fsr_nm': None, 'extinction_ratio_dB': None}
+    n, step = _samples(wavelengths, fsr)
+    nulls, properties = find_peaks(-smooth, prominence=CONST_MinProminence, distance=max(int(0.7 * n), 1))
+    return {'fsr_nm': fsr,
+            'extinction_ratio_dB': float(np.median(properties['prominences'])) if len(nulls) else None}
+
+
+def ring_metrics(wavelengths, spectrum):
+    """
+    Finds the strongest resonance of a ring spectrum, the highest peak (drop port),
+    or else the deepest null (through port) relative to the running-median baseline,
+    and its quality factor from the full width at half maximum, in linear units.
+
+    Returns:
+        dict: resonance_wavelength_nm, resonance_fwhm_nm and q_factor, None if no resonance is found.
+    """
+    from scipy.signal import find_peaks, peak_widths
+    smooth = _smooth(wavelengths, spectrum)
+    band = _passband(wavelengths, smooth)
+    n, step = _samples(wavelengths, CONST_BaselineWidth)
+    wavelengths, smooth = wavelengths[band], smooth[band]
+    baseline = median_filter(smooth, size=2 * n + 1, mode='nearest')
+    for sign in (1, -1):
+        features, _ = find_peaks(sign * (smooth - baseline), prominence=CONST_MinProminence, wlen=2 * n + 1)
+        if len(features):
+            break
+    if not len(features):
+        return {'resonance_wavelength_nm': None, 'resonance_fwhm_nm': None, 'q_factor': None}
+    feature = features[np.argmax(sign * smooth[features])]
+    linear = sign * 10 ** ((smooth - baseline) / 10)
+    fwhm = peak_widths(linear, [feature], rel_height=0.5, wlen=2 * n + 1)[0][0] * step
+    resonance = float(wavelengths[feature])
+    return {'resonance_wavelength_nm': resonance, 'resonance_fwhm_nm': float(fwhm),
+            'q_factor': float(resonance / fwhm) if fwhm else None}
+
+
+def channel_metrics(wavelengths, spectrum, kind='other'):
+    """
+    Computes the summary metrics of one channel of a spectrum.
+
+    Args:
+        wavelengths (numpy.ndarray): The wavelengths [nm].
+        spectrum (numpy.ndarray): The transmission [dB].
+        kind (str): The device type, from device_type().
+
+    Returns:
+        dict: The metrics, with the keys from SUMMARY_COLUMNS.
+    """
+    peak = int(np.argmax(spectrum))
+    metrics = {'above_noise_floor': bool(spectrum[peak] > CONST_NoiseFloor),
+               'peak_dB': float(spectrum[peak]),
+               'peak_wavelength_nm': float(wavelengths[peak]),
+               'insertion_loss_dB': float(-spectrum[peak])}
+    if not metrics['above_noise_floor']:
+        return metrics
+    if kind == 'mzi':
+        metrics.update(mzi_metrics(wavelengths, spectrum))
+    elif kind == 'ring':
+        metrics.update(ring_metrics(wavelengths, spectrum))
+    return metrics
+
+
+def analyze_file(device, mat_file_path):
+    """
+    Computes the metrics of every channel in a .mat file.
+
+    Returns:
+        list: One summary row (dict) per channel.
+    """
+    kind = device_type(device)
+    try:
+        wavelengths, channels = load_mat_spectrum(mat_file_path)
+    except Exception as e:
+        print(f"Error reading {mat_file_path}: {e}")
+        return []
+    rows = []
+    for channel, spectrum in channels.items():
+        row = {'device': device, 'type': kind, 'file': mat_file_path, 'channel': channel}
+        row.update(channel_metrics(wavelengths, spectrum, kind))
+        rows.append(row)
+    return rows
+
+
+def _analyze_file(args):
+    return analyze_file(*args)
+
+
+def analyze_devices(files, workers=None):
+    """
+    Analyzes many measurements in a process pool.
+
+    Args:
+        files (list): (device, .mat file path) pairs.
+        workers (int): Number of processes, by default the number of CPUs.
+
+    Returns:
+        list: The summary rows of all the files, in the order of files.
+    """
+    rows = []
+    if workers == 1:
+        for f in files:
+            rows += analyze_file(*f)
+        return rows
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(_analyze_file, files, chunksize=4):
+            rows += result
+    return rows
+
+
+def files_from_matches(matches):
+    """
+    Returns:
+        list: (device, .mat file path) pairs for every file in the matches
+        from match_files_with_labels, which alternate file paths and labels.
+    """
+    return [(device, f) for device in sorted(matches, key=str.casefold)
+            for f in matches[device][0::2]]
+
+
+def files_from_folders(mat_files_dir):
+    """
+    Without a layout, every folder containing .mat files is treated as a device.
+
+    Returns:
+        list: (device, .mat file path) pairs.
+    """
+    files = []
+    for root, _, filenames in os.walk(mat_files_dir):
+        for file in sorted(filenames):
+            if file.endswith(".mat"):
+                files.append((os.path.basename(root), os.path.join(root, file)))
+    return sorted(files, key=lambda f: (f[0].casefold(), f[1]))
+
+
+def write_summary(rows, output_path):
+    """
+    Writes the summary rows to a CSV file.
+    """
+    with open(output_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: ('' if row.get(k) is None else row.get(k)) for k in SUMMARY_COLUMNS})
+    print(f"Summary written to {output_path}")
+
+
+def main(argv=None):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mat-files', default=os.path.join(script_dir, 'mat_files'),
+                        help='directory containing the .mat files')
+    parser.add_argument('--output', default=os.path.join(script_dir, 'summary.csv'),
+                        help='summary table (CSV)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('--no-layout', action='store_true',
+                        help='use the folder names as devices, instead of matching the opt_in labels in Shuksan.oas')
+    parser.add_argument('--filter', default=None,
+                        help='only analyze devices matching this regular expression')
+    parser.add_argument('--database', default=None, nargs='?', const='',
+                        help='keep the metrics in this SQLite database (default: measurements.sqlite), '
+                             'and only analyze the new or changed files')
+    parser.add_argument('--latest', action='store_true',
+                        help='with --database, only summarize the latest sweep of each device')
+    args = parser.parse_args(argv)
+
+    opt_ins = {}
+    if args.no_layout:
+        files = files_from_folders(args.mat_files)
+    else:
+        # the labels come from the snapshot next to the layout, when it is up to date
+        from layout_access import LayoutDatabase
+        matches = LayoutDatabase(mat_files_dir=args.mat_files).matches
+        files = files_from_matches(matches)
+        opt_ins = {key: matches[key][1]['opt_in'] for key in matches}
+    if args.filter:
+        files = [f for f in files if re.search(args.filter, f[0])]
+
+    if args.database is None:
+        rows = analyze_devices(files, workers=args.workers)
+    else:
+        from measurement_db import MeasurementDatabase
+        db = MeasurementDatabase(args.database or None)
+        read, removed = db.update(files, opt_ins, workers=args.workers)
+        print(f"Analyzed {read} new or changed files")
+        devices = {f[0] for f in files}
+        sweeps = db.latest_per_device() if args.latest else db.sweeps()
+        rows = db.summary_rows([s for s in sweeps if s['device'] in devices])
+        db.close()
+    write_summary(rows, args.output)
+
+    devices = {r['device'] for r in rows}
+    below = {r['device'] for r in rows} - {r['device'] for r in rows if r['above_noise_floor']}
+    print(f"Analyzed {len(files)} files, {len(devices)} devices, {len(rows)} channels")
+    print(f"Devices with no channel above the noise floor ({CONST_NoiseFloor} dB): {len(below)}")
+    for device in sorted(below, key=str.casefold):
+        print(f" - {device}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+'''
+Import time of the measurement tools, from python -X importtime, as a regression
+check that the heavy dependencies (KLayout, SiEPIC-Tools, scipy, matplotlib) are
+only imported by the code paths that use them, e.g.:
+  python benchmark_imports.py --repeat 3
+Exits with 1 if a module takes longer than its budget.
+'''
+
+import os
+import sys
+import argparse
+import subprocess
+
+# seconds, cumulative import time of each module, in a fresh interpreter
+CONST_ImportBudgets = {
+    'fetch_measurement_data': 0.5,  # the download CLI starts well under a second
+    'layout_access': 0.5,
+    'analyze_measurements': 1.0,
+    'spectra': 1.0,
+    'development': 2.0,
+    'viewer': 2.0,
+    'test_plan': 0.5,
+    'circuit_simulator': 0.5,
+    'mzi_fit': 1.0,
+}
+
+
+def import_times(module, cwd=None):
+    """
+    Imports a module in a new interpreter with -X importtime.
+
+    Args:
+        module (str): The module to import.
+        cwd (str): The working directory, where the module is found.
+
+    Returns:
+        float: The cumulative import time of the module [s].
+        list: (cumulative time [s], package) of the modules it imports directly.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+    # import time: self [us] | cumulative | imported package, indented two spaces per level,
+    # each package after the ones it imports
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((level, int(cumulative) * 1e-6, name.strip()))
+    total, children = None, []
+    for i in range(len(entries) - 1, -1, -1):
+        level, cumulative, name = entries[i]
+        if level == 0 and name == module:
+            total = cumulative
+            for level2, cumulative2, name2 in reversed(entries[:i]):
+                if level2 == 0:
+                    break
+                if level2 == 1:
+                    children.append((cumulative2, name2))
+            break
+    if total is None:
+        raise RuntimeError(f"import {module}: no importtime entry")
+    return total, sorted(children, reverse=True)
+
+
+def main(argv=None):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('modules', nargs='*', default=list(CONST_ImportBudgets),
+                        help='modules to import (default: all the tools with a budget)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of imports of each module, the fastest is reported')
+    parser.add_argument('--top', type=int, default=3,
+                        help='number of the slowest direct imports to list')
+    args = parser.parse_args(argv)
+
+    print(f"{'module':<26}{'time [ms]':>12}{'budget [ms]':>13}  slowest imports")
+    over = []
+    for module in args.modules:
+        total, children = min((import_times(module, script_dir) for i in range(args.repeat)),
+                              key=lambda t: t[0])
+        budget = CONST_ImportBudgets.get(module)
+        slowest = ', '.join(f"{name} {t * 1e3:.0f}" for t, name in children[:args.top])
+        print(f"{module:<26}{total * 1e3:>12.0f}{'' if budget is None else f'{budget * 1e3:.0f}':>13}  {slowest}")
+        if budget is not None and total > budget:
+            over.append(module)
+    if over:
+        print(f"Over budget: {', '.join(over)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
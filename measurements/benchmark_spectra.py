@@ -0,0 +1,158 @@
+'''
+Benchmark of the vectorized spectra analysis on the sweepLaser measurements,
+against the per-channel analysis in analyze_measurements, e.g.:
+  python benchmark_spectra.py --repeat 3
+The FSR estimates are first checked on synthetic MZI spectra of known FSR;
+exits with 1 if one of them is wrong.
+'''
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+import spectra
+from analyze_measurements import files_from_folders, channel_metrics, estimate_fsr
+
+CONST_CheckFSRs = [0.14, 1, 10]  # nm, of the synthetic spectra
+
+
+def best_time(function, repeat):
+    """
+    Returns:
+        float: The fastest of repeat calls [s].
+        The result of the last call.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def synthetic_spectrum(wavelengths, fsr, visibility=0.8, noise=0.2, seed=0):
+    """
+    Returns:
+        numpy.ndarray: An MZI spectrum [dB], with a parabolic grating coupler envelope
+        and noise [dB]; without fringes if fsr is None.
+    """
+    envelope = -20 - 0.004 * (wavelengths - 1310) ** 2
+    noise = np.random.default_rng(seed).normal(0, noise, len(wavelengths))
+    if fsr is None:
+        return envelope + noise
+    return envelope + 10 * np.log10((1 + visibility * np.cos(2 * np.pi * wavelengths / fsr)) / 2) + noise
+
+
+def check_fsr(wavelengths):
+    """
+    Estimates the FSR of synthetic spectra within a 50 nm passband, one at a time
+    and with the vectorized analysis.
+
+    Returns:
+        list: (expected FSR, estimated FSR) [nm] of the spectra where they differ by more than 1%,
+        None for the spectrum without fringes.
+    """
+    band = (wavelengths > 1285) & (wavelengths < 1335)
+    fsrs = CONST_CheckFSRs + [None]
+    stack = np.array([synthetic_spectrum(wavelengths, fsr) for fsr in fsrs])
+    start, stop = np.argmax(band), len(band) - np.argmax(band[::-1])
+    vectorized = spectra.estimate_fsr(wavelengths, stack, np.full(len(fsrs), start), np.full(len(fsrs), stop))
+    wrong = []
+    for fsr, spectrum, estimate2 in zip(fsrs, stack, vectorized):
+        estimate = estimate_fsr(wavelengths[band], spectrum[band])
+        estimate = np.nan if estimate is None else estimate
+        for e in (estimate, estimate2):
+            if not (np.isnan(e) if fsr is None else abs(e - fsr) < 0.01 * fsr):
+                wrong.append((fsr, e))
+        print(f"Synthetic {'FSR %s nm' % fsr if fsr else 'spectrum without fringes'}: "
+              f"estimated {estimate:.4g}, vectorized {estimate2:.4g}{', wrong' if wrong and wrong[-1][0] == fsr else ''}")
+    return wrong
+
+
+def check_missing(wavelengths):
+    """
+    Analyzes synthetic spectra that are all below the noise floor, and one with missing samples.
+
+    Returns:
+        list: The descriptions of the checks that failed.
+    """
+    wrong = []
+    dark = np.full((3, len(wavelengths)), -80.0)
+    results = spectra.analyze_spectra(wavelengths, dark)
+    if results['above_noise_floor'].any() or not np.isnan(results['fsr_nm']).all():
+        wrong.append('spectra below the noise floor')
+    print(f"Spectra below the noise floor: {results['above_noise_floor'].sum()} analyzed, "
+          f"FSR {results['fsr_nm']}{', wrong' if wrong else ''}")
+    fsr = CONST_CheckFSRs[1]
+    spectrum = synthetic_spectrum(wavelengths, fsr)
+    spectrum[len(spectrum) // 2] = np.nan
+    estimate = spectra.analyze_spectra(wavelengths, spectrum[np.newaxis])['fsr_nm'][0]
+    if not abs(estimate - fsr) < 0.01 * fsr:
+        wrong.append('spectrum with a missing sample')
+    print(f"Synthetic FSR {fsr} nm with a missing sample: estimated {estimate:.4g}"
+          f"{', wrong' if wrong and wrong[-1] == 'spectrum with a missing sample' else ''}")
+    return wrong
+
+
+def main(argv=None):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mat-files', default=os.path.join(script_dir, 'mat_files', 'sweepLaser'),
+                        help='directory containing the .mat files')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes reading the files (default: 1)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each stage, the fastest is reported')
+    args = parser.parse_args(argv)
+
+    wrong = check_fsr(np.linspace(1265, 1360, 11876))
+    wrong += check_missing(np.linspace(1265, 1360, 11876))
+
+    files = files_from_folders(args.mat_files)
+    folders = len({os.path.dirname(f[1]) for f in files})
+    t, (wavelengths, stack, index) = best_time(lambda: spectra.load_spectra(files, args.workers), args.repeat)
+    print(f"{folders} folders, {len(files)} files, {stack.shape[0]} spectra x {stack.shape[1]} wavelengths")
+    print(f"{'stage':<24}{'time [ms]':>12}{'spectra/s':>12}")
+
+    def report(stage, seconds):
+        print(f"{stage:<24}{seconds * 1e3:>12.1f}{len(stack) / seconds:>12.0f}")
+
+    report('load', t)
+    smoothed = spectra.smooth(wavelengths, stack)
+    reference = spectra.baseline(wavelengths, smoothed)
+    start, stop = spectra.passband(reference)
+    mask = spectra.band_mask(stack.shape, start, stop)
+    stages = [
+        ('smooth', lambda: spectra.smooth(wavelengths, stack)),
+        ('baseline', lambda: spectra.baseline(wavelengths, smoothed)),
+        ('envelope fit', lambda: spectra.fit_envelope(wavelengths, reference, mask)),
+        ('FSR', lambda: spectra.estimate_fsr(wavelengths, smoothed, start, stop)),
+        ('peaks and nulls', lambda: (spectra.find_extrema(smoothed, reference, mask=mask),
+                                     spectra.find_extrema(-smoothed, -reference, mask=mask))),
+        ('resonance', lambda: spectra.resonance(wavelengths, smoothed, reference, mask)),
+    ]
+    for stage, function in stages:
+        report(stage, best_time(function, args.repeat)[0])
+    t_vectorized, results = best_time(lambda: spectra.analyze_spectra(wavelengths, stack), args.repeat)
+    report('analyze_spectra', t_vectorized)
+
+    # the same metrics, one channel at a time
+    def per_channel():
+        return [(channel_metrics(wavelengths, s, 'mzi'), channel_metrics(wavelengths, s, 'ring')) for s in stack]
+    t_loop, reference_rows = best_time(per_channel, args.repeat)
+    report('per-channel loop', t_loop)
+    print(f"Speed-up: {t_loop / t_vectorized:.1f}x")
+
+    fsr = np.array([np.nan if m.get('fsr_nm') is None else m['fsr_nm'] for m, r in reference_rows])
+    both = np.isfinite(fsr) & np.isfinite(results['fsr_nm'])
+    if both.any():
+        error = np.abs(results['fsr_nm'][both] - fsr[both]) / fsr[both]
+        print(f"FSR agreement with the per-channel analysis: median {np.median(error):.2%}, "
+              f"within 1% for {np.mean(error < 0.01):.0%} of {both.sum()} spectra")
+    return 1 if wrong else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
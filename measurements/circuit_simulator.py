@@ -0,0 +1,382 @@
+'''
+S-parameter simulation of the circuits extracted from the layout.
+
+The SPICE netlist of each opt_in label (spice_netlist_export, see
+layout_access.export_netlist) is parsed, every component is replaced by a
+compact model evaluated on the whole wavelength grid at once, and the circuit
+is solved for the wave entering at the laser port, with one batched linear
+solve over the wavelengths. Many circuits are simulated in a process pool,
+so that the predicted spectra can be overlaid on the measurements, e.g.:
+  python circuit_simulator.py --output simulated.npz
+  python circuit_simulator.py --netlists netlists --plot opt_in_TE_1310_ELEC413_emuller_chip2p1
+
+The compact models are nominal values for the SiEPICfab EBeam ZEP O-band
+components; the 2x2 couplers have ports 1, 2 on one side and 3, 4 on the other.
+'''
+
+import os
+import re
+import sys
+import shlex
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+CONST_Wavelength0 = 1310e-9  # m, where the effective indices are given
+CONST_Points = 10001  # samples over the sweep of the .ona analyzer, without a measurement grid
+CONST_ChunkBytes = 32e6  # memory of the S-matrices of one batch of wavelengths
+
+# waveguide compact model: effective index, group index, loss [dB/cm]
+CONST_Waveguides = {
+    'wg_strip_integral_te1310': (2.50, 4.30, 3.0),
+    'wg_strip_integral_te1310_air': (2.40, 4.50, 3.0),
+}
+CONST_GratingCoupler = {'peak_loss_dB': 6.0, 'center': 1310e-9, 'bandwidth_3dB': 35e-9}
+CONST_Splitters = {  # excess loss [dB], power coupling to the cross port
+    'splitter_swg_assist_te': (0.3, 0.5),
+    'ebeam_directional_coupler_swgassist_te1310': (0.2, 0.5),
+}
+CONST_YBranchLoss = 0.3  # dB
+
+
+def parse_value(value):
+    value = value.strip('"')
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def parse_netlist(text):
+    """
+    Reads the subcircuit and the optical network analyzer of a netlist from spice_netlist_export.
+
+    Returns:
+        dict:
+            name (str): The subcircuit.
+            ports (list): Its external nets.
+            components (list): dict with name, nets (list), model, params (dict).
+            analyzer (dict): start, stop [m], output (laser net), inputs (detector nets).
+    """
+    lines = []
+    for line in text.splitlines():
+        if line.strip().startswith('+') and lines:
+            lines[-1] += ' ' + line.strip()[1:]
+        else:
+            lines.append(line)
+    circuit = {'name': None, 'ports': [], 'components': [], 'analyzer': {'inputs': []}}
+    in_subckt = False
+    for line in lines:
+        tokens = shlex.split(line, comments=False, posix=True) if line.strip() else []
+        if not tokens or tokens[0].startswith('*'):
+            continue
+        keyword = tokens[0].lower()
+        if keyword == '.subckt':
+            circuit['name'], circuit['ports'], in_subckt = tokens[1], tokens[2:], True
+        elif keyword == '.ends':
+            in_subckt = False
+        elif keyword == '.ona':
+            for token in tokens[1:]:
+                key, _, value = token.partition('=')
+                if key in ('start', 'stop'):
+                    circuit['analyzer'][key] = float(value)
+                elif key == 'output':
+                    circuit['analyzer']['output'] = value.split(',')[-1]
+                elif key.startswith('input('):
+                    circuit['analyzer']['inputs'].append(value.split(',')[-1])
+        elif in_subckt and not keyword.startswith('.'):
+            first_param = next((i for i, t in enumerate(tokens) if '=' in t), len(tokens))
+            params = dict(t.split('=', 1) for t in tokens[first_param:])
+            circuit['components'].append({'name': tokens[0], 'nets': tokens[1:first_param - 1],
+                                          'model': tokens[first_param - 1],
+                                          'params': {k: parse_value(v) for k, v in params.items()}})
+    return circuit
+
+
+def waveguide(wavelengths, params, neff, ng, loss_dB_cm):
+    length = params['wg_length']
+    dneff = -(ng - neff) / CONST_Wavelength0  # dneff/dlambda
+    phase = 2 * np.pi * (neff + dneff * (wavelengths - CONST_Wavelength0)) * length / wavelengths
+    t = 10 ** (-loss_dB_cm * length * 100 / 20) * np.exp(-1j * phase)
+    s = np.zeros((len(wavelengths), 2, 2), complex)
+    s[:, 0, 1] = s[:, 1, 0] = t
+    return s
+
+
+def grating_coupler(wavelengths, params, peak_loss_dB, center, bandwidth_3dB):
+    loss_dB = peak_loss_dB + 3 * ((wavelengths - center) / (bandwidth_3dB / 2)) ** 2
+    s = np.zeros((len(wavelengths), 2, 2), complex)
+    s[:, 0, 1] = s[:, 1, 0] = 10 ** (-loss_dB / 20)
+    return s
+
+
+def y_branch(wavelengths, params, loss_dB=CONST_YBranchLoss):
+    s = np.zeros((len(wavelengths), 3, 3), complex)
+    s[:, 0, 1] = s[:, 1, 0] = s[:, 0, 2] = s[:, 2, 0] = np.sqrt(0.5) * 10 ** (-loss_dB / 20)
+    return s
+
+
+def coupler(wavelengths, params, loss_dB, coupling):
+    a = 10 ** (-loss_dB / 20)
+    bar, cross = a * np.sqrt(1 - coupling), -1j * a * np.sqrt(coupling)
+    s = np.zeros((len(wavelengths), 4, 4), complex)
+    for i, j in [(0, 2), (1, 3)]:
+        s[:, i, j] = s[:, j, i] = bar
+    for i, j in [(0, 3), (1, 2)]:
+        s[:, i, j] = s[:, j, i] = cross
+    return s
+
+
+def terminator(wavelengths, params):
+    return np.zeros((len(wavelengths), 1, 1), complex)
+
+
+def component_model(component):
+    """
+    Returns:
+        function: (wavelengths [m], params) -> S-matrices, shape (M, ports, ports).
+    """
+    model = component['model']
+    if model in CONST_Waveguides or 'wg_length' in component['params']:
+        values = CONST_Waveguides.get(model, CONST_Waveguides['wg_strip_integral_te1310'])
+        return lambda w, p: waveguide(w, p, *values)
+    if model.startswith('GC_'):
+        return lambda w, p: grating_coupler(w, p, **CONST_GratingCoupler)
+    if model in CONST_Splitters:
+        return lambda w, p: coupler(w, p, *CONST_Splitters[model])
+    if model.startswith('ybranch') or model.startswith('ebeam_y_'):
+        return y_branch
+    if model.startswith('terminator') or model.startswith('ebeam_terminator'):
+        return terminator
+    raise KeyError(f"No compact model for {model} ({component['name']})")
+
+
+def simulate(circuit, wavelengths):
+    """
+    Solves a circuit for the wave entering at the laser port of the analyzer.
+
+    Args:
+        circuit (dict): From parse_netlist.
+        wavelengths (numpy.ndarray): [m], shape (M,).
+
+    Returns:
+        dict: detector net -> transmission [dB], shape (M,).
+    """
+    # global port numbers, and the ports of each net
+    blocks, nets, n = [], {}, 0
+    for component in circuit['components']:
+        ports = np.arange(n, n + len(component['nets']))
+        blocks.append((component_model(component), component['params'], ports))
+        for net, port in zip(component['nets'], ports):
+            nets.setdefault(net, []).append(port)
+        n += len(ports)
+    partner = {}
+    for net, ports in nets.items():
+        if len(ports) == 2:
+            partner[ports[0]], partner[ports[1]] = ports[1], ports[0]
+        elif len(ports) > 2:
+            raise ValueError(f"Net {net} connects {len(ports)} ports")
+    analyzer = circuit['analyzer']
+    laser = nets[analyzer['output']][0]
+    detectors = [d for d in analyzer['inputs'] if d in nets]
+    internal = np.array(sorted(partner), dtype=int)
+    # a_internal = b_internal[perm]: the wave entering a port leaves its partner
+    position = {port: i for i, port in enumerate(internal)}
+    perm = np.array([position[partner[p]] for p in internal], dtype=int)
+    outputs = np.array([nets[d][0] for d in detectors], dtype=int)
+
+    transmission = np.zeros((len(detectors), len(wavelengths)))
+    chunk = max(1, int(CONST_ChunkBytes // (16 * n * n)))
+    for start in range(0, len(wavelengths), chunk):
+        w = wavelengths[start:start + chunk]
+        s = np.zeros((len(w), n, n), complex)
+        for model, params, ports in blocks:
+            s[:, ports[:, None], ports] = model(w, params)
+        # (I - S_ii P) b_i = S_i,laser, then b_detector = S_d,laser + S_d,i P b_i
+        s_ii = s[:, internal[:, None], internal][:, :, perm]
+        m = np.eye(len(internal)) - s_ii
+        b = np.linalg.solve(m, s[:, internal, laser][..., None])[..., 0]
+        out = s[:, outputs, laser] + np.einsum('wdi,wi->wd', s[:, outputs[:, None], internal], b[:, perm])
+        transmission[:, start:start + len(w)] = (np.abs(out) ** 2).T
+    with np.errstate(divide='ignore'):
+        return {d: 10 * np.log10(t) for d, t in zip(detectors, transmission)}
+
+
+def analyzer_wavelengths(circuit, points=CONST_Points):
+    """
+    Returns:
+        numpy.ndarray: The sweep of the analyzer of the netlist [m].
+    """
+    analyzer = circuit['analyzer']
+    return np.linspace(analyzer.get('start', 1260e-9), analyzer.get('stop', 1360e-9), points)
+
+
+def _simulate(args):
+    label, text, wavelengths = args
+    try:
+        circuit = parse_netlist(text)
+        if wavelengths is None:
+            wavelengths = analyzer_wavelengths(circuit)
+        return label, wavelengths, simulate(circuit, wavelengths), None
+    except Exception as e:
+        return label, None, {}, f"{type(e).__name__}: {e}"
+
+
+def simulate_netlists(netlists, wavelengths=None, workers=None):
+    """
+    Simulates many circuits in a process pool.
+
+    Args:
+        netlists (dict): label -> netlist text.
+        wavelengths (numpy.ndarray): [m], or None for the sweep of each analyzer.
+        workers (int): Number of processes, None for the number of CPUs.
+
+    Returns:
+        dict: label -> (wavelengths [m], {detector net: transmission [dB]}, error or None)
+    """
+    tasks = [(label, text, wavelengths) for label, text in netlists.items()]
+    if workers == 1 or len(tasks) < 2:
+        results = [_simulate(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_simulate, tasks))
+    return {label: (w, spectra, error) for label, w, spectra, error in results}
+
+
+def channel(detector):
+    """
+    Returns:
+        int: The measurement channel of a detector port, e.g. 1 for ..._detector1.
+    """
+    match = re.search(r'detector(\d+)$', detector)
+    return int(match.group(1)) if match else None
+
+
+def read_netlists(directory):
+    """
+    Returns:
+        dict: label (file name without extension) -> netlist text, for the .spi and .cir files.
+    """
+    netlists = {}
+    for file in sorted(os.listdir(directory)):
+        if file.endswith(('.spi', '.cir')):
+            with open(os.path.join(directory, file)) as f:
+                netlists[os.path.splitext(file)[0]] = f.read()
+    return netlists
+
+
+def export_netlists(database, labels, save_dir=None):
+    """
+    Exports the netlist of each opt_in label from the merged layout.
+
+    Returns:
+        dict: label -> netlist text.
+    """
+    from layout_access import export_netlist
+    netlists = {}
+    for label in labels:
+        try:
+            netlists[label] = export_netlist(database.cell(label), label)
+        except Exception as e:
+            print(f"{label}: no netlist, {e}")
+            continue
+        if save_dir:
+            os.makedirs(save_dir, exist_ok=True)
+            with open(os.path.join(save_dir, label + '.spi'), 'w') as f:
+                f.write(netlists[label])
+    return netlists
+
+
+def save_results(results, path):
+    """
+    Saves the spectra as <label>/wavelength [nm] and <label>/channel_<n> [dB] arrays (.npz).
+    """
+    arrays = {}
+    for label, (wavelengths, spectra, error) in results.items():
+        if error:
+            continue
+        arrays[f'{label}/wavelength'] = wavelengths * 1e9
+        for detector, t in spectra.items():
+            arrays[f'{label}/channel_{channel(detector) or detector}'] = t
+    np.savez_compressed(path, **arrays)
+
+
+def plot_overlay(label, result, database):
+    """
+    Plots the simulated spectra of a label over its latest measurement.
+    """
+    import matplotlib.pyplot as plt
+    from analyze_measurements import load_mat_spectrum
+    from measurement_db import sweep_timestamp
+    wavelengths, spectra, error = result
+    fig, ax = plt.subplots()
+    for detector, t in spectra.items():
+        ax.plot(wavelengths * 1e9, t, '--', label=f'simulated, channel {channel(detector)}')
+    files = []
+    for values in database.matches.values():
+        if values and values[1].get('opt_in') == label:
+            files += values[0::2]
+    if files:
+        measured, channels = load_mat_spectrum(max(files, key=sweep_timestamp))
+        for c, t in channels.items():
+            ax.plot(measured, t, label=f'measured, channel {c}')
+    ax.set_xlabel('Wavelength [nm]')
+    ax.set_ylabel('Transmission [dB]')
+    ax.set_title(label)
+    ax.legend()
+    plt.show()
+
+
+def main(argv=None):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--netlists', default=None,
+                        help='directory of netlists (.spi), instead of exporting them from the layout')
+    parser.add_argument('--save-netlists', default=None,
+                        help='directory where the netlists exported from the layout are saved')
+    parser.add_argument('--layout', default=None, help='merged layout (default: ../aggregate/Shuksan.oas)')
+    parser.add_argument('--filter', default=None, help='only simulate labels matching this regular expression')
+    parser.add_argument('--sweep', default=None,
+                        help='.mat measurement whose wavelengths are simulated (default: the sweep of each netlist)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('--output', default=os.path.join(script_dir, 'simulated.npz'),
+                        help='simulated spectra (.npz)')
+    parser.add_argument('--plot', default=None, help='opt_in label to plot over its measurement')
+    args = parser.parse_args(argv)
+
+    database = None
+    if args.netlists:
+        netlists = read_netlists(args.netlists)
+    else:
+        from layout_access import LayoutDatabase
+        database = LayoutDatabase(args.layout)
+        labels = [l['opt_in'] for l in database.labels[1] if 'opt_in' in l]
+        netlists = export_netlists(database, labels, args.save_netlists)
+    if args.filter:
+        netlists = {k: v for k, v in netlists.items() if re.search(args.filter, k)}
+    wavelengths = None
+    if args.sweep:
+        from analyze_measurements import load_mat_spectrum
+        wavelengths = load_mat_spectrum(args.sweep)[0] * 1e-9
+
+    results = simulate_netlists(netlists, wavelengths, args.workers)
+    save_results(results, args.output)
+    errors = {label: r[2] for label, r in results.items() if r[2]}
+    print(f"{len(results) - len(errors)} of {len(results)} circuits simulated, saved to {args.output}")
+    for label, error in errors.items():
+        print(f" {label}: {error}")
+
+    if args.plot:
+        if args.plot not in results or args.plot in errors:
+            print(f"{args.plot} was not simulated")
+            return 1
+        if database is None:
+            from layout_access import LayoutDatabase
+            database = LayoutDatabase(args.layout)
+        plot_overlay(args.plot, results[args.plot], database)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,194 +1,142 @@
 
 import os
-import re
-import requests
-import zipfile
 import shutil
-import pathlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import klayout.db as pya
-import siepicfab_ebeam_zep
 import SiEPIC
-from SiEPIC.utils import find_automated_measurement_labels
-import matplotlib.pyplot as plt
-import scipy.io
-import sys
-from SiEPIC.scripts import connect_pins_with_waveguide, connect_cell, zoom_out, export_layout
+from SiEPIC.scripts import export_layout, trim_netlist
 from SiEPIC.extend import get_LumericalINTERCONNECT_analyzers_from_opt_in
-from SiEPIC.scripts import trim_netlist, trace_hierarchy_up_single
+from layout_access import (LayoutDatabase, HierarchyIndex, load_layout, load_layout_and_extract_labels,
+                           find_text_label, find_text_label_cells, match_files_with_labels)
 
-def load_layout_and_extract_labels():
-    """
-    Loads the layout file located at ../aggregate/Shuksan.oas and extracts opt_in labels using SiEPIC.
-    
-    Returns:
-        list: Extracted opt_in labels from the layout.
-    """
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    layout_path = os.path.abspath(os.path.join(script_dir, '..', 'aggregate', 'Shuksan.oas'))
-    
-    if not os.path.exists(layout_path):
-        raise FileNotFoundError(f"Layout file not found at expected location: {layout_path}")
-    
-    # Load all the layouts, without the libraries (no PCells)
-    disable_libraries()
+CONST_MinParallelCircuits = 200  # below this, loading the layout in each worker costs more than it saves
 
-    layout = pya.Layout()
-    layout.read(layout_path)
-    layout.technology_name = "SiEPICfab_EBeam_ZEP"
-    
-    top_cell = layout.top_cell()
-    if not top_cell:
-        raise RuntimeError("No top cell found in the layout.")
-    
-    labels = find_automated_measurement_labels(top_cell)
-    print(f"Extracted number of labels: {len(labels[1])}")
-    return layout, labels
-
-
-def find_parent_cell_and_instance(layout, target_inst_array, verbose=False):
+def find_parent_cell_and_instance(layout, target_inst_array, verbose=False, index=None):
     """
     Given a pya.CellInstArray, find its parent cell and corresponding pya.Instance.
 
     :param layout: The pya.Layout object.
     :param target_inst_array: The pya.CellInstArray to find.
+    :param index: optional HierarchyIndex, to avoid re-scanning the layout.
     :return: (parent_cell, instance) if found, else (None, None).
     """
-    for cell in layout.each_cell():
-        for inst in cell.each_inst():
-            if inst.cell_inst.cell_index == target_inst_array.cell_index:
-                if verbose:
-                    print (f" **** compare found: {inst.cell.name}: {inst.cell_inst} {layout.cell(target_inst_array.cell_index).name}:{target_inst_array}")
-                return cell, inst  # Found the instance and its parent cell
+    if not index:
+        index = HierarchyIndex(layout)
+    cell, inst = index.find_parent_cell_and_instance(target_inst_array.cell_index)
+    if verbose and inst:
+        print (f" **** compare found: {inst.cell.name}: {inst.cell_inst} {layout.cell(target_inst_array.cell_index).name}:{target_inst_array}")
+    return cell, inst
 
-    return None, None  # Not found
-
-def get_absolute_transformation(layout, inst, verbose=False):
+def get_absolute_transformation(layout, inst, verbose=False, index=None):
     """
     Compute the absolute transformation of a cell instance relative to the top cell.
     
-    :param inst: The pya.CellInstArray instance of the cell.
+    :param inst: The pya.Instance of the cell.
+    :param index: optional HierarchyIndex; reuse it across calls to share the cache.
     :return: pya.ICplxTrans representing the absolute transformation.
     """
-    # print(inst, type(inst))
-    # cell, inst = find_parent_cell_and_instance(layout, inst)
-    # print(inst, type(inst))
-    transformation = pya.Trans()
-
-    current_inst = inst
-    while True:
-        transformation *= current_inst.trans
-        if verbose:
-            print (f" current instance: {current_inst.cell.name}")
-            print (f" parent instance: {current_inst.parent_cell.name}")
-            print (f" cumulative transformation: {transformation}")
-        each_parent_inst = current_inst.cell.each_parent_inst()
-        parent_inst = next(each_parent_inst).inst()
-        #if verbose:
-        #    print (f" parent CellInstArray: {parent_inst} {type(parent_inst)}")
-        cell, parent_inst = find_parent_cell_and_instance(layout, parent_inst)
-        if not parent_inst:
-            # No more parent instances found, we reached the top cell
-            if verbose:
-                print('break')
-            break
-        if verbose:
-            print (f" parent Instance: {parent_inst.cell.name} {type(parent_inst)}")
-        
-        current_inst = parent_inst
-        
-    return transformation
+    if not index:
+        index = HierarchyIndex(layout)
+    return index.absolute_transformation(inst.cell_index, verbose=verbose)
 
 
-def get_single_instance(layout, target_cell):
+def get_single_instance(layout, target_cell, index=None):
     """
-    Finds and returns the single instance (pya.CellInstArray) of the given target cell.
+    Finds and returns the single instance of the given target cell.
     
     :param layout: The pya.Layout object.
     :param target_cell: The pya.Cell object to find the instance of.
-    :return: The pya.CellInstArray instance containing the target cell, or None if not found or multiple instances exist.
+    :param index: optional HierarchyIndex, to avoid re-scanning the layout.
+    :return: The pya.Instance containing the target cell, or None if not found or multiple instances exist.
     """
-    instances = []
+    if not index:
+        index = HierarchyIndex(layout)
+    return index.single_instance(target_cell)
 
-    # Iterate through all cells to find where the target_cell is instantiated
-    for cell in layout.each_cell():
-        for inst in cell.each_inst():
-            if inst.cell == target_cell:
-                instances.append(inst)
-
-    # Ensure the target cell is only instantiated once
-    if len(instances) == 1:
-        return instances[0]
-    elif len(instances) > 1:
-        raise ValueError(f"Cell '{target_cell.name}' is instantiated multiple times. Expected only one instance.")
-    else:
-        return None  # Not found
-
-def find_text_label(layout, layer_name, target_text):
-    """
-    Scans a layout file to find a specific text label on a given layer and returns the cell containing that text.
-    
-    Args:
-        layout (pya.Layout): The layout object.
-        layer_name (str): The layer name where the text is expected.
-        target_text (str): The text label to find.
-    
-    Returns:
-        pya.Cell: The cell containing the text, or None if not found.
-    """
-    layer_index = layout.layer(layer_name)
-    if layer_index is None:
-        raise Exception('Layer not found')
-    
-    iter = layout.top_cell().begin_shapes_rec(layer_index)
-    while not iter.at_end():
-        if iter.shape().is_text():
-            text = iter.shape().text.string
-            if text == target_text:
-                # Ensure we return a non-Const cell, see issue: https://github.com/KLayout/klayout/issues/235
-                return layout.cell(iter.cell().name) 
-        iter.next()
-    return None
-
-def disable_libraries():
-    print('Disabling KLayout libraries')
-    for l in pya.Library().library_ids():
-        print(' - %s' % pya.Library().library_by_id(l).name())
-        pya.Library().library_by_id(l).delete()
-    
-def match_files_with_labels(mat_files_dir, labels):
-    """
-    Matches .mat files in the mat_files directory with the extracted opt_in labels.
+def trim_circuit_using_opt_in(cell, nets, components, opt_in_text):
+    '''
+    Trim the netlist of a cell to the circuit connected to an opt_in label
     
-    Args:
-        mat_files_dir (str): The directory containing .mat files.
-        labels (list): Extracted opt_in labels from the layout.
+    cell: pya.Cell containing the opt_in label
+    nets, components: from cell.identify_nets()
+    opt_in_text: <str>
     
     Returns:
-        dict: A mapping of labels to matching .mat files.
-    """
-    matches = {}
-    for root, _, files in os.walk(mat_files_dir):
-        for label in labels[1]:
-            device_id = label.get('deviceID', '')
-            params = "_".join(label.get('params', []))
-            expected_folder_start = f"{device_id}_{params}".strip('_')
-
-            if os.path.basename(root).startswith(expected_folder_start):
-                for file in files:
-                    if file.endswith(".mat"):
-                        matches.setdefault(expected_folder_start, []).append(os.path.join(root, file))
-                        matches[expected_folder_start].append(label)
+    the trimmed nets and components
+    '''
+    # using opt_in, identify where the laser and detectors are connected
+    # this updates the Optical IO Net
+    laser_net, detector_nets, *_ = get_LumericalINTERCONNECT_analyzers_from_opt_in(
+        cell, components, opt_in_selection_text=[opt_in_text])
+    if not laser_net or not detector_nets:
+        raise Exception('opt_in label did not yield laser/detectors.')
+
+    # trim the netlist, based on where the laser is connected
+    laser_component = laser_net.pins[0].component
+    return trim_netlist(nets, components, laser_component)
+
+
+def copy_circuit(layout, components, transformation, topcell2, cell_map=None):
+    '''
+    Copy the component cells of a circuit into topcell2, at their absolute position
     
-    print(f"Matched files: {len(matches)}")
-    return matches
+    cell_map: optionally, a dict of source cell index -> copied cell, shared by 
+      all the circuits copied into the same layout so that each cell is only copied once
+    '''
+    if cell_map is None:
+        cell_map = {}
+    layout2 = topcell2.layout()
+    for c in components:
+        cell_index = c.cell.cell_index()
+        if cell_index not in cell_map:
+            cell1 = layout2.create_cell(c.cell.name)
+            cell1.copy_tree(layout.cell(cell_index))
+            cell_map[cell_index] = cell1
+        topcell2.insert(pya.CellInstArray(cell_map[cell_index].cell_index(), pya.ICplxTrans(transformation) * c.trans))
 
-def extract_layout_using_opt_in(layout, opt_in_text, layout2=None):
+
+def copy_cell_shapes(cell, transformation, topcell2):
+    '''
+    Copy the shapes (not the instances) of a cell into topcell2, at their absolute position
+    '''
+    layout3 = pya.Layout()
+    topcell3 = layout3.create_cell('top')
+    topcell3.copy_shapes(cell)
+    topcell3.transform(transformation)
+    topcell2.copy_shapes(topcell3)
+
+
+def copy_cell_tree(cell3, topcell2, cell_map):
+    '''
+    Copy the shapes and the instances of cell3 into topcell2, from another layout
+
+    cell_map: a dict of cell name -> copied cell, shared by all the cells copied
+      into the same layout so that each child cell is only copied once, like copy_circuit()
+    '''
+    layout3, layout2 = cell3.layout(), topcell2.layout()
+    targets = {cell3.cell_index(): topcell2}
+    for cell_index in cell3.called_cells():
+        name = layout3.cell(cell_index).name
+        if name not in cell_map:
+            cell_map[name] = targets[cell_index] = layout2.create_cell(name)
+    for cell_index, target in targets.items():
+        cell = layout3.cell(cell_index)
+        target.copy_shapes(cell)
+        for inst in cell.each_inst():
+            cell_inst_array = inst.cell_inst
+            cell_inst_array.cell_index = cell_map[inst.cell.name].cell_index()
+            target.insert(cell_inst_array)
+
+
+def extract_layout_using_opt_in(layout, opt_in_text, layout2=None, index=None):
     '''
     Extract the layout for a circuit connected to an opt_in label
     
     Layout: to scan for the opt_in label
     opt_in_text: <str>
     layout2: optionally, add to an existing layout
+    index: optionally, a HierarchyIndex of layout, shared between calls
     
     Returns:
     pya.Cell: the new cell
@@ -207,8 +155,10 @@ def extract_layout_using_opt_in(layout, opt_in_text, layout2=None):
     cell = find_text_label(layout, [10,0], opt_in_text)
     print(f" cell containing opt_in: {cell.name}")
     # Find the transformation for the opt_in label within the cell, versus top cell
-    inst = get_single_instance(layout, cell)
-    transformation = get_absolute_transformation(layout, inst)
+    if not index:
+        index = HierarchyIndex(layout)
+    inst = get_single_instance(layout, cell, index=index)
+    transformation = get_absolute_transformation(layout, inst, index=index)
     # print(f" transformation 2:  {transformation}")
 
     # get the netlist from the entire layout
@@ -217,42 +167,210 @@ def extract_layout_using_opt_in(layout, opt_in_text, layout2=None):
     except:
         return topcell2, layout2
     
-    # using opt_in, identify where the laser and detectors are connected
-    # this updates the Optical IO Net
-    laser_net, detector_nets, *_ = get_LumericalINTERCONNECT_analyzers_from_opt_in(
-        cell, components, opt_in_selection_text=[opt_in_text])
-    if not laser_net or not detector_nets:
-        raise Exception('opt_in label did not yield laser/detectors.')
-
-    # trim the netlist, based on where the laser is connected
-    laser_component = [c for c in components if any(
-        [p for p in c.pins if p.type == SiEPIC._globals.PIN_TYPES.OPTICALIO and 'laser' in p.pin_name])]
-    nets, components = trim_netlist(nets, components, laser_component[0])
+    nets, components = trim_circuit_using_opt_in(cell, nets, components, opt_in_text)
         
     # recreate the layout, copying cells and shapes
-    for c in components:
-        cell1 = layout2.create_cell(c.cell.name)
-        cells1 = cell1.copy_tree(layout.cell(c.cell.name)) 
-        # print(f" trans: {c.trans} {transformation}")
-        #print(f" trans type: {type(c.trans)} {type(transformation)}")
-        topcell2.insert(pya.CellInstArray(cell1.cell_index(), pya.ICplxTrans(transformation) * c.trans))   
-    layout3 = pya.Layout()
-    topcell3 = layout3.create_cell('top')
-    topcell3.copy_shapes(cell)
-    topcell3.transform(transformation)
-    topcell2.copy_shapes(topcell3)
+    copy_circuit(layout, components, transformation, topcell2)
+    copy_cell_shapes(cell, transformation, topcell2)
 
     return topcell2, layout2
 
+
+def extract_circuits_in_cell(layout, cell, opt_in_texts, index, layout2=None, per_device=False, cell_map=None):
+    '''
+    Extract the layouts for all the circuits connected to opt_in labels in one design cell.
+    The nets are identified once for the cell and shared by all of its opt_in labels.
+    
+    cell: pya.Cell containing the opt_in labels
+    opt_in_texts: list of <str>
+    index: HierarchyIndex of layout
+    layout2: optionally, add to an existing layout (ignored when per_device)
+    per_device: create a new layout for each opt_in label
+    cell_map: optionally, the dict of copied cells of layout2, shared by the
+      design cells added to it, so that their common subcells are copied once
+    
+    Returns:
+    dict: opt_in_text -> (pya.Cell, pya.Layout) for each extracted circuit
+    dict: opt_in_text -> error message, for the labels that could not be extracted
+    '''
+    circuits, errors = {}, {}
+    transformation = index.absolute_transformation(cell.cell_index())
+    
+    # get the netlist once, for all the circuits in the cell
+    try:
+        nets, components = cell.identify_nets()
+    except Exception as e:
+        return circuits, {t: f'identify_nets failed: {e}' for t in opt_in_texts}
+    
+    # finding the laser and detectors renames the Optical IO pins, so keep the
+    # original names and nets to start each opt_in label from a clean netlist
+    optical_io = [(p, p.pin_name, p.net) for c in components for p in c.pins 
+                  if p.type == SiEPIC._globals.PIN_TYPES.OPTICALIO]
+
+    topcell2 = None
+    if cell_map is None:
+        cell_map = {}
+    for opt_in_text in opt_in_texts:
+        for p, pin_name, net in optical_io:
+            p.pin_name, p.net = pin_name, net
+        try:
+            nets2, components2 = trim_circuit_using_opt_in(cell, nets, components, opt_in_text)
+        except Exception as e:
+            errors[opt_in_text] = str(e)
+            continue
+        
+        if per_device or not topcell2:
+            if per_device or not layout2:
+                layout2 = pya.Layout()
+            topcell2 = layout2.cell('top') or layout2.create_cell('top')
+            if per_device:
+                cell_map = {}
+            copy_cell_shapes(cell, transformation, topcell2)
+        copy_circuit(layout, components2, transformation, topcell2, cell_map)
+        circuits[opt_in_text] = (topcell2, layout2)
+
+    for p, pin_name, net in optical_io:
+        p.pin_name, p.net = pin_name, net
+    return circuits, errors
+
+
+def write_circuits(circuits, output_dir, filename=None):
+    '''
+    Write extracted circuits to OASIS files in output_dir
+    
+    circuits: from extract_circuits_in_cell
+    filename: for circuits sharing one layout; otherwise, 
+      each file is named after its opt_in label
+    
+    Returns:
+    dict: opt_in_text -> output file
+    '''
+    files = {}
+    for opt_in_text, (topcell2, layout2) in circuits.items():
+        file_out = os.path.join(output_dir, (filename or opt_in_text) + '.oas')
+        if file_out not in files.values():
+            layout2.write(file_out)
+        files[opt_in_text] = file_out
+    return files
+
+
+# Per-process state for the parallel extraction workers
+_extraction_worker = {}
+
+def _init_extraction_worker(layout_path):
+    layout = load_layout(layout_path)
+    _extraction_worker['layout'] = layout
+    _extraction_worker['index'] = HierarchyIndex(layout)
+
+def _extract_cell_worker(cell_name, opt_in_texts, output_dir, per_device):
+    layout = _extraction_worker['layout']
+    circuits, errors = extract_circuits_in_cell(
+        layout, layout.cell(cell_name), opt_in_texts, _extraction_worker['index'], per_device=per_device)
+    return write_circuits(circuits, output_dir, None if per_device else cell_name), errors
+
+
+def extract_layouts_using_opt_in(layout, opt_in_texts, output_dir, filename='development', 
+                                 per_device=False, workers=None, layout_path=None, index=None):
+    '''
+    Extract the layouts for the circuits connected to many opt_in labels, in one pass
+    
+    The labels are grouped by the design cell containing them, so that the nets 
+    are identified once per cell. With workers > 1 and a layout_path, the design
+    cells are processed in parallel, each worker loading its own copy of the layout.
+    
+    Layout: to scan for the opt_in labels
+    opt_in_texts: list of <str>
+    output_dir: where the layouts are written
+    filename: name of the combined layout (ignored when per_device)
+    per_device: write one layout per opt_in label, named after the label
+    workers: number of processes; by default the number of CPUs, or 1 for fewer
+      than CONST_MinParallelCircuits circuits
+    layout_path: the file that layout was loaded from, required for workers > 1
+    index: optionally, a HierarchyIndex of layout
+    
+    Returns:
+    dict: opt_in_text -> output file
+    dict: opt_in_text -> error message, for the labels that could not be extracted
+    '''
+    cells = find_text_label_cells(layout, [10,0], opt_in_texts)
+    errors = {t: 'opt_in label not found in layout' for t in opt_in_texts if t not in cells}
+    labels_by_cell = {}
+    for opt_in_text, cell in cells.items():
+        labels_by_cell.setdefault(cell.name, []).append(opt_in_text)
+    print(f"Extracting {len(cells)} circuits from {len(labels_by_cell)} design cells")
+
+    if workers is None:
+        workers = (os.cpu_count() or 1) if len(cells) >= CONST_MinParallelCircuits else 1
+    workers = min(workers, len(labels_by_cell))
+    files = {}
+    
+    if workers > 1 and layout_path:
+        # each worker writes its circuits to a file: one per device, or one per design cell
+        shard_dir = output_dir if per_device else tempfile.mkdtemp(dir=output_dir)
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_extraction_worker, 
+                                     initargs=(layout_path,)) as executor:
+                futures = [executor.submit(_extract_cell_worker, cell_name, texts, shard_dir, per_device)
+                           for cell_name, texts in labels_by_cell.items()]
+                for future in as_completed(futures):
+                    files2, errors2 = future.result()
+                    files.update(files2)
+                    errors.update(errors2)
+            if not per_device:
+                # combine the design cell files into one layout
+                layout2 = pya.Layout()
+                topcell2 = layout2.create_cell('top')
+                cell_map = {}  # the component cells copied into layout2, for all the design cells
+                for file_in in sorted(set(files.values())):
+                    layout3 = pya.Layout()
+                    layout3.read(file_in)
+                    copy_cell_tree(layout3.top_cell(), topcell2, cell_map)
+                file_out = export_layout(topcell2, output_dir, filename, relative_path = '.', format='oas')
+                files = {t: file_out for t in files}
+        finally:
+            if not per_device:
+                shutil.rmtree(shard_dir, ignore_errors=True)
+    else:
+        if not index:
+            index = HierarchyIndex(layout)
+        layout2 = None if per_device else pya.Layout()
+        cell_map = {}  # the component cells copied into layout2, for all the design cells
+        for cell_name, texts in labels_by_cell.items():
+            circuits, errors2 = extract_circuits_in_cell(
+                layout, layout.cell(cell_name), texts, index, layout2=layout2, per_device=per_device,
+                cell_map=cell_map)
+            errors.update(errors2)
+            if per_device:
+                files.update(write_circuits(circuits, output_dir))
+            else:
+                files.update({t: None for t in circuits})
+        if not per_device and files:
+            file_out = export_layout(layout2.cell('top'), output_dir, filename, relative_path = '.', format='oas')
+            files = {t: file_out for t in files}
+
+    print(f"Extracted circuits: {len(files)}, failed: {len(errors)}")
+    return files, errors
+
     
 if __name__ == "__main__":
     script_dir = os.path.dirname(os.path.abspath(__file__))
 
     if 1:
+        # Copy the layouts for all the circuits with measurement data, in one pass
+        database = LayoutDatabase(mat_files_dir=os.path.join(script_dir,'mat_files'))
+        matches = database.matches
+        opt_in_texts = [matches[m][1]['opt_in'] for m in matches]
+        files, errors = extract_layouts_using_opt_in(
+            database.layout, opt_in_texts, script_dir, filename='development', layout_path=database.layout_path)
+        for opt_in_text, error in errors.items():
+            print(f' {opt_in_text}: {error}')
+
+    if 0:
         # Copy the layout for a circuit connected to an opt_in label
         layout, labels = load_layout_and_extract_labels()
         mat_path = os.path.join(script_dir,'mat_files')
         matches = match_files_with_labels(mat_path, labels)
+        index = HierarchyIndex(layout)
         layout2 = pya.Layout()
         for m in matches:
 #            if 'Itaiboss' in m:
@@ -264,10 +382,7 @@ if __name__ == "__main__":
                 opt_in_text = matches[m][1]['opt_in']
                 print(f' opt_in: {opt_in_text}')
                 
-                cell2, layout2 = extract_layout_using_opt_in(layout, opt_in_text, layout2=layout2)
+                cell2, layout2 = extract_layout_using_opt_in(layout, opt_in_text, layout2=layout2, index=index)
 
                 filename = 'development' # top_cell_name
                 file_out = export_layout(cell2, script_dir, filename, relative_path = '.', format='oas', screenshot=True)
-
-                    
-
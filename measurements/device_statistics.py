@@ -0,0 +1,397 @@
+'''
+Statistics of the devices that are measured many times, across all the designs.
+
+The sweeps are grouped by device family and parameter, parsed from the device
+names (deviceID and params of the opt_in labels, which are also the folder
+names), e.g. PCM_wglossStraight_0um_1 .. _4 are replicates of the 0 um straight
+waveguide. For each group the mean and spread of the transmission are computed
+at every wavelength, over the stacked spectra, and the replicates that differ
+from the others are flagged. Across the parameter values of a family, the trends
+are fitted: the propagation loss of the PCM_wgloss* length series, and the
+coupling of PCM_DCsweep versus the coupler length, e.g.:
+  python device_statistics.py --output statistics.csv
+'''
+
+import os
+import re
+import csv
+import sys
+import argparse
+import warnings
+import numpy as np
+
+import spectra
+from analyze_measurements import files_from_folders, CONST_NoiseFloor
+from measurement_db import sweep_timestamp
+
+CONST_OutlierDeviation = 3  # dB, RMS deviation from the median of the replicates that flags a sweep
+CONST_OutlierFactor = 3  # and times the typical deviation of the replicates
+CONST_ReportBand = 3  # dB, below the peak of a family, where the trends are summarized
+CONST_MinCouplingRange = 0.1  # of the coupling ratio across the lengths, to fit a cross-over length
+
+# regular expression of the device name -> family (if not in the expression), parameter
+FAMILY_PATTERNS = [
+    (r'(?P<family>PCM_DCsweep)_Length(?P<value>\d+(?:p\d+)?)um(?:_\d+)?$', None, 'length_um'),
+    (r'(?P<family>PCM_wgloss\w*?)_(?P<value>\d+(?:p\d+)?)um(?:_\d+)?$', None, 'length_um'),
+    (r'PCM_RingDoubler10g(?P<value>\d+)$', 'PCM_RingDoubler10', 'gap_nm'),
+    (r'PCM_BraggPeriod_300N(?P<value>\d+)nmPeriod', 'PCM_BraggPeriod', 'period_nm'),
+]
+
+DEVICE_COLUMNS = ['family', 'parameter', 'value', 'device', 'channel', 'file', 'replicates',
+                  'above_noise_floor', 'rms_deviation_dB', 'outlier', 'trend_outlier']
+
+
+def device_family(device):
+    """
+    Parses the family of a device from its name.
+
+    Returns:
+        str: The family, e.g. PCM_wglossSpiral for PCM_wglossSpiral_5772um_2; other devices
+            are their own family, as a trailing number is as often a different design
+            (MZI2, MZI5) as a replicate.
+        str: The parameter that varies in the family, e.g. length_um, or None.
+        float: The value of the parameter, or None.
+    """
+    for pattern, family, parameter in FAMILY_PATTERNS:
+        match = re.match(pattern, device)
+        if match:
+            value = float(match.group('value').replace('p', '.'))
+            return family or match.group('family'), parameter, value
+    return device, None, None
+
+
+def latest_files(files):
+    """
+    Returns:
+        list: The (device, .mat file path) pairs of the most recent sweep of each device.
+    """
+    latest = {}
+    for device, path in files:
+        if device not in latest or sweep_timestamp(path) > sweep_timestamp(latest[device]):
+            latest[device] = path
+    return sorted(latest.items(), key=lambda f: (f[0].casefold(), f[1]))
+
+
+def group_rows(index):
+    """
+    Args:
+        index (list): (device, path, channel) of each row of the spectra, see spectra.load_spectra.
+
+    Returns:
+        dict: (family, parameter, value, channel) -> row numbers of the replicates.
+    """
+    groups = {}
+    for row, (device, path, channel) in enumerate(index):
+        groups.setdefault(device_family(device) + (channel,), []).append(row)
+    return {key: np.array(rows) for key, rows in groups.items()}
+
+
+def replicate_statistics(stack, rows):
+    """
+    Statistics of the replicates of a device, at every wavelength.
+
+    Replicates below the noise floor are left out. With 3 replicates or more above it,
+    a replicate is an outlier when its RMS deviation from the median of the replicates is
+    larger than CONST_OutlierDeviation and CONST_OutlierFactor times the typical deviation.
+
+    Args:
+        stack (numpy.ndarray): The spectra [dB], shape (N, M).
+        rows (numpy.ndarray): The rows of the replicates.
+
+    Returns:
+        dict: mean, std and median [dB] of the replicates that are above the noise floor and
+            not outliers, shape (M,), NaN where they cannot be computed; and for each replicate,
+            shape (len(rows),): above_noise_floor, rms_deviation_dB and outlier.
+    """
+    data = stack[rows]
+    above = np.nanmax(data, axis=1) > CONST_NoiseFloor
+    median = np.nanmedian(data[above], axis=0) if above.any() else np.full(data.shape[1], np.nan)
+    # compare the replicates where the median is above the noise floor
+    band = median > CONST_NoiseFloor
+    deviation = np.full(len(rows), np.nan)
+    if band.any():
+        deviation = np.sqrt(np.nanmean((data[:, band] - median[band]) ** 2, axis=1))
+    outlier = np.zeros(len(rows), bool)
+    if above.sum() >= 3:
+        typical = np.median(deviation[above])
+        outlier = above & (deviation > CONST_OutlierDeviation) & (deviation > CONST_OutlierFactor * typical)
+    inliers = data[above & ~outlier]
+    mean = inliers.mean(axis=0) if len(inliers) else np.full(data.shape[1], np.nan)
+    std = inliers.std(axis=0, ddof=1) if len(inliers) > 1 else np.full(data.shape[1], np.nan)
+    return {'mean': mean, 'std': std, 'median': median,
+            'above_noise_floor': above, 'rms_deviation_dB': deviation, 'outlier': outlier}
+
+
+def report_band(spectra_dB, band=CONST_ReportBand):
+    """
+    Returns:
+        numpy.ndarray: bool, shape (M,): the wavelengths within band of the peak of the mean
+        of the spectra (N, M), where the trends are summarized.
+    """
+    mean = np.nanmean(spectra_dB, axis=0)
+    if np.isnan(mean).all():
+        return np.zeros(mean.shape, bool)
+    return mean >= np.nanmax(mean) - band
+
+
+def fit_line(x, y, weights):
+    """
+    Weighted least-squares lines, one per column of y, all at once.
+
+    Args:
+        x (numpy.ndarray): The abscissa, shape (N,).
+        y (numpy.ndarray): The data, shape (N, M).
+        weights (numpy.ndarray): shape (N, M), 0 to ignore a point.
+
+    Returns:
+        numpy.ndarray: The intercepts and the slopes, shape (M,), NaN where fewer than 2 distinct x.
+    """
+    y = np.where(weights > 0, y, 0)
+    s0 = weights.sum(axis=0)
+    s1 = x @ weights
+    s2 = (x ** 2) @ weights
+    sy = (weights * y).sum(axis=0)
+    sxy = x @ (weights * y)
+    determinant = s0 * s2 - s1 ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        valid = determinant > 1e-12 * np.maximum(s0 * s2, 1e-300)
+        slope = np.where(valid, (s0 * sxy - s1 * sy) / determinant, np.nan)
+        intercept = np.where(valid, (sy - slope * s1) / s0, np.nan)
+    return intercept, slope
+
+
+def waveguide_loss(lengths_um, spectra_dB):
+    """
+    Propagation loss from the transmission of a series of waveguide lengths, fitted at every
+    wavelength, ignoring the points below the noise floor. Then the length with the largest
+    median residual in the report band is removed while that residual exceeds
+    CONST_OutlierDeviation, keeping at least 3 lengths.
+
+    Args:
+        lengths_um (numpy.ndarray): The waveguide lengths [µm], shape (N,).
+        spectra_dB (numpy.ndarray): The transmission [dB], shape (N, M).
+
+    Returns:
+        dict: loss_dB_cm and insertion_loss_dB (the fit at zero length), shape (M,);
+            loss_dB_cm_band, the median in the report band; and outlier, shape (N,).
+    """
+    lengths_cm = np.asarray(lengths_um, float) * 1e-4
+    weights = (spectra_dB > CONST_NoiseFloor).astype(float)
+    band = report_band(spectra_dB)
+    outlier = np.zeros(len(lengths_cm), bool)
+    while True:
+        intercept, slope = fit_line(lengths_cm, spectra_dB, weights * ~outlier[:, None])
+        if not band.any() or (~outlier).sum() <= 3:
+            break
+        residual = np.abs(spectra_dB - (intercept + np.outer(lengths_cm, slope)))[:, band]
+        typical = np.nanmedian(np.where(weights[:, band] > 0, residual, np.nan), axis=1)
+        typical[outlier] = np.nan
+        if np.isnan(typical).all() or np.nanmax(typical) <= CONST_OutlierDeviation:
+            break
+        outlier[np.nanargmax(typical)] = True
+    return {'loss_dB_cm': -slope, 'insertion_loss_dB': -intercept,
+            'loss_dB_cm_band': float(np.nanmedian(-slope[band])) if band.any() else np.nan,
+            'outlier': outlier}
+
+
+def coupling_ratio(port1_dB, port2_dB):
+    """
+    Returns:
+        numpy.ndarray: The fraction of the power in port 1, P1 / (P1 + P2), in linear units.
+    """
+    p1, p2 = spectra._linear(port1_dB), spectra._linear(port2_dB)
+    return p1 / (p1 + p2)
+
+
+def fit_coupling_length(lengths_um, ratio):
+    """
+    Fits the coupling of directional couplers versus their length,
+    ratio = sin^2(phase + pi / 2 * length / crossover), by a grid search over
+    the cross-over length (for full coupling) and the phase of the bends.
+
+    Args:
+        lengths_um (numpy.ndarray): The coupler lengths [µm], shape (N,).
+        ratio (numpy.ndarray): The coupling ratio of each length, shape (N,), NaN to ignore.
+
+    Returns:
+        float: The cross-over length [µm]; NaN with fewer than 3 points, when the ratio varies
+            by less than CONST_MinCouplingRange, or when the best fit is on the edge of the grid,
+            as the lengths are then too short to tell the cross-over length.
+        float: The phase [rad].
+        float: The RMS error of the fit.
+    """
+    lengths_um, ratio = np.asarray(lengths_um, float), np.asarray(ratio, float)
+    valid = np.isfinite(ratio)
+    if valid.sum() < 3:
+        return np.nan, np.nan, np.nan
+    lengths_um, ratio = lengths_um[valid], ratio[valid]
+    if ratio.max() - ratio.min() < CONST_MinCouplingRange:
+        warnings.warn(f"the coupling ratio only varies from {ratio.min():.2f} to {ratio.max():.2f}, "
+                      f"too little to fit a cross-over length")
+        return np.nan, np.nan, np.nan
+    span = max(lengths_um.max() - lengths_um.min(), 1)
+    crossover = np.geomspace(span / 20, span * 20, 400)[:, None, None]
+    phase = np.linspace(0, np.pi, 180, endpoint=False)[None, :, None]
+    model = np.sin(phase + np.pi / 2 * lengths_um / crossover) ** 2
+    error = np.sqrt(np.mean((model - ratio) ** 2, axis=-1))
+    i, j = np.unravel_index(np.argmin(error), error.shape)
+    if i in (0, len(crossover) - 1):
+        warnings.warn(f"the best cross-over length, {crossover[i, 0, 0]:.1f} µm, is on the edge of the "
+                      f"search from {crossover[0, 0, 0]:.1f} to {crossover[-1, 0, 0]:.1f} µm")
+        return np.nan, float(phase[0, j, 0]), float(error[i, j])
+    return float(crossover[i, 0, 0]), float(phase[0, j, 0]), float(error[i, j])
+
+
+def family_statistics(wavelengths, stack, index):
+    """
+    Computes the statistics of every group of replicates, and the trends of the families.
+
+    Args:
+        wavelengths (numpy.ndarray): The common wavelengths [nm], shape (M,).
+        stack (numpy.ndarray): The spectra [dB], shape (N, M).
+        index (list): (device, path, channel) of each row, see spectra.load_spectra.
+
+    Returns:
+        dict: (family, parameter, value, channel) -> replicate_statistics() and rows.
+        list: One row (dict) per spectrum, with the keys of DEVICE_COLUMNS.
+        dict: family -> trend results, for the PCM_wgloss* and PCM_DCsweep families.
+    """
+    with warnings.catch_warnings():
+        # groups and wavelengths without data above the noise floor give NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return _family_statistics(wavelengths, stack, index)
+
+
+def _family_statistics(wavelengths, stack, index):
+    groups = {}
+    devices = []
+    for key, rows in group_rows(index).items():
+        statistics = replicate_statistics(stack, rows)
+        statistics['rows'] = rows
+        groups[key] = statistics
+        family, parameter, value, channel = key
+        for i, row in enumerate(rows):
+            device, path, channel = index[row]
+            devices.append({'family': family, 'parameter': parameter, 'value': value, 'device': device,
+                            'channel': channel, 'file': path, 'replicates': len(rows),
+                            'above_noise_floor': bool(statistics['above_noise_floor'][i]),
+                            'rms_deviation_dB': float(statistics['rms_deviation_dB'][i]),
+                            'outlier': bool(statistics['outlier'][i]), 'trend_outlier': False})
+
+    trends = {}
+    families = sorted({key[:2] for key in groups if key[1] == 'length_um'})
+    for family, parameter in families:
+        keys = sorted((key for key in groups if key[:2] == (family, parameter)), key=lambda k: (k[3], k[2]))
+        channels = sorted({key[3] for key in keys})
+        means = {channel: [(key[2], groups[key]['mean']) for key in keys if key[3] == channel]
+                 for channel in channels}
+        if family.startswith('PCM_wgloss'):
+            # the channel connected to the waveguides, with the most power
+            channel = max(channels, key=lambda c: np.nanmax([np.nanmax(m) for v, m in means[c]]))
+            lengths = np.array([v for v, m in means[channel]])
+            if len(np.unique(lengths)) < 2:
+                continue
+            result = waveguide_loss(lengths, np.array([m for v, m in means[channel]]))
+            result.update({'channel': channel, 'lengths_um': lengths})
+            trends[family] = result
+            bad = set(lengths[result['outlier']])
+            for d in devices:
+                if d['family'] == family and d['channel'] == channel and d['value'] in bad:
+                    d['trend_outlier'] = True
+        elif family == 'PCM_DCsweep' and len(channels) == 2:
+            one, two = (dict(means[c]) for c in channels)
+            lengths = np.array(sorted(set(one) & set(two)))
+            if not len(lengths):
+                continue
+            # the cross port has the least power of the shortest coupler, whichever channel it is on
+            if np.nanmax(one[lengths[0]]) > np.nanmax(two[lengths[0]]):
+                one, two = two, one
+                channels = channels[::-1]
+            ratio = coupling_ratio(np.array([one[v] for v in lengths]), np.array([two[v] for v in lengths]))
+            total = np.logaddexp(np.array([one[v] for v in lengths]) * np.log(10) / 10,
+                                 np.array([two[v] for v in lengths]) * np.log(10) / 10) * 10 / np.log(10)
+            band = report_band(total)
+            below = (total < CONST_NoiseFloor)[:, band] if band.any() else np.ones((len(lengths), 1), bool)
+            ratio_band = np.array([np.nanmedian(r[band]) if band.any() else np.nan for r in ratio])
+            ratio_band[below.all(axis=1)] = np.nan
+            crossover, phase, error = fit_coupling_length(lengths, ratio_band)
+            trends[family] = {'channels': channels, 'lengths_um': lengths, 'ratio': ratio,
+                              'ratio_band': ratio_band, 'crossover_um': crossover, 'phase': phase,
+                              'fit_error': error}
+    return groups, devices, trends
+
+
+def write_devices(devices, output_path):
+    with open(output_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=DEVICE_COLUMNS)
+        writer.writeheader()
+        for row in devices:
+            writer.writerow({k: ('' if row.get(k) is None else row.get(k)) for k in DEVICE_COLUMNS})
+    print(f"Device statistics written to {output_path}")
+
+
+def save_spectra(wavelengths, groups, output_path):
+    """
+    Saves the mean and std of every group to a .npz file, with one row per group,
+    in the order of the 'groups' array of (family, parameter, value, channel).
+    """
+    keys = sorted(groups, key=lambda k: (k[0], k[1] or '', k[2] or 0, k[3]))
+    np.savez_compressed(output_path, wavelengths=wavelengths,
+                        groups=np.array([[str(k) for k in key] for key in keys]),
+                        mean=np.array([groups[k]['mean'] for k in keys]),
+                        std=np.array([groups[k]['std'] for k in keys]),
+                        replicates=np.array([len(groups[k]['rows']) for k in keys]))
+    print(f"Mean and spread spectra written to {output_path}")
+
+
+def main(argv=None):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mat-files', default=os.path.join(script_dir, 'mat_files'),
+                        help='directory containing the .mat files')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes reading the files (default: number of CPUs)')
+    parser.add_argument('--output', default=os.path.join(script_dir, 'device_statistics.csv'),
+                        help='table of the sweeps, with their family and outlier flags (CSV)')
+    parser.add_argument('--spectra', default=None,
+                        help='also save the mean and spread spectra of each group (.npz)')
+    parser.add_argument('--filter', default=None,
+                        help='only include devices matching this regular expression')
+    args = parser.parse_args(argv)
+
+    files = latest_files(files_from_folders(args.mat_files))
+    if args.filter:
+        files = [f for f in files if re.search(args.filter, f[0])]
+    wavelengths, stack, index = spectra.load_spectra(files, args.workers)
+    groups, devices, trends = family_statistics(wavelengths, stack, index)
+    write_devices(devices, args.output)
+    if args.spectra:
+        save_spectra(wavelengths, groups, args.spectra)
+
+    replicated = {k: g for k, g in groups.items() if len(g['rows']) > 1}
+    print(f"{len(files)} devices, {len(stack)} spectra, {len(groups)} groups, "
+          f"{len(replicated)} with replicates, {sum(d['outlier'] for d in devices)} outliers, "
+          f"{sum(not d['above_noise_floor'] for d in devices)} below the noise floor")
+    for (family, parameter, value, channel), g in sorted(replicated.items(), key=lambda i: str(i[0])):
+        band = g['mean'] > CONST_NoiseFloor
+        spread = np.median(g['std'][band]) if band.any() else np.nan
+        print(f" {family}{'' if value is None else f' {value:g}'} channel {channel}: {len(g['rows'])} replicates, "
+              f"{int(g['above_noise_floor'].sum())} above the noise floor, "
+              f"median spread {spread:.2f} dB, {int(g['outlier'].sum())} outliers")
+    for family, trend in trends.items():
+        if 'loss_dB_cm' in trend:
+            print(f" {family} (channel {trend['channel']}): loss {trend['loss_dB_cm_band']:.2f} dB/cm, "
+                  f"{len(trend['lengths_um'])} lengths, excluded {', '.join(f'{l:g} µm' for l in trend['lengths_um'][trend['outlier']]) or 'none'}")
+        else:
+            ratios = ', '.join(f"{l:g}: {r:.2f}" for l, r in zip(trend['lengths_um'], trend['ratio_band']))
+            print(f" {family}: coupling ratio (cross port: channel {trend['channels'][0]}) vs length [µm] {ratios}")
+            if np.isnan(trend['crossover_um']):
+                print(f" {family}: cross-over length not determined")
+            else:
+                print(f" {family}: cross-over length {trend['crossover_um']:.1f} µm, "
+                      f"RMS error {trend['fit_error']:.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,15 +6,21 @@ written with the help of ChatGPT 4.o
 
 import os
 import re
+import json
+import zlib
+import struct
 import requests
+import time
 import zipfile
 import shutil
 import pathlib
-import klayout.db as pya
-import siepic_ebeam_pdk
-from SiEPIC.utils import find_automated_measurement_labels
-import matplotlib.pyplot as plt
-import scipy.io
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+CONST_ChunkSize = 1 << 20  # bytes, read from the HTTP stream at a time
+CONST_ManifestName = 'manifest.json'  # in mat_files/ (ignored by git), the members extracted by sync_mat_files()
+CONST_PartSize = 8 << 20  # bytes, each range of download_file_ranged()
+CONST_DownloadWorkers = 4  # concurrent range requests
+CONST_Retries = 3  # attempts for each range
 
 def extract_measurement_url():
     """
@@ -57,13 +63,14 @@ def extract_measurement_url():
         raise RuntimeError(f"Error reading the README.md file: {e}")
 
 
-def download_file(url, output_dir="downloaded_files"):
+def download_file(url, output_dir="downloaded_files", filename="downloaded_data.zip"):
     """
     Downloads a file from the given URL and saves it to the specified output directory.
     
     Args:
         url (str): The URL to download from.
         output_dir (str): The directory where the file will be saved.
+        filename (str): The name of the file.
     
     Returns:
         str: The path to the downloaded file, or None if an error occurs.
@@ -75,17 +82,638 @@ def download_file(url, output_dir="downloaded_files"):
         response = requests.get(url, stream=True)
         response.raise_for_status()
         
-        filename = os.path.join(output_dir, "downloaded_data.zip")
-        with open(filename, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
+        path = os.path.join(output_dir, filename)
+        with open(path, "wb") as file:
+            for chunk in response.iter_content(chunk_size=CONST_ChunkSize):
                 file.write(chunk)
-        print(f"Downloaded file saved to {filename}")
-        return filename
+        print(f"Downloaded file saved to {path}")
+        return path
     
     except requests.RequestException as e:
         print(f"Error downloading file: {e}")
         return None
 
+def _pooled_session(workers):
+    """
+    Returns:
+        requests.Session: With a connection pool large enough for workers threads.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _download_part(session, url, path, start, end):
+    """
+    Downloads bytes start to end (inclusive) of url into the same place in the file at path,
+    retrying CONST_Retries times.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    for attempt in range(CONST_Retries):
+        try:
+            with session.get(url, headers={'Range': f"bytes={start}-{end}"}, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise requests.RequestException("Server stopped supporting range requests")
+                written = 0
+                with open(path, 'r+b') as file:
+                    file.seek(start)
+                    for chunk in response.iter_content(chunk_size=CONST_ChunkSize):
+                        file.write(chunk)
+                        written += len(chunk)
+            if written != end - start + 1:
+                raise requests.RequestException(f"Range {start}-{end} is incomplete: {written} bytes")
+            return written
+        except requests.RequestException as e:
+            if attempt == CONST_Retries - 1:
+                raise
+            print(f"Retrying range {start}-{end}: {e}")
+            time.sleep(2 ** attempt)
+
+
+def download_file_ranged(url, output_dir="downloaded_files", filename="downloaded_data.zip",
+                         part_size=CONST_PartSize, workers=CONST_DownloadWorkers):
+    """
+    Downloads a file in byte ranges fetched concurrently over a pooled session, and saves it
+    to the specified output directory. The completed ranges are recorded in a checkpoint
+    file next to it, so that an interrupted download resumes with the missing ranges only.
+    When the server does not support range requests, the file is downloaded with download_file().
+
+    Args:
+        url (str): The URL to download from.
+        output_dir (str): The directory where the file will be saved.
+        filename (str): The name of the file.
+        part_size (int): Bytes in each range.
+        workers (int): Number of concurrent range requests.
+
+    Returns:
+        str: The path to the downloaded file, or None if an error occurs.
+    """
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    path = os.path.join(output_dir, filename)
+    checkpoint_path = path + '.checkpoint.json'
+    session = _pooled_session(workers)
+    try:
+        with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            ranged = response.status_code == 206
+            size = int(response.headers['Content-Range'].split('/')[-1]) if ranged else None
+            etag = response.headers.get('ETag') or response.headers.get('Last-Modified')
+    except (requests.RequestException, KeyError, ValueError) as e:
+        print(f"Error downloading file: {e}")
+        return None
+    if not ranged:
+        print("Server does not support range requests, downloading in a single stream")
+        return download_file(url, output_dir, filename)
+
+    # resume only if the checkpoint is for the same file, split in the same ranges
+    state = {'url': url, 'size': size, 'etag': etag, 'part_size': part_size, 'done': []}
+    if os.path.exists(checkpoint_path) and os.path.exists(path + '.part'):
+        with open(checkpoint_path, 'r', encoding='utf-8') as file:
+            previous = json.load(file)
+        if all(previous.get(k) == state[k] for k in ('url', 'size', 'etag', 'part_size')):
+            state = previous
+    if not state['done']:
+        with open(path + '.part', 'wb') as file:
+            file.truncate(size)
+
+    def save_checkpoint():
+        with open(checkpoint_path + '.part', 'w', encoding='utf-8') as file:
+            json.dump(state, file)
+        os.replace(checkpoint_path + '.part', checkpoint_path)
+
+    parts = [(i, i * part_size, min((i + 1) * part_size, size) - 1)
+             for i in range(-(-size // part_size)) if i not in set(state['done'])]
+    print(f"Downloading {size / 1e6:.1f} MB in {len(parts)} ranges"
+          + (f", resuming after {len(state['done'])} completed ranges" if state['done'] else ""))
+    downloaded = 0
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_download_part, session, url, path + '.part', start, end): i
+                   for i, start, end in parts}
+        try:
+            for future in as_completed(futures):
+                downloaded += future.result()
+                state['done'].append(futures[future])
+                save_checkpoint()
+        except (requests.RequestException, OSError, KeyboardInterrupt) as e:
+            for future in futures:
+                future.cancel()
+            save_checkpoint()
+            print(f"Error downloading file, run again to resume: {e!r}")
+            return None
+    elapsed = max(time.time() - start_time, 1e-9)
+    print(f"Downloaded {downloaded / 1e6:.1f} MB in {elapsed:.1f} s, {downloaded / 1e6 / elapsed:.1f} MB/s "
+          f"with {workers} concurrent ranges")
+
+    # integrity: the size, and the CRC-32 of every member if it is a ZIP archive
+    if os.path.getsize(path + '.part') != size:
+        print(f"Error: downloaded file has {os.path.getsize(path + '.part')} bytes instead of {size}")
+        return None
+    if zipfile.is_zipfile(path + '.part'):
+        with zipfile.ZipFile(path + '.part') as zip_ref:
+            bad = zip_ref.testzip()
+        if bad:
+            print(f"Error: {bad} is corrupted in the downloaded archive")
+            os.remove(checkpoint_path)
+            return None
+    os.replace(path + '.part', path)
+    os.remove(checkpoint_path)
+    print(f"Downloaded file saved to {path}")
+    return path
+
+
+class _StreamReader:
+    """
+    Reads exact numbers of bytes from an iterator of chunks, e.g. response.iter_content(),
+    with the ability to push back bytes that were read too far.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+
+    def _fill(self, n):
+        while len(self.buffer) < n:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return False
+            self.buffer += chunk
+        return True
+
+    def read(self, n):
+        if not self._fill(n):
+            raise zipfile.BadZipFile("Unexpected end of the archive")
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def read_some(self, n=CONST_ChunkSize):
+        """Returns up to n bytes, b'' at the end of the stream."""
+        self._fill(1)
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def unread(self, data):
+        self.buffer[:0] = data
+
+
+_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_LOCAL_SIGNATURE = b'PK\x03\x04'
+_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+
+
+def _local_header(reader):
+    """
+    Reads the next local file header of a ZIP stream.
+
+    Returns:
+        dict: name, flags, method, crc, compressed_size, size and zip64,
+        or None at the central directory, which follows the last member.
+    """
+    signature = reader.read(4)
+    if signature != _LOCAL_SIGNATURE:
+        if signature[:2] == b'PK':
+            return None
+        raise zipfile.BadZipFile("Bad local file header signature")
+    (_, _, flags, method, _, _, crc, compressed_size, size,
+     name_length, extra_length) = _LOCAL_HEADER.unpack(signature + reader.read(_LOCAL_HEADER.size - 4))
+    name = reader.read(name_length)
+    extra = reader.read(extra_length)
+    name = name.decode('utf-8' if flags & 0x800 else 'cp437')
+
+    # the zip64 extra field holds the sizes that do not fit in 32 bits, in this order
+    zip64 = False
+    while len(extra) >= 4:
+        tag, length = struct.unpack('<HH', extra[:4])
+        if tag == 0x0001:
+            zip64 = True
+            fields = extra[4:4 + length]
+            if size == 0xFFFFFFFF and len(fields) >= 8:
+                size, fields = struct.unpack('<Q', fields[:8])[0], fields[8:]
+            if compressed_size == 0xFFFFFFFF and len(fields) >= 8:
+                compressed_size = struct.unpack('<Q', fields[:8])[0]
+        extra = extra[4 + length:]
+    return {'name': name, 'flags': flags, 'method': method, 'crc': crc,
+            'compressed_size': compressed_size, 'size': size, 'zip64': zip64}
+
+
+def _compressed_data(reader, header):
+    """
+    Yields the compressed data of a member, up to the data descriptor if it has one.
+    Without sizes in the local header, deflated data ends with its own end marker,
+    and stored data ends at the data descriptor with the matching size.
+    """
+    if not header['flags'] & 0x08:
+        remaining = header['compressed_size']
+        while remaining:
+            data = reader.read_some(min(remaining, CONST_ChunkSize))
+            if not data:
+                raise zipfile.BadZipFile("Unexpected end of the archive")
+            remaining -= len(data)
+            yield data
+        return
+
+    if header['method'] == zipfile.ZIP_DEFLATED:
+        # the decompressor in _extract_member finds the end, and pushes back what follows
+        while True:
+            data = reader.read_some()
+            if not data:
+                raise zipfile.BadZipFile("Unexpected end of the archive")
+            yield data
+
+    descriptor_size = 24 if header['zip64'] else 16
+    size_format = '<Q' if header['zip64'] else '<I'
+    total, buffer = 0, bytearray()
+    while True:
+        data = reader.read_some()
+        if not data:
+            raise zipfile.BadZipFile("Unexpected end of the archive")
+        buffer += data
+        start = 0
+        while True:
+            i = buffer.find(_DESCRIPTOR_SIGNATURE, start)
+            if i < 0 or i + descriptor_size > len(buffer):
+                break
+            compressed_size = struct.unpack(size_format, buffer[i + 8:i + 8 + struct.calcsize(size_format)])[0]
+            if compressed_size == total + i:
+                yield bytes(buffer[:i])
+                reader.unread(buffer[i:])
+                return
+            start = i + 1
+        # keep what may still be the start of a data descriptor
+        keep = max(len(buffer) - 3, 0) if i < 0 else i
+        total += keep
+        yield bytes(buffer[:keep])
+        del buffer[:keep]
+
+
+def _data_descriptor(reader, header):
+    """
+    Reads the data descriptor that follows a member written with unknown sizes.
+
+    Returns:
+        int: The CRC-32 of the member.
+    """
+    crc = reader.read(4)
+    if crc == _DESCRIPTOR_SIGNATURE:
+        crc = reader.read(4)
+    reader.read(16 if header['zip64'] else 8)
+    return struct.unpack('<I', crc)[0]
+
+
+def safe_member_path(output_dir, name):
+    """
+    Returns:
+        str: The path where the member is extracted under output_dir, keeping its folders,
+        or None for directories, and for absolute paths or '..' that would leave output_dir.
+    """
+    parts = name.replace('\\', '/').split('/')
+    if name.endswith('/') or not parts[-1]:
+        return None
+    if name.startswith('/') or re.match(r'^[A-Za-z]:', name) or '..' in parts:
+        return None
+    path = os.path.join(output_dir, *[p for p in parts if p not in ('', '.')])
+    root = os.path.abspath(output_dir)
+    return path if os.path.abspath(path).startswith(root + os.sep) else None
+
+
+def _extract_member(reader, header, output_path):
+    """
+    Decompresses one member from the stream, into output_path if it is not None,
+    and checks its CRC-32. The file is written under a temporary name, and
+    only renamed to output_path once complete.
+
+    Returns:
+        int: The size of the member.
+        int: Its CRC-32.
+    """
+    method = header['method']
+    if header['flags'] & 0x01:
+        raise zipfile.BadZipFile(f"Encrypted member is not supported: {header['name']}")
+    if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        raise zipfile.BadZipFile(f"Compression method {method} is not supported: {header['name']}")
+    decompressor = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+
+    file = None
+    if output_path:
+        pathlib.Path(os.path.dirname(output_path)).mkdir(parents=True, exist_ok=True)
+        file = open(output_path + '.part', 'wb')
+    crc, size = 0, 0
+    try:
+        for data in _compressed_data(reader, header):
+            if decompressor:
+                data = decompressor.decompress(data)
+            crc, size = zlib.crc32(data, crc), size + len(data)
+            if file:
+                file.write(data)
+            if decompressor and decompressor.eof:
+                reader.unread(decompressor.unused_data)
+                break
+        if decompressor and not decompressor.eof:
+            raise zipfile.BadZipFile(f"Truncated member: {header['name']}")
+        expected = _data_descriptor(reader, header) if header['flags'] & 0x08 else header['crc']
+        if crc != expected:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for {header['name']}")
+    except BaseException:
+        if file:
+            file.close()
+            os.remove(output_path + '.part')
+        raise
+    if file:
+        file.close()
+        os.replace(output_path + '.part', output_path)
+    return size, crc
+
+
+def extract_zip_stream(chunks, output_dir, suffixes=('.mat',)):
+    """
+    Extracts the members of a ZIP archive while it is being read, in one pass,
+    without seeking, so that it can come straight from an HTTP response.
+    Only the members ending with one of suffixes are written, keeping their folders;
+    the others are read through and discarded.
+
+    Args:
+        chunks: Iterator of bytes, e.g. response.iter_content(chunk_size).
+        output_dir (str): The directory where the members are extracted.
+        suffixes (tuple): The file name endings to extract, case insensitive.
+
+    Returns:
+        list: (relative path, size, CRC-32) of the extracted members.
+    """
+    reader = _StreamReader(chunks)
+    extracted = []
+    while True:
+        header = _local_header(reader)
+        if header is None:
+            break
+        output_path = None
+        if header['name'].lower().endswith(tuple(s.lower() for s in suffixes)):
+            output_path = safe_member_path(output_dir, header['name'])
+            if output_path is None:
+                print(f"Skipped unsafe path: {header['name']}")
+        size, crc = _extract_member(reader, header, output_path)
+        if output_path:
+            relative_path = os.path.relpath(output_path, output_dir).replace(os.sep, '/')
+            extracted.append((relative_path, size, crc))
+            print(f"Extracted: \"{relative_path}\"")
+    return extracted
+
+
+def download_and_extract_mat_files(url, mat_files_dir="mat_files", chunk_size=CONST_ChunkSize):
+    """
+    Downloads the ZIP archive at url and extracts only its .mat files into mat_files_dir,
+    keeping their folder structure, without saving the archive.
+
+    Args:
+        url (str): The URL to download from.
+        mat_files_dir (str): The directory where the .mat files are extracted.
+        chunk_size (int): Bytes read from the HTTP stream at a time.
+
+    Returns:
+        list: (relative path, size, CRC-32) of the extracted files, or None if an error occurs.
+    """
+    try:
+        with requests.get(url, stream=True) as response:
+            response.raise_for_status()
+            extracted = extract_zip_stream(response.iter_content(chunk_size=chunk_size), mat_files_dir)
+        print(f"Extracted {len(extracted)} .mat files into {mat_files_dir}")
+        return extracted
+    except requests.RequestException as e:
+        print(f"Error downloading file: {e}")
+    except zipfile.BadZipFile as e:
+        print(f"Downloaded file is not a valid ZIP archive: {e}")
+    return None
+
+
+_END_OF_CENTRAL_DIRECTORY = struct.Struct('<4sHHHHIIH')
+_ZIP64_LOCATOR = struct.Struct('<4sIQI')
+_ZIP64_END_OF_CENTRAL_DIRECTORY = struct.Struct('<4sQHHIIQQQQ')
+_CENTRAL_HEADER = struct.Struct('<4sHHHHHHIIIHHHHHII')
+
+
+def _get_range(session, url, start, end=None):
+    """
+    Requests bytes start to end (inclusive) of url, or the last -start bytes if start < 0.
+
+    Returns:
+        requests.Response: The streamed response, or None if the server does not support ranges.
+    """
+    byte_range = f"bytes={start}" if start < 0 else f"bytes={start}-{'' if end is None else end}"
+    response = session.get(url, headers={'Range': byte_range}, stream=True)
+    response.raise_for_status()
+    if response.status_code != 206:
+        response.close()
+        return None
+    return response
+
+
+def fetch_central_directory(url, session=None):
+    """
+    Reads the central directory at the end of a remote ZIP archive with HTTP range requests,
+    without downloading the members.
+
+    Returns:
+        list: One dict per member, with name, flags, method, crc, compressed_size, size and
+        offset, the position of its local header, and end, where its data (and data descriptor)
+        ends; or None if the server does not support range requests.
+    """
+    session = session or requests.Session()
+    # the end of central directory record, with a comment of up to 64 kB
+    response = _get_range(session, url, -(_END_OF_CENTRAL_DIRECTORY.size + 0xFFFF))
+    if response is None:
+        return None
+    with response:
+        tail = response.content
+        archive_size = int(response.headers['Content-Range'].split('/')[-1])
+    tail_start = archive_size - len(tail)
+    i = tail.rfind(b'PK\x05\x06')
+    if i < 0:
+        raise zipfile.BadZipFile("End of central directory not found")
+    (_, _, _, _, count, directory_size, directory_offset,
+     _) = _END_OF_CENTRAL_DIRECTORY.unpack(tail[i:i + _END_OF_CENTRAL_DIRECTORY.size])
+    if directory_offset == 0xFFFFFFFF or count == 0xFFFF:
+        # zip64: the locator, just before, points to the zip64 end of central directory record
+        locator = tail[i - _ZIP64_LOCATOR.size:i]
+        _, _, zip64_offset, _ = _ZIP64_LOCATOR.unpack(locator)
+        if zip64_offset >= tail_start:
+            record = tail[zip64_offset - tail_start:zip64_offset - tail_start + _ZIP64_END_OF_CENTRAL_DIRECTORY.size]
+        else:
+            response = _get_range(session, url, zip64_offset, zip64_offset + _ZIP64_END_OF_CENTRAL_DIRECTORY.size - 1)
+            if response is None:
+                return None
+            with response:
+                record = response.content
+        (_, _, _, _, _, _, _, count, directory_size,
+         directory_offset) = _ZIP64_END_OF_CENTRAL_DIRECTORY.unpack(record)
+
+    if directory_offset >= tail_start:
+        directory = tail[directory_offset - tail_start:directory_offset - tail_start + directory_size]
+    else:
+        response = _get_range(session, url, directory_offset, directory_offset + directory_size - 1)
+        if response is None:
+            return None
+        with response:
+            directory = response.content
+
+    members, position = [], 0
+    for _ in range(count):
+        (signature, _, _, flags, method, _, _, crc, compressed_size, size, name_length,
+         extra_length, comment_length, _, _, _, offset) = _CENTRAL_HEADER.unpack(
+            directory[position:position + _CENTRAL_HEADER.size])
+        if signature != b'PK\x01\x02':
+            raise zipfile.BadZipFile("Bad central directory file header signature")
+        position += _CENTRAL_HEADER.size
+        name = directory[position:position + name_length].decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = directory[position + name_length:position + name_length + extra_length]
+        position += name_length + extra_length + comment_length
+        # the zip64 extra field holds the values that do not fit in 32 bits, in this order
+        while len(extra) >= 4:
+            tag, length = struct.unpack('<HH', extra[:4])
+            if tag == 0x0001:
+                fields = extra[4:4 + length]
+                values = [size, compressed_size, offset]
+                for k, value in enumerate(values):
+                    if value == 0xFFFFFFFF and len(fields) >= 8:
+                        values[k], fields = struct.unpack('<Q', fields[:8])[0], fields[8:]
+                size, compressed_size, offset = values
+            extra = extra[4 + length:]
+        members.append({'name': name, 'flags': flags, 'method': method, 'crc': crc,
+                        'compressed_size': compressed_size, 'size': size, 'offset': offset})
+
+    # each member ends where the next one, or the central directory, starts
+    offsets = sorted(m['offset'] for m in members)
+    ends = dict(zip(offsets, offsets[1:] + [directory_offset]))
+    for m in members:
+        m['end'] = ends[m['offset']]
+    return members
+
+
+def load_manifest(mat_files_dir):
+    """
+    Returns:
+        dict: relative path -> {'size': int, 'crc': int} of the files extracted by sync_mat_files().
+    """
+    path = os.path.join(mat_files_dir, CONST_ManifestName)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file).get('files', {})
+
+
+def save_manifest(mat_files_dir, files, url=None):
+    """
+    Writes the manifest under a temporary name first, so that an interrupted sync
+    keeps the previous one.
+    """
+    pathlib.Path(mat_files_dir).mkdir(parents=True, exist_ok=True)
+    path = os.path.join(mat_files_dir, CONST_ManifestName)
+    with open(path + '.part', 'w', encoding='utf-8') as file:
+        json.dump({'url': url, 'files': dict(sorted(files.items()))}, file, indent=1)
+    os.replace(path + '.part', path)
+
+
+def _file_crc(path):
+    crc = 0
+    with open(path, 'rb') as file:
+        for data in iter(lambda: file.read(CONST_ChunkSize), b''):
+            crc = zlib.crc32(data, crc)
+    return crc
+
+
+def sync_mat_files(url, mat_files_dir="mat_files", suffixes=('.mat',), session=None):
+    """
+    Updates mat_files_dir from the remote ZIP archive, downloading only the .mat members
+    that are missing or changed: their size and CRC-32 in the central directory are compared
+    with the manifest of the previous sync (or with the file itself, when it is not listed).
+    Consecutive members are fetched together with one range request.
+    When the server does not support range requests, the whole archive is streamed instead.
+
+    Args:
+        url (str): The URL of the archive.
+        mat_files_dir (str): The directory where the .mat files are extracted.
+        suffixes (tuple): The file name endings to extract, case insensitive.
+        session (requests.Session): Reused for all the requests.
+
+    Returns:
+        list: The relative paths of the files that were downloaded, or None if an error occurs.
+    """
+    session = session or requests.Session()
+    try:
+        members = fetch_central_directory(url, session)
+    except (requests.RequestException, zipfile.BadZipFile, KeyError, ValueError, struct.error) as e:
+        print(f"Error reading the central directory: {e}")
+        members = None
+    if members is None:
+        print("Server does not support range requests, downloading the whole archive")
+        extracted = download_and_extract_mat_files(url, mat_files_dir)
+        if extracted is None:
+            return None
+        manifest = load_manifest(mat_files_dir)
+        manifest.update({path: {'size': size, 'crc': crc} for path, size, crc in extracted})
+        save_manifest(mat_files_dir, manifest, url)
+        return [path for path, size, crc in extracted]
+
+    manifest = load_manifest(mat_files_dir)
+    wanted = []
+    for m in members:
+        if not m['name'].lower().endswith(tuple(s.lower() for s in suffixes)):
+            continue
+        output_path = safe_member_path(mat_files_dir, m['name'])
+        if output_path is None:
+            print(f"Skipped unsafe path: {m['name']}")
+            continue
+        m['path'] = os.path.relpath(output_path, mat_files_dir).replace(os.sep, '/')
+        entry = {'size': m['size'], 'crc': m['crc']}
+        if os.path.exists(output_path) and os.path.getsize(output_path) == m['size']:
+            if manifest.get(m['path']) == entry:
+                continue
+            if m['path'] not in manifest and _file_crc(output_path) == m['crc']:
+                manifest[m['path']] = entry
+                continue
+        wanted.append(m)
+    print(f"{len(wanted)} of {sum(1 for m in members if 'path' in m)} files to download")
+
+    # consecutive members in the archive are fetched with a single request
+    wanted.sort(key=lambda m: m['offset'])
+    groups = []
+    for m in wanted:
+        if groups and groups[-1][-1]['end'] == m['offset']:
+            groups[-1].append(m)
+        else:
+            groups.append([m])
+
+    downloaded = []
+    try:
+        for group in groups:
+            response = _get_range(session, url, group[0]['offset'], group[-1]['end'] - 1)
+            if response is None:
+                raise zipfile.BadZipFile("Server stopped supporting range requests")
+            with response:
+                reader = _StreamReader(response.iter_content(chunk_size=CONST_ChunkSize))
+                for m in group:
+                    header = _local_header(reader)
+                    if header is None or header['name'] != m['name']:
+                        raise zipfile.BadZipFile(f"Local header does not match the central directory: {m['name']}")
+                    size, crc = _extract_member(reader, header, os.path.join(mat_files_dir, m['path']))
+                    if crc != m['crc']:
+                        raise zipfile.BadZipFile(f"CRC-32 does not match the central directory: {m['name']}")
+                    manifest[m['path']] = {'size': size, 'crc': crc}
+                    downloaded.append(m['path'])
+                    print(f"Downloaded: \"{m['path']}\"")
+            save_manifest(mat_files_dir, manifest, url)
+    except (requests.RequestException, zipfile.BadZipFile) as e:
+        print(f"Error downloading file: {e}")
+        return None
+    finally:
+        save_manifest(mat_files_dir, manifest, url)
+    return downloaded
+
+
 def unzip_and_clean(filename, output_dir):
     """
     Unzips a given ZIP file and copies all .mat files to a separate directory while maintaining folder structure.
@@ -150,12 +778,32 @@ def copy_mat_files(source_dir, destination_dir):
 if __name__ == "__main__":
     script_dir = os.path.dirname(os.path.abspath(__file__))
     if 1:
+        # Download only the new or changed .mat files
+        try:
+            url = extract_measurement_url()
+            print(f"Extracted URL: {url}")
+            mat_path = os.path.join(script_dir,'mat_files')
+            sync_mat_files(url, mat_path)
+        except Exception as e:
+            print(f"Error: {e}")
+
+    if 0:
+        # Download and extract all the .mat files, streaming
+        try:
+            url = extract_measurement_url()
+            print(f"Extracted URL: {url}")
+            mat_path = os.path.join(script_dir,'mat_files')
+            download_and_extract_mat_files(url, mat_path)
+        except Exception as e:
+            print(f"Error: {e}")
+
+    if 0:
         # Download, extract, copy .mat files
         try:
             url = extract_measurement_url()
             print(f"Extracted URL: {url}")
             download_path = os.path.join(script_dir,'downloaded')
-            filename = download_file(url, output_dir=download_path)
+            filename = download_file_ranged(url, output_dir=download_path)
             mat_path = os.path.join(script_dir,'mat_files')
             unzip_and_copy_mat_files(filename, download_path, mat_path)
             shutil.rmtree(download_path)
@@ -168,7 +816,7 @@ if __name__ == "__main__":
             url = "https://stratus.ece.ubc.ca/s/kfHwqfkcxNEMgXs/download"  # Test URL
             print(f"Using test URL: {url}")
             download_path = os.path.join(script_dir,'downloaded')
-            filename = download_file(url, output_dir=download_path)
+            filename = download_file_ranged(url, output_dir=download_path)
             mat_path = os.path.join(script_dir,'mat_files')
             unzip_and_copy_mat_files(filename, download_path, mat_path)
             # unzip_and_clean(filename, "downloaded_files")
@@ -0,0 +1,443 @@
+'''
+Access to the merged layout (Shuksan.oas), its opt_in labels and the matching
+measurement files, shared by the viewer, development and analysis tools.
+
+  db = LayoutDatabase()
+  db.labels      # opt_in labels, from the snapshot if the layout has not changed
+  db.matches     # label key -> [file, label, file, label, ...]
+  db.cell(opt_in_text), db.hierarchy, db.layout  # the layout is read on first use
+'''
+
+import os
+import pickle
+import klayout.db as pya
+
+CONST_UseSnapshot = True  # save the labels next to the layout, to skip the label scan next time
+CONST_SnapshotSuffix = '.labels.pickle'
+CONST_SnapshotVersion = 1  # increase when the content of the snapshot changes
+
+
+def default_layout_path():
+    """
+    Returns:
+        str: The path of the merged layout, ../aggregate/Shuksan.oas
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.abspath(os.path.join(script_dir, '..', 'aggregate', 'Shuksan.oas'))
+
+
+def check_layout_path(layout_path):
+    """
+    Raises:
+        FileNotFoundError: If the layout does not exist; the merged layout is not in the
+            repository, it is made by aggregate.py.
+    """
+    if not os.path.exists(layout_path):
+        raise FileNotFoundError(f"Layout file not found: {layout_path}. The merged layout is not in the "
+                                f"repository: run aggregate/aggregate.py first, or give the path of a layout (--layout).")
+
+
+def default_mat_files_dir():
+    """
+    Returns:
+        str: The directory of the .mat files, mat_files next to this module
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mat_files')
+
+
+def disable_libraries():
+    print('Disabling KLayout libraries')
+    for l in pya.Library().library_ids():
+        print(' - %s' % pya.Library().library_by_id(l).name())
+        pya.Library().library_by_id(l).delete()
+
+
+def load_layout(layout_path=None):
+    """
+    Loads the layout file (by default ../aggregate/Shuksan.oas), without the libraries.
+    
+    Returns:
+        pya.Layout: The layout, with the technology set.
+    """
+    if not layout_path:
+        layout_path = default_layout_path()
+    
+    check_layout_path(layout_path)
+    
+    # SiEPIC-Tools and the PDK take a second to import, only when a layout is read
+    import siepicfab_ebeam_zep  # registers the SiEPICfab_EBeam_ZEP technology
+
+    # Load all the layouts, without the libraries (no PCells)
+    disable_libraries()
+
+    layout = pya.Layout()
+    layout.read(layout_path)
+    layout.technology_name = "SiEPICfab_EBeam_ZEP"
+    return layout
+
+
+def load_layout_and_extract_labels(layout_path=None):
+    """
+    Loads the layout file located at ../aggregate/Shuksan.oas and extracts opt_in labels using SiEPIC.
+    
+    Returns:
+        list: Extracted opt_in labels from the layout.
+    """
+    from SiEPIC.utils import find_automated_measurement_labels
+    layout = load_layout(layout_path)
+    
+    top_cell = layout.top_cell()
+    if not top_cell:
+        raise RuntimeError("No top cell found in the layout.")
+    
+    labels = find_automated_measurement_labels(top_cell)
+    print(f"Extracted number of labels: {len(labels[1])}")
+    return layout, labels
+
+
+def find_text_label(layout, layer_name, target_text):
+    """
+    Scans a layout file to find a specific text label on a given layer and returns the cell containing that text.
+    
+    Args:
+        layout (pya.Layout): The layout object.
+        layer_name (str): The layer name where the text is expected.
+        target_text (str): The text label to find.
+    
+    Returns:
+        pya.Cell: The cell containing the text, or None if not found.
+    """
+    layer_index = layout.layer(layer_name)
+    if layer_index is None:
+        raise Exception('Layer not found')
+    
+    iter = layout.top_cell().begin_shapes_rec(layer_index)
+    while not iter.at_end():
+        if iter.shape().is_text():
+            text = iter.shape().text.string
+            if text == target_text:
+                # Ensure we return a non-Const cell, see issue: https://github.com/KLayout/klayout/issues/235
+                # return layout.cell(iter.cell().name) 
+                return layout.cell(iter.cell_index())
+        iter.next()
+    return None
+
+
+def find_text_label_cells(layout, layer_name, target_texts):
+    """
+    Scans the layout once to find the cells containing any of the given text labels.
+    
+    Args:
+        layout (pya.Layout): The layout object.
+        layer_name (str): The layer name where the texts are expected.
+        target_texts (list): The text labels to find.
+    
+    Returns:
+        dict: text label -> pya.Cell containing it; labels that are not found are omitted.
+    """
+    layer_index = layout.layer(layer_name)
+    targets = set(target_texts)
+    cells = {}
+    
+    iter = layout.top_cell().begin_shapes_rec(layer_index)
+    while not iter.at_end():
+        if iter.shape().is_text():
+            text = iter.shape().text.string
+            if text in targets and text not in cells:
+                cells[text] = layout.cell(iter.cell_index())
+        iter.next()
+    return cells
+
+
+def find_course_cells(layout, layer_name=[10,0]):
+    """
+    Finds the course cell (the child of the top cell, e.g. ELEC413) of every opt_in label, in one scan.
+    
+    Returns:
+        dict: opt_in text -> course cell name.
+    """
+    courses = {}
+    top_cell = layout.top_cell()
+    iter = top_cell.begin_shapes_rec(layout.layer(layer_name))
+    while not iter.at_end():
+        if iter.shape().is_text() and iter.shape().text.string.startswith('opt_in'):
+            path = iter.path()
+            courses[iter.shape().text.string] = layout.cell(path[0].cell_inst().cell_index).name if path else top_cell.name
+        iter.next()
+    return courses
+
+
+def match_files_with_labels(mat_files_dir, labels):
+    """
+    Matches .mat files in the mat_files directory with the extracted opt_in labels.
+    
+    Args:
+        mat_files_dir (str): The directory containing .mat files.
+        labels (list): Extracted opt_in labels from the layout.
+    
+    Returns:
+        dict: A mapping of labels to matching .mat files.
+    """
+    matches = {}
+    for folder_matches in iter_folder_matches(mat_files_dir, labels):
+        for key, files_and_labels in folder_matches.items():
+            matches.setdefault(key, []).extend(files_and_labels)
+    
+    print(f"Matched files: {len(matches)}")
+    return matches
+
+
+def iter_folder_matches(mat_files_dir, labels):
+    """
+    Matches the .mat files with the opt_in labels one folder at a time, so that
+    the results can be shown while the other folders are scanned.
+    
+    Yields:
+        dict: For each folder with matches, label key -> [file, label, file, label, ...].
+    """
+    expected = []
+    for label in labels[1]:
+        device_id = label.get('deviceID', '')
+        params = "_".join(label.get('params', []))
+        expected.append((f"{device_id}_{params}".strip('_'), label))
+
+    for root, _, files in os.walk(mat_files_dir):
+        folder = os.path.basename(root)
+        mat_files = [file for file in files if file.endswith(".mat")]
+        matches = {}
+        for expected_folder_start, label in expected:
+            if mat_files and folder.startswith(expected_folder_start):
+                for file in mat_files:
+                    matches.setdefault(expected_folder_start, []).append(os.path.join(root, file))
+                    matches[expected_folder_start].append(label)
+        if matches:
+            yield matches
+
+
+def export_netlist(cell, opt_in_text):
+    """
+    Exports the SPICE netlist of the circuit connected to an opt_in label.
+    
+    Args:
+        cell (pya.Cell): The cell containing the opt_in label.
+        opt_in_text (str): The opt_in label.
+    
+    Returns:
+        str: The netlist, subcircuit followed by the main circuit.
+    """
+    import SiEPIC.extend  # adds pya.Cell.spice_netlist_export
+    text_subckt, text_main, *_ = cell.spice_netlist_export(opt_in_selection_text=[opt_in_text])
+    if not text_subckt:
+        raise Exception('Netlist export returned no circuit.')
+    return text_subckt + '\n' + text_main
+
+
+class HierarchyIndex:
+    """
+    One-time child -> parents index over a layout, with a cached resolver for
+    absolute transformations on top of it.
+
+    Building the index is a single pass over every instance in the layout;
+    afterwards each query is a dictionary lookup, so extracting many circuits
+    from the merged chip stays linear in the number of instances.
+
+    :param layout: The pya.Layout object to index.
+    """
+
+    def __init__(self, layout):
+        self.layout = layout
+        # child cell index -> list of pya.Instance placing that cell
+        self.parents = {}
+        for cell in layout.each_cell():
+            for inst in cell.each_inst():
+                self.parents.setdefault(inst.cell_index, []).append(inst)
+        # cell index -> pya.ICplxTrans of the cell relative to the top cell
+        self._absolute = {}
+
+    def parent_instances(self, cell_index):
+        """
+        :param cell_index: The index of the child cell.
+        :return: list of pya.Instance that place the cell (empty for a top cell).
+        """
+        return self.parents.get(cell_index, [])
+
+    def find_parent_cell_and_instance(self, cell_index):
+        """
+        :param cell_index: The index of the child cell.
+        :return: (parent_cell, instance) for the first placement, else (None, None).
+        """
+        instances = self.parent_instances(cell_index)
+        if not instances:
+            return None, None
+        return instances[0].parent_cell, instances[0]
+
+    def single_instance(self, target_cell):
+        """
+        :param target_cell: The pya.Cell object to find the instance of.
+        :return: The pya.Instance of the cell, or None if it is not instantiated.
+        :raises ValueError: if the cell is instantiated more than once.
+        """
+        instances = self.parent_instances(target_cell.cell_index())
+        if len(instances) > 1:
+            raise ValueError(f"Cell '{target_cell.name}' is instantiated multiple times. Expected only one instance.")
+        return instances[0] if instances else None
+
+    def absolute_transformation(self, cell_index, verbose=False):
+        """
+        Compute the transformation of a cell relative to the top cell, following
+        the first placement at each level of the hierarchy.
+        Results are cached for every cell visited on the way up.
+
+        :param cell_index: The index of the cell.
+        :return: pya.ICplxTrans representing the absolute transformation.
+        """
+        # walk up until we reach a cell that is cached, or a top cell
+        chain = []
+        current = cell_index
+        while current not in self._absolute:
+            instances = self.parent_instances(current)
+            if not instances:
+                self._absolute[current] = pya.ICplxTrans()
+                break
+            chain.append((current, instances[0]))
+            current = instances[0].parent_cell.cell_index()
+
+        # then compose the transformations on the way back down
+        transformation = self._absolute[current]
+        for current, inst in reversed(chain):
+            transformation = transformation * inst.cplx_trans
+            self._absolute[current] = transformation
+            if verbose:
+                print (f" {inst.parent_cell.name} -> {self.layout.cell(current).name}: {transformation}")
+        return self._absolute[cell_index]
+
+
+class LayoutDatabase:
+    """
+    The merged layout and its opt_in labels, loaded once and shared by the tools.
+
+    The layout is only read when it is first used. The labels, and the cell and
+    course cell of each label, are saved in a snapshot next to the layout file
+    (CONST_SnapshotSuffix), keyed by the size and modification time of the layout,
+    so that the next runs get them without reading the layout at all.
+
+    Args:
+        layout_path (str): The layout file, by default ../aggregate/Shuksan.oas.
+        mat_files_dir (str): The directory of the .mat files, by default mat_files.
+        snapshot (bool): Read and write the snapshot.
+    """
+
+    def __init__(self, layout_path=None, mat_files_dir=None, snapshot=CONST_UseSnapshot):
+        self.layout_path = os.path.abspath(layout_path or default_layout_path())
+        self.mat_files_dir = mat_files_dir or default_mat_files_dir()
+        self.snapshot = snapshot
+        self._layout = None
+        self._hierarchy = None
+        self._index = None
+        self._matches = None
+
+    @property
+    def layout(self):
+        """
+        pya.Layout: read on first use.
+        """
+        if self._layout is None:
+            self._layout = load_layout(self.layout_path)
+        return self._layout
+
+    @property
+    def hierarchy(self):
+        """
+        HierarchyIndex: of the layout, built on first use.
+        """
+        if self._hierarchy is None:
+            self._hierarchy = HierarchyIndex(self.layout)
+        return self._hierarchy
+
+    @property
+    def labels(self):
+        """
+        tuple: The opt_in labels, in the format of find_automated_measurement_labels.
+        """
+        return self._load_index()['labels']
+
+    @property
+    def label_cells(self):
+        """
+        dict: opt_in text -> name of the cell containing the label.
+        """
+        return self._load_index()['label_cells']
+
+    @property
+    def courses(self):
+        """
+        dict: opt_in text -> name of its course cell, see find_course_cells.
+        """
+        return self._load_index()['courses']
+
+    @property
+    def matches(self):
+        """
+        dict: The measurement files of each label, see match_files_with_labels.
+        """
+        if self._matches is None:
+            self._matches = match_files_with_labels(self.mat_files_dir, self.labels)
+        return self._matches
+
+    def iter_matches(self):
+        """
+        Yields:
+            dict: The matches one folder at a time, see iter_folder_matches.
+        """
+        return iter_folder_matches(self.mat_files_dir, self.labels)
+
+    def cell(self, opt_in_text):
+        """
+        Returns:
+            pya.Cell: The cell containing an opt_in label, or None if not found.
+        """
+        name = self.label_cells.get(opt_in_text)
+        return self.layout.cell(name) if name else None
+
+    def snapshot_path(self):
+        return self.layout_path + CONST_SnapshotSuffix
+
+    def _snapshot_key(self):
+        check_layout_path(self.layout_path)
+        stat = os.stat(self.layout_path)
+        return (CONST_SnapshotVersion, self.layout_path, stat.st_size, stat.st_mtime_ns)
+
+    def _load_index(self):
+        if self._index is not None:
+            return self._index
+        key = self._snapshot_key()
+        if self.snapshot and os.path.exists(self.snapshot_path()):
+            try:
+                with open(self.snapshot_path(), 'rb') as file:
+                    index = pickle.load(file)
+                if index.get('key') == key:
+                    print(f"Extracted number of labels: {len(index['labels'][1])} (snapshot)")
+                    self._index = index
+                    return index
+            except Exception as e:
+                print(f"Ignoring snapshot {self.snapshot_path()}: {e}")
+
+        from SiEPIC.utils import find_automated_measurement_labels
+        top_cell = self.layout.top_cell()
+        if not top_cell:
+            raise RuntimeError("No top cell found in the layout.")
+        labels = find_automated_measurement_labels(top_cell)
+        print(f"Extracted number of labels: {len(labels[1])}")
+        cells = find_text_label_cells(self.layout, [10,0], [label['opt_in'] for label in labels[1]])
+        self._index = {'key': key,
+                       'labels': labels,
+                       'label_cells': {text: cell.name for text, cell in cells.items()},
+                       'courses': find_course_cells(self.layout)}
+        if self.snapshot:
+            try:
+                with open(self.snapshot_path() + '.part', 'wb') as file:
+                    pickle.dump(self._index, file, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(self.snapshot_path() + '.part', self.snapshot_path())
+            except OSError as e:
+                print(f"Cannot write snapshot {self.snapshot_path()}: {e}")
+        return self._index
@@ -0,0 +1,319 @@
+'''
+Index of every sweepLaser measurement, in an SQLite database, so that the repeat
+measurements of a device, and the calibration runs, can be found and compared
+without reading the .mat files again, e.g.:
+
+  db = MeasurementDatabase()
+  db.update(files_from_folders('mat_files'))   # only new or changed files are read
+  db.latest_per_device(kind='mzi')
+  db.sweeps(kind='mzi', start='2025-02-23', end='2025-02-24')
+
+  python measurement_db.py --latest
+'''
+
+import os
+import sys
+import sqlite3
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from analyze_measurements import (load_mat_spectrum, device_type, channel_metrics, files_from_folders,
+                                  SUMMARY_COLUMNS, CONST_NoiseFloor)
+
+CONST_DatabaseName = 'measurements.sqlite'  # next to this module
+CONST_TimestampFormat = '%d-%b-%Y %H.%M.%S'  # name of the .mat files, e.g. 23-Feb-2025 01.05.26.mat
+CONST_SchemaVersion = 2  # PRAGMA user_version; databases of other versions are rebuilt from the files
+
+# the metrics of each channel, see channel_metrics
+METRIC_COLUMNS = SUMMARY_COLUMNS[SUMMARY_COLUMNS.index('above_noise_floor'):]
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS sweeps (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    device TEXT NOT NULL,
+    opt_in TEXT,
+    type TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    wavelength_min_nm REAL,
+    wavelength_max_nm REAL,
+    points INTEGER,
+    channels INTEGER,
+    channels_above_floor INTEGER,
+    error TEXT,
+    UNIQUE (device, path)
+);
+CREATE INDEX IF NOT EXISTS sweeps_device ON sweeps (device, timestamp);
+CREATE INDEX IF NOT EXISTS sweeps_type ON sweeps (type, timestamp);
+CREATE TABLE IF NOT EXISTS channels (
+    sweep_id INTEGER NOT NULL REFERENCES sweeps (id) ON DELETE CASCADE,
+    channel INTEGER NOT NULL,
+    {', '.join(f'{c} REAL' for c in METRIC_COLUMNS)},
+    PRIMARY KEY (sweep_id, channel)
+);
+'''
+
+
+def default_database_path():
+    """
+    Returns:
+        str: measurements.sqlite, next to this module
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), CONST_DatabaseName)
+
+
+def sweep_timestamp(mat_file_path):
+    """
+    The time of a measurement, from the name of its .mat file, or else the modification time.
+
+    Returns:
+        str: 'YYYY-MM-DD HH:MM:SS', which sorts in time order.
+    """
+    name = os.path.splitext(os.path.basename(mat_file_path))[0]
+    try:
+        time = datetime.datetime.strptime(name, CONST_TimestampFormat)
+    except ValueError:
+        time = datetime.datetime.fromtimestamp(os.path.getmtime(mat_file_path))
+    return time.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _timestamp_bound(value, end=False):
+    """
+    Returns:
+        str: A date, date and time, or datetime.date(time) as a timestamp; dates include the whole day.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, datetime.date):
+        value = value.isoformat()
+    if len(value) == 10:
+        return value + (' 23:59:59' if end else ' 00:00:00')
+    return value
+
+
+def index_file(device, mat_file_path):
+    """
+    Reads a .mat file and computes the metrics of its channels.
+
+    Returns:
+        dict: The columns of the sweeps table, without the file identity.
+        list: (channel, metrics dict) for each channel.
+    """
+    kind = device_type(device)
+    sweep = {'device': device, 'type': kind, 'timestamp': sweep_timestamp(mat_file_path),
+             'wavelength_min_nm': None, 'wavelength_max_nm': None, 'points': None,
+             'channels': 0, 'channels_above_floor': 0, 'error': None}
+    try:
+        wavelengths, channels = load_mat_spectrum(mat_file_path)
+    except Exception as e:
+        sweep['error'] = str(e) or type(e).__name__
+        return sweep, []
+    metrics = [(channel, channel_metrics(wavelengths, spectrum, kind)) for channel, spectrum in channels.items()]
+    sweep.update({'wavelength_min_nm': float(wavelengths.min()) if len(wavelengths) else None,
+                  'wavelength_max_nm': float(wavelengths.max()) if len(wavelengths) else None,
+                  'points': len(wavelengths),
+                  'channels': len(metrics),
+                  'channels_above_floor': sum(m['above_noise_floor'] for c, m in metrics)})
+    return sweep, metrics
+
+
+def _index_file(args):
+    return index_file(*args)
+
+
+class MeasurementDatabase:
+    """
+    The sweeps table has one row per .mat file and device, as a file can belong to
+    two devices whose folders share a prefix (e.g. BriannaGopaul_CHIP2 and
+    BriannaGopaul_CHIP2_calibration): the device (the label key of
+    match_files_with_labels, or the folder name), its opt_in label and type,
+    the measurement time, the wavelength range and the number of channels above
+    CONST_NoiseFloor. The channels table has the metrics of each channel.
+
+    Args:
+        path (str): The database file, by default measurements.sqlite next to this module;
+            ':memory:' for a temporary database.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_database_path()
+        self.connection = sqlite3.connect(self.path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != CONST_SchemaVersion:
+            # an index of the files, so it is rebuilt rather than migrated
+            self.connection.executescript('DROP TABLE IF EXISTS channels; DROP TABLE IF EXISTS sweeps;')
+        self.connection.executescript(SCHEMA)
+        self.connection.execute(f'PRAGMA user_version = {CONST_SchemaVersion}')
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, files, opt_ins=None, workers=None):
+        """
+        Adds the new and changed files, and removes the sweeps whose file no longer exists.
+        Sweeps are identified by their device and path, and are read again when the size
+        or modification time of the file changes.
+
+        Args:
+            files (list): (device, .mat file path) pairs, see files_from_matches and files_from_folders.
+            opt_ins (dict): device -> opt_in label text, if known.
+            workers (int): Number of processes reading the files, by default the number of CPUs.
+
+        Returns:
+            int: Number of files read.
+            int: Number of sweeps removed.
+        """
+        opt_ins = opt_ins or {}
+        known = {(row['device'], row['path']): (row['id'], row['size'], row['mtime_ns'], row['opt_in'])
+                 for row in self.connection.execute('SELECT id, path, size, mtime_ns, device, opt_in FROM sweeps')}
+        changed, relabeled = [], []
+        for device, mat_file_path in files:
+            path = os.path.abspath(mat_file_path)
+            stat = os.stat(path)
+            old = known.get((device, path))
+            if not old or old[1:3] != (stat.st_size, stat.st_mtime_ns):
+                changed.append((device, path, stat))
+            elif old[3] != opt_ins.get(device):
+                relabeled.append((opt_ins.get(device), old[0]))
+
+        requests = [(device, path) for device, path, stat in changed]
+        if workers == 1 or len(requests) < 2:
+            results = [index_file(*request) for request in requests]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_index_file, requests, chunksize=4))
+        with self.connection:
+            for (device, path, stat), (sweep, metrics) in zip(changed, results):
+                self.connection.execute('DELETE FROM sweeps WHERE device = ? AND path = ?', (device, path))
+                sweep.update({'path': path, 'opt_in': opt_ins.get(device),
+                              'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+                names = list(sweep)
+                sweep_id = self.connection.execute(
+                    f"INSERT INTO sweeps ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                    [sweep[n] for n in names]).lastrowid
+                self.connection.executemany(
+                    f"INSERT INTO channels (sweep_id, channel, {', '.join(METRIC_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * (len(METRIC_COLUMNS) + 2))})",
+                    [[sweep_id, channel] + [m.get(c) for c in METRIC_COLUMNS] for channel, m in metrics])
+            self.connection.executemany('UPDATE sweeps SET opt_in = ? WHERE id = ?', relabeled)
+            gone = [(sweep_id,) for (device, path), (sweep_id, *_) in known.items() if not os.path.exists(path)]
+            self.connection.executemany('DELETE FROM sweeps WHERE id = ?', gone)
+        return len(changed), len(gone)
+
+    def sweeps(self, device=None, kind=None, start=None, end=None, above_floor=False):
+        """
+        Args:
+            device (str): Only the sweeps of this device.
+            kind (str): Only the devices of this type, see device_type.
+            start, end (str or datetime.date): Only the sweeps in this time range, inclusive;
+                dates ('YYYY-MM-DD') include the whole day.
+            above_floor (bool): Only the sweeps with a channel above the noise floor.
+
+        Returns:
+            list: The rows of the sweeps table (dict), by device and time.
+        """
+        conditions, parameters = self._conditions(device, kind, start, end, above_floor)
+        return self._query(f"SELECT * FROM sweeps {conditions} ORDER BY device COLLATE NOCASE, timestamp, id",
+                           parameters)
+
+    def latest_per_device(self, kind=None, start=None, end=None, above_floor=False):
+        """
+        Returns:
+            list: The most recent sweep of each device, with the filters of sweeps().
+        """
+        conditions, parameters = self._conditions(None, kind, start, end, above_floor)
+        return self._query(
+            f"SELECT * FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY device ORDER BY timestamp DESC, id DESC) "
+            f"AS rank FROM sweeps {conditions}) WHERE rank = 1 ORDER BY device COLLATE NOCASE", parameters)
+
+    def devices(self):
+        """
+        Returns:
+            dict: device -> number of sweeps.
+        """
+        return {row['device']: row['n'] for row in self.connection.execute(
+            'SELECT device, COUNT(*) AS n FROM sweeps GROUP BY device ORDER BY device COLLATE NOCASE')}
+
+    def summary_rows(self, sweeps):
+        """
+        Returns:
+            list: The metrics of every channel of the sweeps, as the summary rows of
+            analyze_measurements (dict with the keys from SUMMARY_COLUMNS).
+        """
+        rows = []
+        for sweep in sweeps:
+            for channel in self.connection.execute(
+                    'SELECT * FROM channels WHERE sweep_id = ? ORDER BY channel', (sweep['id'],)):
+                row = {'device': sweep['device'], 'type': sweep['type'], 'file': sweep['path']}
+                row.update(dict(channel))
+                row['above_noise_floor'] = bool(row['above_noise_floor'])
+                rows.append(row)
+        return rows
+
+    def _conditions(self, device, kind, start, end, above_floor):
+        conditions, parameters = [], []
+        if device is not None:
+            conditions.append('device = ?')
+            parameters.append(device)
+        if kind is not None:
+            conditions.append('type = ?')
+            parameters.append(kind)
+        if start is not None:
+            conditions.append('timestamp >= ?')
+            parameters.append(_timestamp_bound(start))
+        if end is not None:
+            conditions.append('timestamp <= ?')
+            parameters.append(_timestamp_bound(end, end=True))
+        if above_floor:
+            conditions.append('channels_above_floor > 0')
+        return ('WHERE ' + ' AND '.join(conditions) if conditions else ''), parameters
+
+    def _query(self, sql, parameters=()):
+        return [dict(row) for row in self.connection.execute(sql, parameters)]
+
+
+def main(argv=None):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mat-files', default=os.path.join(script_dir, 'mat_files'),
+                        help='directory containing the .mat files')
+    parser.add_argument('--database', default=default_database_path(),
+                        help='SQLite database file')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('--no-layout', action='store_true',
+                        help='use the folder names as devices, instead of matching the opt_in labels in Shuksan.oas')
+    parser.add_argument('--type', default=None, choices=['mzi', 'ring', 'other'],
+                        help='only list the devices of this type')
+    parser.add_argument('--start', default=None, help='only list the sweeps from this date (YYYY-MM-DD)')
+    parser.add_argument('--end', default=None, help='only list the sweeps until this date (YYYY-MM-DD)')
+    parser.add_argument('--latest', action='store_true', help='only list the latest sweep of each device')
+    args = parser.parse_args(argv)
+
+    db = MeasurementDatabase(args.database)
+    if args.no_layout:
+        read, removed = db.update(files_from_folders(args.mat_files), workers=args.workers)
+    else:
+        from layout_access import LayoutDatabase
+        from analyze_measurements import files_from_matches
+        matches = LayoutDatabase(mat_files_dir=args.mat_files).matches
+        read, removed = db.update(files_from_matches(matches),
+                                  {key: matches[key][1]['opt_in'] for key in matches}, workers=args.workers)
+    print(f"Read {read} files, removed {removed} sweeps")
+
+    query = db.latest_per_device if args.latest else db.sweeps
+    sweeps = query(kind=args.type, start=args.start, end=args.end)
+    for sweep in sweeps:
+        print(f"{sweep['timestamp']}  {sweep['device']:<40} {sweep['type']:<6} "
+              f"{sweep['channels_above_floor']}/{sweep['channels']} channels above {CONST_NoiseFloor} dB")
+    print(f"{len(sweeps)} sweeps of {len({s['device'] for s in sweeps})} devices")
+    db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
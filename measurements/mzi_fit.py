@@ -0,0 +1,391 @@
+'''
+Batch fit of the measured MZI spectra.
+
+Every MZI channel above the noise floor is fitted, all the channels at once,
+with a vectorized Levenberg-Marquardt least-squares fit of the model [dB]:
+
+  T(λ) = E(λ) + 10 log10((1 + V cos φ(λ)) / 2)
+
+where E is the grating coupler envelope (a parabola in dB), V the fringe
+visibility and φ the phase difference between the arms (a parabola in λ).
+The fit is started from the FFT estimate of the FSR, and from the phase of
+the fringes band-passed around it, so that it only refines the model.
+
+The phase gives the FSR and the group index times the path length difference,
+ng ΔL = λ² dφ/dλ / 2π, and its dispersion. The absolute effective index is not
+observable from the transmission alone; its dispersion is given by ng and
+dng/dλ = -λ d²neff/dλ². These need ΔL, from --delta-length or --lengths, e.g.:
+  python mzi_fit.py --output mzi_fit.csv
+  python mzi_fit.py --no-layout --lengths delta_lengths.csv --workers 4
+'''
+
+import os
+import re
+import csv
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from analyze_measurements import (device_type, files_from_folders, files_from_matches, CONST_NoiseFloor,
+                                  CONST_BaselineWidth)
+from spectra import load_spectra, smooth, baseline, passband, band_mask, estimate_fsr, fit_envelope, _filled
+
+CONST_Wavelength = 1310  # nm, where the group index, FSR and insertion loss are reported
+CONST_Iterations = 50  # Levenberg-Marquardt iterations, at most
+CONST_Tolerance = 1e-6  # relative change of the residuals, below which a fit has converged
+CONST_MinVisibility = 0.2  # fits with weaker fringes are not MZI spectra
+CONST_RowsPerWorker = 16  # spectra fitted together by each process
+
+FIT_COLUMNS = ['device', 'file', 'channel', 'converged', 'wavelength_nm',
+               'insertion_loss_dB', 'extinction_ratio_dB', 'fsr_nm', 'fsr_fft_nm',
+               'fsr_slope', 'ng_delta_length_um', 'delta_length_um', 'group_index',
+               'dng_dlambda_per_um', 'd2neff_dlambda2_per_um2', 'dispersion_ps_nm_km',
+               'band_start_nm', 'band_stop_nm', 'rms_residual_dB', 'r_squared', 'iterations']
+
+_dB = 10 / np.log(10)
+_c = 299792458  # m/s
+
+
+def initial_phase(wavelengths, spectra, reference, mask, fsr):
+    """
+    Unwrapped phase of the fringes of each spectrum, from their analytic signal,
+    band-passed around the frequency of the FFT estimate of the FSR.
+
+    Args:
+        spectra (numpy.ndarray): Spectra [dB], shape (N, M).
+        reference (numpy.ndarray): Their baselines [dB], from baseline().
+        mask (numpy.ndarray): Boolean (N, M), the passband of each row.
+        fsr (numpy.ndarray): The FSR of each row [nm], shape (N,), from estimate_fsr().
+
+    Returns:
+        numpy.ndarray: The phase [rad], increasing with the wavelength, shape (N, M).
+        numpy.ndarray: The amplitude of the analytic signal, shape (N, M), to weight the phase.
+    """
+    samples = spectra.shape[1]
+    step = (wavelengths[-1] - wavelengths[0]) / (samples - 1)
+    ripple = np.where(mask, _filled(spectra - reference, 0), 0)
+    spectrum = np.fft.fft(ripple, axis=1)
+    frequencies = np.fft.fftfreq(samples, d=step)
+    center = 1 / fsr[:, None]
+    # a Gaussian band-pass of half the fringe frequency, on the positive frequencies only
+    gain = np.where(frequencies > 0, 2 * np.exp(-0.5 * ((frequencies - center) / (0.25 * center)) ** 2), 0)
+    analytic = np.fft.ifft(spectrum * gain, axis=1)
+    return np.unwrap(np.angle(analytic), axis=1), np.abs(analytic)
+
+
+def _polyfit(u, values, weights, order):
+    """
+    Weighted least-squares polynomials of the rows of values, in powers of u (N, M), lowest first.
+    """
+    vander = u[..., None] ** np.arange(order + 1)
+    normal = np.einsum('nm,nmk,nml->nkl', weights, vander, vander)
+    rhs = np.einsum('nm,nmk,nm->nk', weights, vander, values)
+    normal[np.linalg.matrix_rank(normal) < order + 1] = np.eye(order + 1)
+    return np.linalg.solve(normal, rhs[..., None])[..., 0]
+
+
+def model(u, parameters):
+    """
+    The MZI transmission [dB], and its Jacobian.
+
+    Args:
+        u (numpy.ndarray): The normalized wavelengths of each row, shape (N, M).
+        parameters (numpy.ndarray): Shape (N, 7): the envelope e0, e1, e2 [dB],
+            v = atanh(V), and the phase p0, p1, p2 [rad], all in powers of u.
+
+    Returns:
+        numpy.ndarray: The transmission [dB], shape (N, M).
+        numpy.ndarray: Its derivatives with respect to the parameters, shape (N, M, 7).
+    """
+    e, v, p = parameters[:, None, 0:3], parameters[:, 3:4], parameters[:, None, 4:7]
+    powers = u[..., None] ** np.arange(3)
+    visibility = np.tanh(v)
+    phase = (powers * p).sum(axis=2)
+    cos, sin = np.cos(phase), np.sin(phase)
+    # at most 60 dB deep nulls, as the fit may go through V = 1
+    g = np.maximum(0.5 * (1 + visibility * cos), 1e-6)
+    jacobian = np.empty(u.shape + (7,))
+    jacobian[..., 0:3] = powers
+    jacobian[..., 3] = _dB * 0.5 * (1 - visibility ** 2) * cos / g
+    jacobian[..., 4:7] = (-_dB * 0.5 * visibility * sin / g)[..., None] * powers
+    return (powers * e).sum(axis=2) + _dB * np.log(g), jacobian
+
+
+def levenberg_marquardt(u, y, weights, parameters, iterations=CONST_Iterations, tolerance=CONST_Tolerance):
+    """
+    Weighted least-squares fit of model() to every row, solved together: each
+    row has its own damping, which decreases when a step reduces its residuals
+    and increases otherwise (Marquardt's scaling by the diagonal of JᵀJ).
+
+    Returns:
+        numpy.ndarray: The fitted parameters, shape (N, 7).
+        numpy.ndarray: The weighted sum of the squared residuals of each row, shape (N,).
+        numpy.ndarray: The number of iterations of each row, shape (N,).
+        numpy.ndarray: Boolean (N,), whether each fit has converged.
+    """
+    count = len(y)
+    damping = np.full(count, 1e-3)
+    done = np.zeros(count, dtype=bool)
+    steps = np.zeros(count, dtype=int)
+    values, jacobian = model(u, parameters)
+    residuals = y - values
+    cost = (weights * residuals ** 2).sum(axis=1)
+    for i in range(iterations):
+        active = np.flatnonzero(~done)
+        if not len(active):
+            break
+        w, j, r = weights[active], jacobian[active], residuals[active]
+        normal = np.einsum('nm,nmk,nml->nkl', w, j, j)
+        gradient = np.einsum('nm,nmk,nm->nk', w, j, r)
+        diagonal = np.diagonal(normal, axis1=1, axis2=2)
+        damped = normal + (damping[active, None] * diagonal)[:, :, None] * np.eye(7)
+        step = np.linalg.solve(damped, gradient[..., None])[..., 0]
+        trial = parameters[active] + step
+        trial_values, trial_jacobian = model(u[active], trial)
+        trial_residuals = y[active] - trial_values
+        trial_cost = (w * trial_residuals ** 2).sum(axis=1)
+        better = trial_cost < cost[active]
+        accepted = active[better]
+        converged = better & (cost[active] - trial_cost <= tolerance * cost[active])
+        parameters[accepted] = trial[better]
+        jacobian[accepted] = trial_jacobian[better]
+        residuals[accepted] = trial_residuals[better]
+        cost[accepted] = trial_cost[better]
+        damping[active] = np.where(better, damping[active] / 3, damping[active] * 4)
+        steps[active] += 1
+        # a damping this large only takes steps too small to matter
+        done[active[converged | (damping[active] > 1e10)]] = True
+    return parameters, cost, steps, done
+
+
+def fit_spectra(wavelengths, spectra, wavelength=CONST_Wavelength):
+    """
+    Fits the MZI model to stacked spectra, within the passband of each one.
+
+    Args:
+        wavelengths (numpy.ndarray): The common wavelengths [nm], shape (M,).
+        spectra (numpy.ndarray): The spectra [dB], shape (N, M).
+        wavelength (float): Where the results are reported [nm].
+
+    Returns:
+        dict: Arrays of shape (N,): converged, wavelength_nm (the reported wavelength, within
+        the passband), insertion_loss_dB, extinction_ratio_dB,
+        fsr_nm, fsr_fft_nm, fsr_slope, ng_delta_length_um, d_ng_delta_length_um_per_um,
+        band_start_nm, band_stop_nm, rms_residual_dB, r_squared, iterations;
+        NaN for the rows that cannot be fitted.
+    """
+    count = len(spectra)
+    results = {key: np.full(count, np.nan) for key in
+               ['wavelength_nm', 'insertion_loss_dB', 'extinction_ratio_dB', 'fsr_nm', 'fsr_fft_nm', 'fsr_slope',
+                'ng_delta_length_um', 'd_ng_delta_length_um_per_um', 'band_start_nm', 'band_stop_nm',
+                'rms_residual_dB', 'r_squared']}
+    results['converged'] = np.zeros(count, dtype=bool)
+    results['iterations'] = np.zeros(count, dtype=int)
+    if not count:
+        return results
+
+    smoothed = smooth(wavelengths, spectra)
+    reference = baseline(wavelengths, smoothed)
+    start, stop = passband(reference)
+    fsr = estimate_fsr(wavelengths, smoothed, start, stop)
+    rows = np.flatnonzero(np.isfinite(fsr))
+    results['fsr_fft_nm'] = fsr
+    if not len(rows):
+        return results
+
+    # only the columns within one of the passbands
+    first, last = start[rows].min(), stop[rows].max()
+    wavelengths = wavelengths[first:last]
+    y, reference = spectra[rows, first:last], reference[rows, first:last]
+    start, stop, fsr = start[rows] - first, stop[rows] - first, fsr[rows]
+    mask = band_mask(y.shape, start, stop) & np.isfinite(y)
+    weights = mask.astype(float)
+    # the running median follows fringes longer than its window: a parabola through them instead
+    long = fsr > CONST_BaselineWidth
+    if long.any():
+        reference[long] = fit_envelope(wavelengths, y[long], mask[long])[0]
+    y = _filled(y, 0)
+
+    # normalized wavelengths, -1 to 1 over each passband, with their origin at the reported wavelength
+    low, high = wavelengths[start], wavelengths[stop - 1]
+    origin = np.clip(wavelength, low, high)
+    scale = np.maximum(np.maximum(high - origin, origin - low), 1e-3)
+    u = (wavelengths - origin[:, None]) / scale[:, None]
+
+    phase, amplitude = initial_phase(wavelengths, y, reference, mask, fsr)
+    # the median of the fringes is 3 dB below their maximum, E
+    envelope = _polyfit(u, reference + _dB * np.log(2), weights, 2)
+    depth = np.nanpercentile(np.where(mask, y - reference, np.nan), [2, 98], axis=1)
+    ratio = np.clip(depth[1] - depth[0], 1, 40)
+    parameters = np.concatenate([envelope, (ratio / (2 * _dB))[:, None],
+                                 _polyfit(u, phase, weights * amplitude ** 2, 2)], axis=1)
+    parameters, cost, steps, converged = levenberg_marquardt(u, y, weights, parameters)
+
+    e, v, p = parameters[:, 0:3], np.abs(parameters[:, 3]), parameters[:, 4:7]
+    samples = weights.sum(axis=1)
+    variance = (weights * (y - (weights * y).sum(axis=1, keepdims=True) / samples[:, None]) ** 2).sum(axis=1)
+    slope = p[:, 1] / scale  # dφ/dλ at the origin [rad/nm]
+    curvature = 2 * p[:, 2] / scale ** 2  # d²φ/dλ² [rad/nm²]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fitted = {'wavelength_nm': origin,
+                  'insertion_loss_dB': -e[:, 0],
+                  'extinction_ratio_dB': 2 * _dB * v,
+                  'fsr_nm': 2 * np.pi / np.abs(slope),
+                  # dFSR/dλ, dimensionless
+                  'fsr_slope': -2 * np.pi * curvature * np.sign(slope) / slope ** 2,
+                  'ng_delta_length_um': origin ** 2 * np.abs(slope) / (2 * np.pi) / 1e3,
+                  # d(ng ΔL)/dλ [µm/µm]
+                  'd_ng_delta_length_um_per_um': (2 * origin * np.abs(slope) + origin ** 2 * curvature * np.sign(slope))
+                  / (2 * np.pi),
+                  'band_start_nm': low,
+                  'band_stop_nm': high,
+                  'rms_residual_dB': np.sqrt(cost / samples),
+                  'r_squared': 1 - cost / variance,
+                  'iterations': steps,
+                  'converged': converged & (np.tanh(v) >= CONST_MinVisibility)}
+    for key, value in fitted.items():
+        results[key][rows] = value
+    return results
+
+
+def _fit_rows(args):
+    return fit_spectra(*args)
+
+
+def fit_all(wavelengths, spectra, workers=1, wavelength=CONST_Wavelength):
+    """
+    Runs fit_spectra() on blocks of CONST_RowsPerWorker spectra, in a process pool.
+
+    Args:
+        workers (int): Number of processes, None for the number of CPUs.
+
+    Returns:
+        dict: The results of fit_spectra(), for all the rows.
+    """
+    blocks = [(wavelengths, spectra[i:i + CONST_RowsPerWorker], wavelength)
+              for i in range(0, len(spectra), CONST_RowsPerWorker)]
+    if workers == 1 or len(blocks) < 2:
+        parts = [_fit_rows(b) for b in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(_fit_rows, blocks))
+    if not parts:
+        return fit_spectra(wavelengths, spectra, wavelength)
+    return {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+
+
+def read_lengths(path):
+    """
+    Returns:
+        dict: The path length difference [µm] of each device, from a CSV file
+        with the columns device and delta_length_um.
+    """
+    with open(path, newline='') as file:
+        return {row['device']: float(row['delta_length_um']) for row in csv.DictReader(file)}
+
+
+def group_index(results, delta_length):
+    """
+    The group index and the dispersion, from ng ΔL and the path length differences.
+
+    Args:
+        results (dict): From fit_spectra().
+        delta_length (numpy.ndarray): ΔL of each row [µm], NaN if unknown.
+
+    Returns:
+        dict: Arrays of shape (N,): group_index, dng_dlambda_per_um,
+        d2neff_dlambda2_per_um2, dispersion_ps_nm_km.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ng = results['ng_delta_length_um'] / delta_length
+        dng = results['d_ng_delta_length_um_per_um'] / delta_length
+    return {'group_index': ng,
+            'dng_dlambda_per_um': dng,
+            # dng/dλ = -λ d²neff/dλ²
+            'd2neff_dlambda2_per_um2': -dng / (results['wavelength_nm'] / 1e3),
+            # D = (1/c) dng/dλ, in ps/(nm km)
+            'dispersion_ps_nm_km': dng * 1e12 / _c}
+
+
+def write_results(rows, output_path):
+    """
+    Writes the fit results to a CSV file.
+    """
+    with open(output_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=FIT_COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: _format(row.get(k)) for k in FIT_COLUMNS})
+    print(f"Fit results written to {output_path}")
+
+
+def _format(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    if isinstance(value, float):
+        return f'{value:.6g}'
+    return value
+
+
+def main(argv=None):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mat-files', default=os.path.join(script_dir, 'mat_files'),
+                        help='directory containing the .mat files')
+    parser.add_argument('--output', default=os.path.join(script_dir, 'mzi_fit.csv'),
+                        help='results table (CSV)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('--no-layout', action='store_true',
+                        help='use the folder names as devices, instead of matching the opt_in labels in Shuksan.oas')
+    parser.add_argument('--filter', default=None,
+                        help='only fit devices matching this regular expression')
+    parser.add_argument('--wavelength', type=float, default=CONST_Wavelength,
+                        help='where the results are reported [nm]')
+    parser.add_argument('--delta-length', type=float, default=None,
+                        help='path length difference of the MZIs [µm], for the group index')
+    parser.add_argument('--lengths', default=None,
+                        help='CSV file with the columns device and delta_length_um, for each MZI')
+    args = parser.parse_args(argv)
+
+    if args.no_layout:
+        files = files_from_folders(args.mat_files)
+    else:
+        from layout_access import LayoutDatabase
+        files = files_from_matches(LayoutDatabase(mat_files_dir=args.mat_files).matches)
+    files = [f for f in files if device_type(f[0]) == 'mzi']
+    if args.filter:
+        files = [f for f in files if re.search(args.filter, f[0])]
+
+    wavelengths, spectra, index = load_spectra(files, workers=args.workers)
+    live = np.flatnonzero(np.nanmax(_filled(spectra, -np.inf), axis=1) > CONST_NoiseFloor) if len(index) else []
+    fitted = fit_all(wavelengths, spectra[live], workers=args.workers, wavelength=args.wavelength)
+
+    lengths = read_lengths(args.lengths) if args.lengths else {}
+    delta_length = np.array([lengths.get(index[i][0], np.nan if args.delta_length is None else args.delta_length)
+                             for i in live], dtype=float)
+    fitted.update(delta_length_um=delta_length, **group_index(fitted, delta_length))
+
+    rows = []
+    for k, i in enumerate(live):
+        device, path, channel = index[i]
+        row = {'device': device, 'file': path, 'channel': channel}
+        row.update({key: value[k].item() for key, value in fitted.items()})
+        rows.append(row)
+    write_results(rows, args.output)
+
+    converged = sum(r['converged'] for r in rows)
+    print(f"Fitted {len(rows)} MZI channels above the noise floor ({CONST_NoiseFloor} dB), "
+          f"of {len(index)} in {len(files)} files: {converged} converged")
+    for row in rows:
+        if np.isnan(row['fsr_fft_nm']):
+            print(f" - {row['device']} channel {row['channel']}: no fringes")
+        elif not row['converged']:
+            print(f" - {row['device']} channel {row['channel']}: not fitted, "
+                  f"ER {row['extinction_ratio_dB']:.1f} dB, FSR {row['fsr_nm']:.3g} nm, r² {row['r_squared']:.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,507 @@
+'''
+Vectorized analysis of stacked sweepLaser spectra.
+
+Every function works on a 2-D array of spectra in dB, one row per device channel,
+sampled on a common wavelength grid, so that whole measurement sets are analyzed
+at once instead of device by device, e.g.:
+  wavelengths, spectra, index = load_spectra(files_from_folders('mat_files'))
+  results = analyze_spectra(wavelengths, spectra)
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.fft import next_fast_len, rfft
+from scipy.ndimage import maximum_filter1d, median_filter, uniform_filter1d
+
+from analyze_measurements import (load_mat_spectrum, CONST_NoiseFloor, CONST_SmoothingWidth,
+                                  CONST_BaselineWidth, CONST_Passband, CONST_MinProminence,
+                                  CONST_MinPeriods, CONST_MinFringeDepth)
+
+
+def _load(mat_file_path):
+    try:
+        return load_mat_spectrum(mat_file_path)
+    except Exception as e:
+        print(f"Error reading {mat_file_path}: {e}")
+        return None, {}
+
+
+def load_spectra(files, workers=1):
+    """
+    Loads many .mat files into a single array of spectra.
+    Files sampled on another grid than the first file are interpolated onto it,
+    with NaN outside of their wavelength range.
+
+    Args:
+        files (list): (device, .mat file path) pairs, e.g. from files_from_folders().
+        workers (int): Number of processes reading the files, None for the number of CPUs.
+
+    Returns:
+        numpy.ndarray: The common wavelengths [nm], shape (M,).
+        numpy.ndarray: The spectra [dB], shape (N, M).
+        list: (device, .mat file path, channel) for each of the N rows.
+    """
+    paths = [f[1] for f in files]
+    if workers == 1:
+        loaded = [_load(p) for p in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            loaded = list(executor.map(_load, paths, chunksize=4))
+
+    grid = next((w for w, channels in loaded if channels), None)
+    if grid is None:
+        return np.zeros(0), np.zeros((0, 0)), []
+    rows, index = [], []
+    for (device, path), (wavelengths, channels) in zip(files, loaded):
+        same_grid = len(wavelengths) == len(grid) and np.allclose(wavelengths, grid) if channels else False
+        for channel, spectrum in channels.items():
+            if not same_grid:
+                spectrum = np.interp(grid, wavelengths, spectrum, left=np.nan, right=np.nan)
+            rows.append(spectrum)
+            index.append((device, path, channel))
+    return grid.astype(float), np.array(rows, dtype=float), index
+
+
+def _filled(spectra, value):
+    """
+    Replaces NaN by value, without a copy when there is none (np.nan_to_num also checks for infinities).
+    """
+    nan = np.isnan(spectra)
+    return np.where(nan, value, spectra) if nan.any() else spectra
+
+
+def _interpolated(spectra, edge=None):
+    """
+    Fills the NaN of each spectrum by linear interpolation between its samples, and
+    before its first and after its last sample with those samples, or with edge. The
+    filters would otherwise spread a single NaN over the whole row.
+
+    Returns:
+        numpy.ndarray: The filled spectra, without a copy when there is no NaN.
+        numpy.ndarray: Boolean, where the spectra are NaN.
+    """
+    nan = np.isnan(spectra)
+    if not nan.any():
+        return spectra, nan
+    filled = spectra.copy()
+    columns = np.arange(spectra.shape[1])
+    for row in np.flatnonzero(nan.any(axis=1)):
+        valid = ~nan[row]
+        if valid.any():
+            filled[row] = np.interp(columns, columns[valid], spectra[row, valid], left=edge, right=edge)
+        else:
+            filled[row] = 0 if edge is None else edge
+    return filled, nan
+
+
+def _linear(spectra):
+    # 10 ** (spectra / 10), as exp is faster than power
+    return np.exp(spectra * (np.log(10) / 10))
+
+
+def _samples(wavelengths, width):
+    step = abs(wavelengths[-1] - wavelengths[0]) / max(len(wavelengths) - 1, 1)
+    return max(int(round(width / step)), 1) if step else 1, step
+
+
+def smooth(wavelengths, spectra, width=CONST_SmoothingWidth):
+    """
+    Moving average of each spectrum over width [nm]; NaN where the spectrum is NaN.
+    """
+    n, step = _samples(wavelengths, width)
+    filled, nan = _interpolated(spectra)
+    smoothed = uniform_filter1d(filled, size=n, axis=1, mode='nearest')
+    return np.where(nan, np.nan, smoothed) if nan.any() else smoothed
+
+
+def _median(values):
+    """
+    Median along the last axis, of odd length, by partitioning rather than sorting.
+    """
+    middle = values.shape[-1] // 2
+    return np.partition(values, middle, axis=-1)[..., middle]
+
+
+def baseline(wavelengths, spectra, width=CONST_BaselineWidth, blocks=16):
+    """
+    Running median of each spectrum over +/- width [nm], which follows the
+    grating coupler envelope but not the narrow peaks and nulls.
+    The median is taken over the medians of blocks of width / blocks [nm],
+    interpolated back to every wavelength, which is much faster than a running
+    median over every sample and smooth enough for a baseline.
+    NaN where the spectrum is NaN.
+    """
+    n, step = _samples(wavelengths, width)
+    filled, nan = _interpolated(spectra)
+    reference = _baseline(filled, n, blocks)
+    return np.where(nan, np.nan, reference) if nan.any() else reference
+
+
+def _baseline(spectra, n, blocks):
+    count, samples = spectra.shape
+    # odd blocks, so that the median is a sample
+    size = max(n // blocks, 1) | 1
+    if size == 1 or samples < 2 * size or not count:
+        return median_filter(spectra, size=(1, 2 * n + 1), mode='nearest')
+    # pad the last block with its own last sample, so that every block has size samples
+    padded = -(-samples // size) * size
+    stacked = np.concatenate([spectra, np.repeat(spectra[:, -1:], padded - samples, axis=1)], axis=1)
+    medians = _median(stacked.reshape(count, -1, size))
+    medians = np.pad(medians, ((0, 0), (blocks, blocks)), mode='edge')
+    medians = _median(sliding_window_view(medians, 2 * blocks + 1, axis=1))
+    centers = np.arange(medians.shape[1]) * size + (size - 1) / 2
+    position = np.clip(np.interp(np.arange(samples), centers, np.arange(len(centers))), 0, len(centers) - 1)
+    lower = np.minimum(position.astype(int), len(centers) - 2)
+    fraction = position - lower
+    return medians[:, lower] * (1 - fraction) + medians[:, lower + 1] * fraction
+
+
+def passband(envelope, passband=CONST_Passband):
+    """
+    Finds the contiguous range around the maximum of each envelope that is within
+    passband [dB] of that maximum.
+
+    Args:
+        envelope (numpy.ndarray): Smooth envelopes [dB], shape (N, M), e.g. from baseline().
+
+    Returns:
+        numpy.ndarray: First index of each range, shape (N,).
+        numpy.ndarray: End index (exclusive) of each range, shape (N,).
+    """
+    # a missing sample within the envelope does not end its passband, the missing ends do
+    envelope = _interpolated(envelope, -np.inf)[0]
+    columns = np.arange(envelope.shape[1])
+    peak = np.argmax(envelope, axis=1)
+    outside = envelope < (envelope[np.arange(len(envelope)), peak] - passband)[:, None]
+    start = np.where(outside & (columns < peak[:, None]), columns, -1).max(axis=1) + 1
+    stop = np.where(outside & (columns > peak[:, None]), columns, envelope.shape[1]).min(axis=1)
+    return start, stop
+
+
+def band_mask(shape, start, stop):
+    """
+    Returns:
+        numpy.ndarray: Boolean mask of shape, True within [start, stop) of each row.
+    """
+    columns = np.arange(shape[1])
+    return (columns >= start[:, None]) & (columns < stop[:, None])
+
+
+def fit_envelope(wavelengths, spectra, mask=None, order=2):
+    """
+    Least-squares polynomial fit of each spectrum [dB] within mask.
+    A parabola in dB is the Gaussian transmission of the grating couplers.
+    All the rows are solved together from their weighted normal equations.
+
+    Args:
+        spectra (numpy.ndarray): Spectra or their baselines [dB], shape (N, M).
+        mask (numpy.ndarray): Boolean (N, M), the samples used in each fit; all by default.
+        order (int): Order of the polynomial.
+
+    Returns:
+        numpy.ndarray: The fitted envelopes [dB], shape (N, M).
+        numpy.ndarray: The coefficients, shape (N, order + 1), highest power first,
+        of the polynomial in (wavelength - wavelengths.mean()).
+    """
+    x = wavelengths - wavelengths.mean()
+    vander = np.vander(x, order + 1)
+    weights = np.isfinite(spectra) if mask is None else mask & np.isfinite(spectra)
+    weights = weights.astype(float)
+    y = np.where(weights > 0, spectra, 0)
+    # matrix products rather than einsum, to use BLAS
+    outer = (vander[:, :, None] * vander[:, None, :]).reshape(len(x), -1)
+    normal = (weights @ outer).reshape(-1, order + 1, order + 1)
+    rhs = (weights * y) @ vander
+    # rows without enough samples get a zero polynomial rather than a singular system
+    singular = np.linalg.matrix_rank(normal) < order + 1
+    normal[singular] = np.eye(order + 1)
+    rhs[singular] = 0
+    coefficients = np.linalg.solve(normal, rhs[..., None])[..., 0]
+    coefficients[singular] = np.nan
+    return coefficients @ vander.T, coefficients
+
+
+def envelope_parameters(wavelengths, coefficients):
+    """
+    Describes parabolic envelopes from fit_envelope(order=2).
+
+    Returns:
+        numpy.ndarray: Center wavelength [nm], shape (N,).
+        numpy.ndarray: Peak transmission [dB], shape (N,).
+        numpy.ndarray: 3 dB bandwidth [nm], shape (N,), NaN if the envelope is not concave.
+    """
+    a, b, c = coefficients.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        center = -b / (2 * a)
+        peak = c - b ** 2 / (4 * a)
+        bandwidth = np.where(a < 0, 2 * np.sqrt(-3 / np.where(a < 0, a, -1)), np.nan)
+    return center + wavelengths.mean(), peak, bandwidth
+
+
+def _running_maximum(spectra, size):
+    """
+    maximum_filter1d along the wavelengths, with a size for all the rows or for each row;
+    one filter per distinct size, over all the rows that share it.
+    """
+    size = np.broadcast_to(np.asarray(size, dtype=int), len(spectra))
+    result = np.empty_like(spectra)
+    for s in np.unique(size):
+        rows = size == s
+        result[rows] = maximum_filter1d(spectra[rows], size=s, axis=1, mode='nearest')
+    return result
+
+
+def find_extrema(spectra, reference, prominence=CONST_MinProminence, distance=3, mask=None):
+    """
+    Finds the peaks of every spectrum at once: samples that are the maximum within
+    distance samples, and at least prominence above the reference.
+    For the nulls, use find_extrema(-spectra, -reference).
+
+    Args:
+        spectra (numpy.ndarray): Smoothed spectra [dB], shape (N, M).
+        reference (numpy.ndarray): The level the prominence is measured from, e.g. baseline().
+        distance (int or numpy.ndarray): Smallest separation of two peaks, in samples, for all
+            the rows or for each row.
+        mask (numpy.ndarray): Boolean (N, M), where peaks are searched.
+
+    Returns:
+        numpy.ndarray: Boolean (N, M), True at the peaks.
+    """
+    filled = _filled(spectra, -np.inf)
+    peaks = filled == _running_maximum(filled, np.maximum(distance, 3))
+    peaks &= (spectra - reference) >= prominence
+    # a peak on the edge is not known to be a peak
+    peaks[:, [0, -1]] = False
+    if mask is not None:
+        peaks &= mask
+    return peaks
+
+
+def refine_extrema(wavelengths, spectra, extrema):
+    """
+    Parabolic interpolation of the extrema between samples.
+
+    Returns:
+        numpy.ndarray: The row of each extremum.
+        numpy.ndarray: Its wavelength [nm].
+        numpy.ndarray: Its value [dB].
+    """
+    rows, columns = np.nonzero(extrema)
+    left, center, right = (spectra[rows, columns + d] for d in (-1, 0, 1))
+    curvature = left - 2 * center + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(curvature != 0, 0.5 * (left - right) / curvature, 0)
+    offset = np.clip(np.nan_to_num(offset), -0.5, 0.5)
+    step = wavelengths[1] - wavelengths[0]
+    return rows, wavelengths[columns] + offset * step, center - 0.25 * (left - right) * offset
+
+
+def estimate_fsr(wavelengths, spectra, start=None, stop=None):
+    """
+    Estimates the free spectral range of every spectrum from the strongest period
+    of its linear ripple relative to a parabolic envelope in dB, with a Hann window
+    over its passband, as analyze_measurements.estimate_fsr does for one spectrum:
+    the period must fit CONST_MinPeriods times in the passband, and be at least
+    CONST_MinFringeDepth deep.
+
+    Args:
+        spectra (numpy.ndarray): Spectra [dB], shape (N, M).
+        start, stop (numpy.ndarray): The passband of each row, from passband(); all by default.
+
+    Returns:
+        numpy.ndarray: The FSR [nm], shape (N,), NaN if it cannot be estimated.
+    """
+    count, samples = spectra.shape
+    if start is None:
+        start, stop = np.zeros(count, int), np.full(count, samples)
+    step = abs(wavelengths[-1] - wavelengths[0]) / max(samples - 1, 1)
+    if not count or not step:
+        return np.full(count, np.nan)
+    # only the columns within one of the passbands
+    first, last = start.min(), stop.max()
+    wavelengths, spectra = wavelengths[first:last], spectra[:, first:last]
+    start, stop = start - first, stop - first
+    samples = last - first
+    mask = band_mask(spectra.shape, start, stop) & np.isfinite(spectra)
+    envelope, _ = fit_envelope(wavelengths, spectra, mask)
+    ratio = np.where(mask, _linear(np.where(mask, _filled(spectra - envelope, 0), 0)), 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(mask, ratio / (ratio.sum(axis=1) / mask.sum(axis=1))[:, None] - 1, 0)
+    columns = np.arange(samples)
+    length = np.maximum(stop - start - 1, 1)[:, None]
+    window = np.where(mask, 0.5 - 0.5 * np.cos(2 * np.pi * (columns - start[:, None]) / length), 0)
+    # zero-padded, to interpolate the long periods, which are only a few frequency bins
+    length = next_fast_len(4 * samples, real=True)
+    amplitude = np.abs(rfft(_filled(ratio * window, 0), n=length, axis=1, workers=-1))
+    amplitude *= (2 / window.sum(axis=1))[:, None]
+    frequencies = np.fft.rfftfreq(length, d=step)
+    span = np.maximum(stop - start - 1, 1) * step
+    valid = frequencies[None, :] >= (CONST_MinPeriods / span)[:, None]
+    valid[:, 0] = False
+    # only the local maxima: the tail of a longer period, which does not fit CONST_MinPeriods
+    # times, is not one, however fine the frequency grid
+    valid[:, 1:-1] &= (amplitude[:, 1:-1] >= amplitude[:, :-2]) & (amplitude[:, 1:-1] >= amplitude[:, 2:])
+    best = np.argmax(np.where(valid, amplitude, -1), axis=1)
+    rows = np.arange(count)
+    b = np.clip(best, 1, len(frequencies) - 2)
+    left, center, right = (np.log(amplitude[rows, b + d] + 1e-300) for d in (-1, 0, 1))
+    curvature = left - 2 * center + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where((best < len(frequencies) - 1) & (curvature < 0), 0.5 * (left - right) / curvature, 0)
+        fsr = 1 / (frequencies[best] + np.clip(offset, -0.5, 0.5) * frequencies[1])
+        # the relative amplitude m of the fringes, (1 + m cos) in linear units
+        peak = amplitude[rows, best]
+        depth = 10 * np.log10((1 + peak) / np.maximum(1 - peak, 1e-12))
+    # a shallow ripple, or no period that fits CONST_MinPeriods times
+    fsr[~(depth >= CONST_MinFringeDepth) | ~valid.any(axis=1) | (stop - start < 16)] = np.nan
+    return fsr
+
+
+def extinction_ratio(spectra, nulls, width_samples):
+    """
+    Median depth of the nulls of every spectrum, below the highest level within
+    width_samples of each null.
+
+    Args:
+        width_samples (int or numpy.ndarray): For all the rows or for each row, e.g. one FSR.
+
+    Returns:
+        numpy.ndarray: The extinction ratio [dB], shape (N,), NaN without nulls.
+    """
+    upper = _running_maximum(_filled(spectra, -np.inf), 2 * np.asarray(width_samples) + 1)
+    depth = np.where(nulls, upper - spectra, np.nan)
+    ratio = np.full(len(spectra), np.nan)
+    found = nulls.any(axis=1)
+    ratio[found] = np.nanmedian(depth[found], axis=1)
+    return ratio
+
+
+def resonance(wavelengths, spectra, reference, mask=None, prominence=CONST_MinProminence,
+              width=CONST_BaselineWidth):
+    """
+    Finds the strongest resonance of every spectrum: the highest peak above the
+    reference (drop port), or else the deepest null (through port), and its full width
+    at half maximum in linear units, within width [nm] of the resonance.
+
+    Returns:
+        numpy.ndarray: Resonance wavelength [nm], shape (N,), NaN without resonance.
+        numpy.ndarray: FWHM [nm], shape (N,).
+        numpy.ndarray: Quality factor, shape (N,).
+    """
+    count, samples = spectra.shape
+    n, step = _samples(wavelengths, width)
+    rows = np.arange(count)
+    columns = np.arange(samples)
+    relative = _filled(spectra - reference, 0)
+    if mask is not None:
+        relative = np.where(mask, relative, 0)
+    peak, null = np.argmax(relative, axis=1), np.argmin(relative, axis=1)
+    is_peak = relative[rows, peak] >= prominence
+    found = is_peak | (-relative[rows, null] >= prominence)
+    center = np.where(is_peak, peak, null)
+    sign = np.where(is_peak, 1.0, -1.0)[:, None]
+
+    # distance above half maximum, in linear units, positive at the resonance
+    linear = _linear(relative)
+    half = (1 + linear[rows, center]) / 2
+    above = sign * (linear - half[:, None])
+    near = np.abs(columns - center[:, None]) <= n
+    outside = (above < 0) & near
+    left = np.where(outside & (columns < center[:, None]), columns, -1).max(axis=1)
+    right = np.where(outside & (columns > center[:, None]), columns, samples).min(axis=1)
+    found &= (left >= 0) & (right < samples)
+
+    # linear interpolation of the crossings, between the last sample outside and the next one inside
+    def crossing(outer, inner):
+        outer, inner = np.clip(outer, 0, samples - 1), np.clip(inner, 0, samples - 1)
+        a, b = above[rows, outer], above[rows, inner]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = np.where(b != a, -a / (b - a), 0)
+        return outer + fraction * (inner - outer)
+
+    fwhm = (crossing(right, right - 1) - crossing(left, left + 1)) * step
+    wavelength = wavelengths[center]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = wavelength / fwhm
+    nan = np.where(found & (fwhm > 0), 1, np.nan)
+    return wavelength * nan, fwhm * nan, q * nan
+
+
+def analyze_spectra(wavelengths, spectra):
+    """
+    Runs the complete analysis on stacked spectra. Like channel_metrics(), only the
+    spectra above CONST_NoiseFloor are analyzed; the others get NaN results.
+
+    Args:
+        wavelengths (numpy.ndarray): The common wavelengths [nm], shape (M,).
+        spectra (numpy.ndarray): The spectra [dB], shape (N, M).
+
+    Returns:
+        dict: Arrays of shape (N,) for the scalar results: above_noise_floor, peak_dB,
+        peak_wavelength_nm, envelope_center_nm, envelope_peak_dB, envelope_bandwidth_nm,
+        fsr_nm, extinction_ratio_dB, resonance_wavelength_nm, resonance_fwhm_nm, q_factor;
+        and the (N, M) arrays envelope, normalized (spectra - envelope), peaks and nulls.
+    """
+    filled = _filled(spectra, -np.inf)
+    peak = np.argmax(filled, axis=1)
+    peak_dB = filled[np.arange(len(spectra)), peak]
+    live = peak_dB > CONST_NoiseFloor
+    results = {'above_noise_floor': live,
+               'peak_dB': peak_dB,
+               'peak_wavelength_nm': wavelengths[peak]}
+    features = _analyze_live(wavelengths, spectra[live]) if live.any() else _no_features(spectra.shape[1])
+    for key, value in features.items():
+        full = np.zeros((len(spectra),) + value.shape[1:], dtype=value.dtype)
+        if value.dtype != bool:
+            full[:] = np.nan
+        full[live] = value
+        results[key] = full
+    results['normalized'] = spectra - results['envelope']
+    return results
+
+
+def _no_features(samples):
+    """
+    The results of _analyze_live() for no spectra: baseline() and the fits need at least one.
+    """
+    features = {key: np.empty(0) for key in ['envelope_center_nm', 'envelope_peak_dB', 'envelope_bandwidth_nm',
+                                             'fsr_nm', 'extinction_ratio_dB', 'resonance_wavelength_nm',
+                                             'resonance_fwhm_nm', 'q_factor']}
+    features.update(envelope=np.empty((0, samples)), peaks=np.zeros((0, samples), bool),
+                    nulls=np.zeros((0, samples), bool))
+    return features
+
+
+def _analyze_live(wavelengths, live_spectra):
+    """
+    The features of the spectra above the noise floor, see analyze_spectra().
+    """
+    smoothed = smooth(wavelengths, live_spectra)
+    reference = baseline(wavelengths, smoothed)
+    start, stop = passband(reference)
+    mask = band_mask(live_spectra.shape, start, stop)
+    envelope, coefficients = fit_envelope(wavelengths, reference, mask)
+    center, envelope_peak, bandwidth = envelope_parameters(wavelengths, coefficients)
+
+    fsr = estimate_fsr(wavelengths, smoothed, start, stop)
+    # peaks and nulls closer than 0.7 FSR are the same feature
+    n, step = _samples(wavelengths, CONST_BaselineWidth)
+    period = np.clip(np.nan_to_num(fsr / step, nan=n), 3, n).astype(int)
+    distance = (0.7 * period).astype(int)
+    peaks = find_extrema(smoothed, reference, distance=distance, mask=mask)
+    nulls = find_extrema(-smoothed, -reference, distance=distance, mask=mask)
+    resonance_wavelength, fwhm, q = resonance(wavelengths, smoothed, reference, mask)
+
+    features = {'envelope_center_nm': center,
+                'envelope_peak_dB': envelope_peak,
+                'envelope_bandwidth_nm': bandwidth,
+                'fsr_nm': fsr,
+                'extinction_ratio_dB': extinction_ratio(smoothed, nulls, period),
+                'resonance_wavelength_nm': resonance_wavelength,
+                'resonance_fwhm_nm': fwhm,
+                'q_factor': q,
+                'envelope': envelope,
+                'peaks': peaks,
+                'nulls': nulls}
+    return features
@@ -0,0 +1,216 @@
+'''
+Test plan for the automated probe station, ordered to minimize the stage travel.
+
+The opt_in labels of the merged layout are grouped by polarization and
+wavelength, so that the laser and polarization are changed once per group,
+and the devices of each group are ordered with a nearest-neighbour tour,
+improved by 2-opt. The plan is written in the coordinate file format of
+SiEPIC-Tools (find_automated_measurement_labels), and the total travel is
+compared with the order of the labels in the layout, e.g.:
+  python test_plan.py --output test_plan.txt
+  python test_plan.py --manifest ../aggregate/Shuksan_opt_in.json
+'''
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+CONST_Header = '% X-coord, Y-coord, Polarization, wavelength, type, deviceID, params'
+CONST_Metric = 'euclidean'  # or 'chebyshev', for stages that move both axes at the same time
+
+
+def label_fields(opt_in):
+    """
+    Splits an opt_in label as find_automated_measurement_labels does:
+    opt_in_<polarization>_<wavelength>_<type>_<deviceID>_<params>
+
+    Returns:
+        dict: opt_in, pol, wavelength, type, deviceID, params (list)
+    """
+    fields = opt_in.split('_')
+    while len(fields) < 7:
+        fields.append('comment')
+    return {'opt_in': opt_in, 'pol': fields[2], 'wavelength': fields[3], 'type': fields[4],
+            'deviceID': fields[5], 'params': fields[6:]}
+
+
+def labels_from_layout(layout_path=None):
+    """
+    Returns:
+        list: The opt_in labels (dict with x, y [µm]) of the merged layout.
+    """
+    from layout_access import LayoutDatabase
+    labels = LayoutDatabase(layout_path).labels[1]
+    return [dict(label_fields(l['opt_in']), x=l['x'], y=l['y']) for l in labels if 'opt_in' in l]
+
+
+def labels_from_manifest(path):
+    """
+    Returns:
+        list: The opt_in labels (dict with x, y [µm]) of the manifest written by aggregate.py.
+    """
+    with open(path) as file:
+        labels = json.load(file)['labels']
+    return [dict(label_fields(l['opt_in']), x=l['x'], y=l['y']) for l in labels]
+
+
+def distances(points, metric=CONST_Metric):
+    """
+    Args:
+        points (np.ndarray): (n, 2) positions.
+
+    Returns:
+        np.ndarray: (n, n) stage travel between the points.
+    """
+    delta = np.abs(points[:, None, :] - points[None, :, :])
+    if metric == 'chebyshev':
+        return delta.max(axis=2)
+    if metric == 'manhattan':
+        return delta.sum(axis=2)
+    return np.hypot(delta[..., 0], delta[..., 1])
+
+
+def nearest_neighbour(d, start):
+    """
+    Returns:
+        np.ndarray: The order of the points, from start, to the nearest point not visited yet.
+    """
+    n = len(d)
+    order = [start]
+    visited = np.zeros(n, dtype=bool)
+    visited[start] = True
+    for i in range(n - 1):
+        row = np.where(visited, np.inf, d[order[-1]])
+        order.append(int(np.argmin(row)))
+        visited[order[-1]] = True
+    return np.array(order)
+
+
+def two_opt(order, d, max_passes=100):
+    """
+    Improves an open path, with a fixed first point, by reversing the segments
+    order[i:j+1] that shorten it, until none does.
+
+    Returns:
+        np.ndarray: The new order.
+    """
+    order = order.copy()
+    n = len(order)
+    if n < 3:
+        return order
+    for p in range(max_passes):
+        improved = False
+        for i in range(1, n - 1):
+            a, b = order[i - 1], order[i]
+            c = order[i + 1:]                          # j = i+1 .. n-1
+            e = np.append(order[i + 2:], -1)           # the point after j, none for the last
+            after = np.where(e >= 0, d[b, e] - d[c, e], 0)
+            delta = d[a, c] - d[a, b] + after
+            j = int(np.argmin(delta))
+            if delta[j] < -1e-9:
+                order[i:i + j + 2] = order[i:i + j + 2][::-1]
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+def path_length(points, order, start=None, metric=CONST_Metric):
+    """
+    Returns:
+        float: The travel through the points in order, from start if given.
+    """
+    path = points[order]
+    if start is not None:
+        path = np.vstack([start, path])
+    d = np.abs(np.diff(path, axis=0))
+    if metric == 'chebyshev':
+        return float(d.max(axis=1).sum())
+    if metric == 'manhattan':
+        return float(d.sum())
+    return float(np.hypot(d[:, 0], d[:, 1]).sum())
+
+
+def plan(labels, start=(0, 0), metric=CONST_Metric):
+    """
+    Orders the labels: by polarization and wavelength, then in each group by a
+    nearest-neighbour tour improved by 2-opt, starting from the device nearest
+    to the end of the previous group.
+
+    Returns:
+        list: The labels, in the order of the measurements.
+        list: (polarization, wavelength, number of devices, travel [µm]) of each group.
+    """
+    position = np.array(start, dtype=float)
+    ordered, groups = [], []
+    for key in sorted(set((l['pol'], l['wavelength']) for l in labels)):
+        group = [l for l in labels if (l['pol'], l['wavelength']) == key]
+        points = np.array([[l['x'], l['y']] for l in group], dtype=float)
+        d = distances(points, metric)
+        first = int(np.argmin(distances(np.vstack([position, points]), metric)[0, 1:]))
+        order = two_opt(nearest_neighbour(d, first), d)
+        groups.append(key + (len(group), path_length(points, order, position, metric)))
+        ordered += [group[i] for i in order]
+        position = points[order[-1]]
+    return ordered, groups
+
+
+def travel(labels, start=(0, 0), metric=CONST_Metric):
+    """
+    Returns:
+        float: The stage travel to measure the labels in this order [µm].
+        int: The number of changes of polarization or wavelength.
+    """
+    points = np.array([[l['x'], l['y']] for l in labels], dtype=float).reshape(-1, 2)
+    changes = sum((a['pol'], a['wavelength']) != (b['pol'], b['wavelength']) for a, b in zip(labels, labels[1:]))
+    return path_length(points, np.arange(len(labels)), np.array(start, dtype=float), metric), changes
+
+
+def write_plan(labels, path):
+    """
+    Writes the labels in the coordinate file format of SiEPIC-Tools.
+    """
+    with open(path, 'w') as file:
+        file.write(CONST_Header + '\n')
+        for l in labels:
+            x, y = (int(v) if float(v).is_integer() else v for v in (l['x'], l['y']))
+            file.write(', '.join(str(v) for v in [x, y, l['pol'], l['wavelength'], l['type'], l['deviceID']] + l['params']) + '\n')
+
+
+def main(argv=None):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--layout', default=None,
+                        help='merged layout (default: ../aggregate/Shuksan.oas)')
+    parser.add_argument('--manifest', default=None,
+                        help='read the labels from the opt_in manifest of aggregate.py (JSON) instead of the layout')
+    parser.add_argument('--output', default=os.path.join(script_dir, 'test_plan.txt'),
+                        help='the test plan, in the SiEPIC-Tools coordinate file format')
+    parser.add_argument('--start', type=float, nargs=2, default=[0, 0], metavar=('X', 'Y'),
+                        help='initial position of the stage [µm]')
+    parser.add_argument('--metric', default=CONST_Metric, choices=['euclidean', 'chebyshev', 'manhattan'],
+                        help='stage travel between two devices')
+    args = parser.parse_args(argv)
+
+    labels = labels_from_manifest(args.manifest) if args.manifest else labels_from_layout(args.layout)
+    if not labels:
+        print('No opt_in labels found')
+        return 1
+    ordered, groups = plan(labels, args.start, args.metric)
+    write_plan(ordered, args.output)
+
+    naive, naive_changes = travel(labels, args.start, args.metric)
+    optimized, changes = travel(ordered, args.start, args.metric)
+    print(f"{len(labels)} devices, {len(groups)} polarization/wavelength groups, plan written to {args.output}")
+    for pol, wavelength, n, length in groups:
+        print(f" {pol} {wavelength}: {n} devices, {length / 1e3:.1f} mm")
+    print(f"Stage travel ({args.metric}): {optimized / 1e3:.1f} mm, {changes} laser/polarization changes "
+          f"(layout order: {naive / 1e3:.1f} mm, {naive_changes} changes; "
+          f"{100 * (1 - optimized / naive) if naive else 0:.0f}% less travel)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,62 +4,539 @@ written with the help of ChatGPT 4.o
 '''
 
 import os
-import re
-import requests
-import zipfile
-import shutil
-import pathlib
 import klayout.db as pya
-import siepicfab_ebeam_zep
-import SiEPIC
-from SiEPIC.utils import find_automated_measurement_labels
-import matplotlib.pyplot as plt
-import scipy.io
 import sys
-from PyQt6.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QListWidget, QLabel, QTabWidget, QScrollArea, QPushButton, QTextEdit
-from PyQt6.QtGui import QPixmap
-from PyQt6.QtCore import Qt
+import time
+import bisect
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from PyQt6.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QTabWidget, QScrollArea, QPushButton, QTextEdit, QTreeView, QLineEdit, QAbstractItemView
+from PyQt6.QtGui import QPixmap, QBrush, QColor
+from PyQt6.QtCore import Qt, QObject, QThread, QTimer, QAbstractItemModel, QModelIndex, pyqtSignal
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas, NavigationToolbar2QT as NavigationToolbar
 
-CONST_NoiseFloor = -50  # only plot files that exceed the measurement noise floor
+from analyze_measurements import CONST_NoiseFloor, load_mat_spectrum  # only plot files that exceed the measurement noise floor
+from measurement_db import MeasurementDatabase
+from layout_access import (LayoutDatabase, default_layout_path, load_layout_and_extract_labels,
+                           match_files_with_labels, find_course_cells, find_text_label, export_netlist)
+CONST_PrecomputeNetlists = False  # extract the netlists of all the devices at startup
+CONST_NetlistWorkers = None  # number of processes for the netlists, None for the number of CPUs
+CONST_NetlistChunk = 8  # number of netlists per worker task when precomputing
+CONST_MatchBatchInterval = 0.05  # s, between batches of matches sent to the list while loading
+CONST_SearchDelay = 150  # ms, after the last key press in the search box before filtering
+CONST_ExpandSearchResults = 200  # expand the whole tree when a search has at most this many devices
 
 '''
 matches example:
 ['/Users/lukasc/Documents/GitHub/openEBL-2024-10/measurements/mat_files/Lukas_data_2024T3/LukasChrostowski_MZI1/09-Nov-2024 06.05.22.mat', {'opt_in': 'opt_in_TE_1550_device_LukasChrostowski_MZI1', 'x': 673, 'y': 4322, 'pol': 'TE', 'wavelength': '1550', 'type': 'device', 'deviceID': 'LukasChrostowski', 'params': ['MZI1'], 'Text': ('opt_in_TE_1550_device_LukasChrostowski_MZI1',r0 673000,4322000)}]
 '''
 
+class NetlistCache(QObject):
+    """
+    Netlists of the opt_in circuits, cached per opt_in label.
+    
+    The netlists are extracted in worker processes, each with its own copy of the 
+    layout, so that the GUI never waits on SiEPIC-Tools. Failed extractions are 
+    cached as well, so they are not retried. The cache is only modified on the
+    GUI thread: the results of the workers are queued to it by a signal.
+    
+    Signals:
+        netlist_ready (str): the opt_in of a netlist added to the cache.
+    """
+    netlist_ready = pyqtSignal(str)
+    _results_ready = pyqtSignal(list)
+
+    def __init__(self, layout_path, workers=1):
+        super().__init__()
+        self.layout_path = layout_path
+        self.workers = workers
+        self.netlists = {}  # opt_in -> (netlist text, error message)
+        self.pending = set()  # opt_in labels being extracted
+        self.executor = None
+        self._results_ready.connect(self._store)
+
+    def get(self, opt_in_text):
+        """
+        Returns:
+            tuple: (netlist text, error message), or None if not extracted yet.
+        """
+        return self.netlists.get(opt_in_text)
+
+    def request(self, requests):
+        """
+        Extracts netlists in the background, unless they are cached or pending.
+        
+        Args:
+            requests (list): (cell name, opt_in) pairs; with a cell name of None,
+                the cell containing the opt_in label is found by the worker.
+        """
+        todo = {}
+        for cell_name, opt_in_text in requests:
+            if opt_in_text not in self.pending and opt_in_text not in self.netlists:
+                todo.setdefault(opt_in_text, cell_name)
+        todo = [(cell_name, opt_in_text) for opt_in_text, cell_name in todo.items()]
+        if not todo:
+            return
+        if not self.executor:
+            # spawn, rather than fork a process that is running Qt
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_netlist_worker, initargs=(self.layout_path,))
+        for i in range(0, len(todo), CONST_NetlistChunk):
+            chunk = todo[i:i + CONST_NetlistChunk]
+            self.pending.update(opt_in_text for cell_name, opt_in_text in chunk)
+            future = self.executor.submit(_netlist_worker, chunk)
+            future.add_done_callback(partial(self._done, chunk))
+
+    def _done(self, chunk, future):
+        # runs in an executor thread: the results are queued to the GUI thread
+        try:
+            results = future.result()
+        except Exception as e:
+            results = [(cell_name, opt_in_text, None, f'worker failed: {e}') for cell_name, opt_in_text in chunk]
+        self._results_ready.emit(results)
+
+    def _store(self, results):
+        for cell_name, opt_in_text, text, error in results:
+            self.netlists[opt_in_text] = (text, error)
+            self.pending.discard(opt_in_text)
+            self.netlist_ready.emit(opt_in_text)
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+# Per-process layout for the netlist workers
+_netlist_worker_layout = {}
+
+def _init_netlist_worker(layout_path):
+    _netlist_worker_layout['database'] = LayoutDatabase(layout_path)
+
+def _netlist_worker(requests):
+    """
+    Returns:
+        list: (cell name, opt_in, netlist text, error message) for each request.
+    """
+    database = _netlist_worker_layout['database']
+    results = []
+    for cell_name, opt_in_text in requests:
+        cell = database.layout.cell(cell_name) if cell_name else database.cell(opt_in_text)
+        try:
+            if not cell:
+                raise Exception('opt_in label not found in layout')
+            cell_name = cell.name
+            results.append((cell_name, opt_in_text, export_netlist(cell, opt_in_text), None))
+        except Exception as e:
+            results.append((cell_name, opt_in_text, None, str(e) or type(e).__name__))
+    return results
+
+class DataLoader(QThread):
+    """
+    Loads the opt_in labels and matches the .mat files in the background, then loads the layout,
+    so that the window shows immediately. The labels come from the LayoutDatabase snapshot
+    when the layout has not changed, so the device browser fills before the layout is read.
+    
+    Signals:
+        status (str): progress message.
+        courses_found (dict): opt_in -> course cell name, see find_course_cells; before any matches.
+        matches_found (dict): a batch of matches, in the format of match_files_with_labels;
+            a key can be in several batches, its files and labels are then to be appended.
+        layout_loaded (object): the pya.Layout; the thread does not use the layout after that.
+        failed (str): error message; no more signals follow.
+    """
+    status = pyqtSignal(str)
+    courses_found = pyqtSignal(dict)
+    matches_found = pyqtSignal(dict)
+    layout_loaded = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, layout_path=None, mat_files_dir=None):
+        super().__init__()
+        self.database = LayoutDatabase(layout_path, mat_files_dir)
+
+    def run(self):
+        try:
+            self.status.emit('Extracting opt_in labels...')
+            self.courses_found.emit(self.database.courses)
+
+            self.status.emit('Matching measurement files...')
+            batch, last = {}, time.time()
+            for folder_matches in self.database.iter_matches():
+                for key, files_and_labels in folder_matches.items():
+                    batch.setdefault(key, []).extend(files_and_labels)
+                if batch and time.time() - last > CONST_MatchBatchInterval:
+                    self.matches_found.emit(batch)
+                    batch, last = {}, time.time()
+            if batch:
+                self.matches_found.emit(batch)
+
+            self.status.emit('Loading layout...')
+            self.layout_loaded.emit(self.database.layout)
+        except Exception as e:
+            self.failed.emit(str(e) or type(e).__name__)
+
+
+class _TreeNode:
+    """
+    A row of the DeviceTreeModel: the root (level 0), a course cell (1), a designer (2) or a device (3).
+    """
+    __slots__ = ('name', 'parent', 'level', 'row', 'children', 'by_name', 'fetched')
+
+    def __init__(self, name, parent, row=0):
+        self.name = name
+        self.parent = parent
+        self.level = parent.level + 1 if parent else 0
+        self.row = row
+        self.children = []
+        self.by_name = {}
+        self.fetched = self.level == 3  # devices have no children to fetch
+
+
+class DeviceTreeModel(QAbstractItemModel):
+    """
+    The matched devices, grouped by course cell and designer (deviceID).
+    
+    The rows under a node are only created when the view asks for them (canFetchMore / 
+    fetchMore, when the node is expanded), and devices found later are inserted in place 
+    into the nodes already created, so that the tree stays responsive with tens of 
+    thousands of devices.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.groups = {}  # course -> designer -> set of device keys, all the devices
+        self.shown = self.groups  # the same, for the devices passing the filter
+        self.filter = None  # set of device keys shown, None for all
+        self.errors = {}  # device key -> tooltip, for the devices shown in gray
+        self.root = _TreeNode('', None)
+
+    def add(self, key, course, designer):
+        """
+        Adds a device, and inserts its row if its parent's rows have been created.
+        """
+        self.groups.setdefault(course, {}).setdefault(designer, set()).add(key)
+        if self.filter is not None:
+            if key not in self.filter:
+                return
+            self.shown.setdefault(course, {}).setdefault(designer, set()).add(key)
+        node = self.root
+        for name in (course, designer, key):
+            if not node.fetched:
+                return
+            child = node.by_name.get(name)
+            if child is None:
+                # its own children, if any, are fetched later from self.shown
+                self._insert(node, name)
+                return
+            node = child
+
+    def _insert(self, node, name):
+        row = bisect.bisect(node.children, name.casefold(), key=lambda child: child.name.casefold())
+        self.beginInsertRows(self._index(node), row, row)
+        child = _TreeNode(name, node, row)
+        node.children.insert(row, child)
+        node.by_name[name] = child
+        for i in range(row + 1, len(node.children)):
+            node.children[i].row = i
+        self.endInsertRows()
+
+    def _names(self, node):
+        if node.level == 0:
+            return list(self.shown)
+        if node.level == 1:
+            return list(self.shown.get(node.name, {}))
+        if node.level == 2:
+            return list(self.shown.get(node.parent.name, {}).get(node.name, ()))
+        return []
+
+    def set_filter(self, keys):
+        """
+        Shows only the devices in keys, or all of them if keys is None.
+        """
+        self.beginResetModel()
+        self.filter = keys
+        if keys is None:
+            self.shown = self.groups
+        else:
+            self.shown = {}
+            for course, designers in self.groups.items():
+                for designer, devices in designers.items():
+                    devices = devices & keys
+                    if devices:
+                        self.shown.setdefault(course, {})[designer] = devices
+        self.root = _TreeNode('', None)
+        self.endResetModel()
+
+    def set_error(self, key, tooltip):
+        """
+        Shows a device in gray, with a tooltip.
+        """
+        self.errors[key] = tooltip
+        for course, designers in self.shown.items():
+            for designer, devices in designers.items():
+                if key in devices:
+                    node = self.root.by_name.get(course)
+                    node = node and node.by_name.get(designer)
+                    node = node and node.by_name.get(key)
+                    if node:
+                        index = self._index(node)
+                        self.dataChanged.emit(index, index)
+
+    def key(self, index):
+        """
+        Returns:
+            str: The device key of a row, None for course and designer rows.
+        """
+        node = self._node(index)
+        return node.name if node.level == 3 else None
+
+    def _node(self, index):
+        return index.internalPointer() if index.isValid() else self.root
+
+    def _index(self, node):
+        return QModelIndex() if node is self.root else self.createIndex(node.row, 0, node)
+
+    def index(self, row, column, parent=QModelIndex()):
+        node = self._node(parent)
+        if column != 0 or not 0 <= row < len(node.children):
+            return QModelIndex()
+        return self.createIndex(row, 0, node.children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        return self._index(index.internalPointer().parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        return len(self._node(parent).children)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def hasChildren(self, parent=QModelIndex()):
+        node = self._node(parent)
+        return bool(node.children) or (not node.fetched and bool(self._names(node)))
+
+    def canFetchMore(self, parent):
+        node = self._node(parent)
+        return not node.fetched
+
+    def fetchMore(self, parent):
+        node = self._node(parent)
+        if node.fetched:
+            return
+        names = sorted(self._names(node), key=str.casefold)
+        node.fetched = True
+        if not names:
+            return
+        self.beginInsertRows(parent, 0, len(names) - 1)
+        for row, name in enumerate(names):
+            child = _TreeNode(name, node, row)
+            node.children.append(child)
+            node.by_name[name] = child
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        node = index.internalPointer()
+        if role == Qt.ItemDataRole.DisplayRole:
+            return node.name
+        if node.level == 3 and node.name in self.errors:
+            if role == Qt.ItemDataRole.ForegroundRole:
+                return QBrush(QColor('gray'))
+            if role == Qt.ItemDataRole.ToolTipRole:
+                return self.errors[node.name]
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.ItemFlag.NoItemFlags
+        if index.internalPointer().level == 3:
+            return Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable
+        return Qt.ItemFlag.ItemIsEnabled
+
+
+class TrigramIndex:
+    """
+    Case-insensitive substring search over the device keys. Queries of 3 or more characters
+    only check the keys that contain all of the query's trigrams; a query that extends the 
+    previous one only checks the previous results.
+    """
+    def __init__(self):
+        self.keys = set()
+        self.trigrams = {}  # trigram -> set of keys
+        self.previous = (None, None)  # the last query and its results
+
+    @staticmethod
+    def _trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, key):
+        self.keys.add(key)
+        for trigram in self._trigrams(key.casefold()):
+            self.trigrams.setdefault(trigram, set()).add(key)
+        self.previous = (None, None)
+
+    def search(self, query):
+        """
+        Returns:
+            set: The keys containing query, or None for an empty query.
+        """
+        query = query.strip().casefold()
+        if not query:
+            return None
+        previous_query, previous_keys = self.previous
+        if previous_query is not None and previous_query in query:
+            candidates = previous_keys
+        elif len(query) >= 3:
+            postings = sorted((self.trigrams.get(t, set()) for t in self._trigrams(query)), key=len)
+            candidates = set.intersection(*postings)
+        else:
+            candidates = self.keys
+        keys = {key for key in candidates if query in key.casefold()}
+        self.previous = (query, keys)
+        return keys
+
+
 class TabbedGUI(QMainWindow):
-    def __init__(self, layout, matches):
+    def __init__(self, layout=None, matches=None, layout_path=None, precompute_netlists=CONST_PrecomputeNetlists,
+                 mat_files_dir=None):
+        """
+        Args:
+            layout (pya.Layout): The loaded layout; if None, the layout is loaded from layout_path
+                and the matches found in mat_files_dir in the background, after the window shows.
+            matches (dict): From match_files_with_labels.
+        """
         super().__init__()
         self.setWindowTitle("SiEPIC openEBL data viewer")
         self.setGeometry(100, 100, 800, 600)
-        self.matches = dict(sorted(matches.items()))
+        self.matches = {}
+        self.database = MeasurementDatabase()  # the sweeps of each device, read as they are selected
         self.layout = layout
-        self.top_cell = layout.top_cell()
+        self.top_cell = layout.top_cell() if layout else None
+        self.courses = find_course_cells(layout) if layout else {}  # opt_in -> course cell name
+        self.search_index = TrigramIndex()
         self.legend_enabled = True  # Track legend state
         self.multi_selection = False  # Track selection mode
         
+        # Netlists are extracted in the background, and shown when ready
+        workers = 1
+        if precompute_netlists:
+            workers = CONST_NetlistWorkers or os.cpu_count() or 1
+        self.precompute_netlists = precompute_netlists
+        self.netlists = NetlistCache(layout_path or default_layout_path(), workers)
+        self.netlists.netlist_ready.connect(self.on_netlist_ready)
+        self.netlist_shown = None  # opt_in of the circuit in the Netlist tab
+        
         self.initUI()
+        self.loader = None
+        if layout:
+            self.add_matches(matches or {})
+            self.loading_finished()
+        else:
+            self.loader = DataLoader(layout_path, mat_files_dir)
+            self.loader.status.connect(self.statusBar().showMessage)
+            self.loader.courses_found.connect(self.set_courses)
+            self.loader.matches_found.connect(self.add_matches)
+            self.loader.layout_loaded.connect(self.set_layout)
+            self.loader.failed.connect(self.loading_failed)
+            self.loader.finished.connect(self.loading_finished)
+            self.loader.start()
+
+    def set_courses(self, courses):
+        """
+        Sets the course cell of each opt_in label, before the DataLoader finds the matches.
+        """
+        self.courses = courses
+
+    def set_layout(self, layout):
+        """
+        Shows the layout once loaded by the DataLoader.
+        """
+        self.layout = layout
+        self.top_cell = layout.top_cell()
+        if not self.selected_keys():
+            self.display_klayout_cell_image(self.top_cell.name, self.top_cell, width=self.scrollArea.width()*0.99)
+
+    def add_matches(self, matches):
+        """
+        Adds matches to the device browser and the search index, as they are found.
+        """
+        query = self.search_box.text().strip().casefold()
+        for key, files_and_labels in matches.items():
+            if key not in self.matches:
+                label = files_and_labels[1]
+                course = self.courses.get(label['opt_in'], 'Unknown')
+                if self.device_model.filter is not None and query in key.casefold():
+                    self.device_model.filter.add(key)
+                self.device_model.add(key, course, label.get('deviceID') or 'Unknown')
+                self.search_index.add(key)
+            self.matches.setdefault(key, []).extend(files_and_labels)
+        self.statusBar().showMessage(f'Matching measurement files... {len(self.matches)} devices')
+
+    def selected_keys(self):
+        """
+        Returns:
+            list: The keys of the selected devices.
+        """
+        keys = (self.device_model.key(index) for index in self.tree.selectionModel().selectedIndexes())
+        return [key for key in keys if key]
+
+    def apply_search(self):
+        """
+        Shows only the devices matching the text in the search box.
+        """
+        keys = self.search_index.search(self.search_box.text())
+        self.device_model.set_filter(keys)
+        if keys is not None:
+            if len(keys) <= CONST_ExpandSearchResults:
+                self.tree.expandAll()
+            self.statusBar().showMessage(f'{len(keys)} of {len(self.matches)} devices', 5000)
+
+    def loading_failed(self, error):
+        self.statusBar().showMessage(f'Loading failed: {error}')
+        if not self.layout:
+            self.imageLabel.setText(f'Loading failed: {error}')
+
+    def loading_finished(self):
+        if self.layout:
+            self.statusBar().showMessage(f'{len(self.matches)} devices with measurements', 5000)
+        if self.precompute_netlists:
+            self.netlists.request([(None, self.matches[m][1]['opt_in']) for m in self.matches])
 
     def initUI(self):
         main_widget = QWidget()
         main_layout = QHBoxLayout()
         
-        # List Widget on the Left
+        # Device browser on the Left: search box, and tree of course / designer / device
         left_layout = QVBoxLayout()
-        self.listWidget = QListWidget()
-        #self.listWidget.setSelectionMode(QListWidget.SelectionMode.MultiSelection)
-        self.listWidget.setSelectionMode(QListWidget.SelectionMode.SingleSelection)
-        for item in sorted(self.matches.keys(), key=str.casefold):
-            self.listWidget.addItem(item)
-        self.listWidget.itemSelectionChanged.connect(self.update_tabs)
+        self.search_box = QLineEdit()
+        self.search_box.setPlaceholderText("Search devices")
+        self.search_box.setClearButtonEnabled(True)
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(CONST_SearchDelay)
+        self.search_timer.timeout.connect(self.apply_search)
+        self.search_box.textChanged.connect(self.search_timer.start)
+        self.device_model = DeviceTreeModel(self)
+        self.tree = QTreeView()
+        self.tree.setHeaderHidden(True)
+        self.tree.setUniformRowHeights(True)
+        self.tree.setModel(self.device_model)
+        #self.tree.setSelectionMode(QAbstractItemView.SelectionMode.MultiSelection)
+        self.tree.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        self.tree.selectionModel().selectionChanged.connect(self.update_tabs)
 
         # Add selection mode toggle button
         self.selection_button = QPushButton("Selection: Single")
         self.selection_button.clicked.connect(self.toggle_selection_mode)
-        left_layout.addWidget(self.listWidget)
+        left_layout.addWidget(self.search_box)
+        left_layout.addWidget(self.tree)
         left_layout.addWidget(self.selection_button)
         main_layout.addLayout(left_layout, 1)  # Takes 1 part of the space
         
@@ -69,19 +546,27 @@ class TabbedGUI(QMainWindow):
         # Tab 2: Image
         self.tab2 = QWidget()
         self.scrollArea = QScrollArea()
-        self.imageLabel = QLabel("Select an item to display an image")
+        self.imageLabel = QLabel("Select an item to display an image" if self.layout else "Loading layout...")
         self.imageLabel.setAlignment(Qt.AlignmentFlag.AlignCenter)
         self.scrollArea.setWidget(self.imageLabel)
         self.scrollArea.setWidgetResizable(True)
         layout2 = QVBoxLayout()
         layout2.addWidget(self.scrollArea)
         self.tab2.setLayout(layout2)
-        self.display_klayout_cell_image(self.layout.top_cell().name, self.layout.top_cell()) #, width=self.scrollArea.width()*0.99)
+        if self.layout:
+            self.display_klayout_cell_image(self.layout.top_cell().name, self.layout.top_cell()) #, width=self.scrollArea.width()*0.99)
         
         # Tab 3: Data Plot
         self.tab3 = QWidget()
         self.figure, self.ax = plt.subplots()
+        self.ax.set_xlabel("Wavelength [nm]")
+        self.ax.set_ylabel("Transmission [dB]")
+        self.ax.grid(True)
+        self.lines = {}  # (list key, channel) -> DecimatedLine
+        self.spectra = {}  # .mat file path -> (wavelengths, channels)
+        self.ax.callbacks.connect('xlim_changed', self.update_decimation)
         self.canvas = FigureCanvas(self.figure)
+        self.canvas.mpl_connect('resize_event', self.update_decimation)
         self.toolbar = NavigationToolbar(self.canvas, self)
         self.legend_button = QPushButton("Toggle Legend")
         self.legend_button.clicked.connect(self.toggle_legend)
@@ -113,83 +598,162 @@ class TabbedGUI(QMainWindow):
         Toggles between Single and Multi selection mode.
         """
         self.multi_selection = not self.multi_selection
-        mode = QListWidget.SelectionMode.MultiSelection if self.multi_selection else QListWidget.SelectionMode.SingleSelection
-        self.listWidget.setSelectionMode(mode)
+        mode = QAbstractItemView.SelectionMode.MultiSelection if self.multi_selection else QAbstractItemView.SelectionMode.SingleSelection
+        self.tree.setSelectionMode(mode)
         self.selection_button.setText("Selection: Multi" if self.multi_selection else "Selection: Single")
 
     def resizeEvent(self, event):
         """
         Resize event to dynamically adjust image size.
         """
-        if self.imageLabel.pixmap():
+        if self.layout and self.imageLabel.pixmap():
             self.display_klayout_cell_image(width=self.scrollArea.width()*0.99)
         super().resizeEvent(event)
 
     def update_tabs(self):
-        selected_items = [item.text() for item in self.listWidget.selectedItems()]
+        selected_items = self.selected_keys()
         if not selected_items:
-            self.ax.clear()
+            self.update_plot([])
             #print(self.layout.top_cell().name)
-            self.display_klayout_cell_image(self.layout.top_cell().name, self.layout.top_cell(), width=self.scrollArea.width()*0.99)
-            self.canvas.draw()
+            if self.layout:
+                self.display_klayout_cell_image(self.layout.top_cell().name, self.layout.top_cell(), width=self.scrollArea.width()*0.99)
             return
         
-        self.ax.clear()
         for selected_key in selected_items:
             if selected_key in self.matches:
-                mat_file_path = self.matches[selected_key][0]  # Get the first associated file
-                self.plot_mat_data(mat_file_path, selected_key, len(selected_items)>1)
                 self.display_klayout_cell_image(selected_key, width=self.scrollArea.width()*0.99)
-                opt_in_selection_text=[self.matches[selected_key][1]['opt_in']]
-                print(opt_in_selection_text)
-                try:
-                    text_subckt, text_main, *_ = self.cell.spice_netlist_export(opt_in_selection_text=opt_in_selection_text)
-#                    print(text_subckt, text_main)
-                    self.text_output.setPlainText(text_subckt)
-                    self.text_output.append(text_main)
-                except:
-                    text = 'No netlist available for this circuit.'
-                    self.text_output.setPlainText(text)
-                    pass
-        
-        if len(selected_items)>1:
+                opt_in_text = self.matches[selected_key][1]['opt_in']
+                print(opt_in_text)
+                self.show_netlist(self.cell.name if self.cell else None, opt_in_text)
+        self.update_plot([key for key in selected_items if key in self.matches])
+
+    def update_plot(self, selected_keys):
+        """
+        Shows the spectra of the selected devices, keeping the line artists of
+        the devices that stay selected, and removing the others.
+        """
+        multi = len(selected_keys) > 1
+        wanted = {}
+        for selected_key in selected_keys:
+            mat_file_path = self.latest_sweep(selected_key)
+            for line in self.plot_mat_data(mat_file_path, selected_key, multi):
+                wanted[(selected_key, line.channel)] = line
+        for key in list(self.lines):
+            if key not in wanted:
+                self.lines.pop(key).remove()
+        self.lines = wanted
+
+        if multi:
             self.ax.set_title(f"Spectrum Data for selected files")
-        if self.legend_enabled:
+        elif selected_keys:
+            self.ax.set_title(f"Spectrum Data for {selected_keys[0]}")
+        else:
+            self.ax.set_title("")
+        if self.lines:
+            # full range of the data, then the visible part at screen resolution
+            self.ax.set_xlim(min(line.x[0] for line in self.lines.values()),
+                             max(line.x[-1] for line in self.lines.values()))
+            self.ax.set_ylim(*DecimatedLine.limits(self.lines.values()))
+            self.toolbar.update()  # the Home button returns to this view
+        self.update_legend()
+        self.canvas.draw_idle()
+
+    def latest_sweep(self, key):
+        """
+        Returns:
+            str: The most recent .mat file of a device, from the measurement database, after
+            adding its new files; the number of sweeps is shown in the status bar when there are several.
+        """
+        self.database.update([(key, f) for f in self.matches[key][0::2]],
+                             {key: self.matches[key][1]['opt_in']}, workers=1)
+        sweeps = self.database.sweeps(device=key)
+        latest = sweeps[-1]
+        if len(sweeps) > 1:
+            self.statusBar().showMessage(f"{key}: {len(sweeps)} sweeps, showing the latest, {latest['timestamp']}", 5000)
+        return latest['path']
+
+    def update_decimation(self, *args):
+        """
+        Recomputes the decimated lines for the visible wavelength range and the plot width,
+        after a zoom, pan or resize.
+        """
+        xlim = self.ax.get_xlim()
+        pixels = max(int(self.ax.bbox.width), 1)
+        for line in self.lines.values():
+            line.update(xlim, pixels)
+        self.canvas.draw_idle()
+
+    def update_legend(self):
+        legend = self.ax.get_legend()
+        if legend:
+            legend.remove()
+        if self.legend_enabled and self.lines:
             self.ax.legend()
-        self.canvas.draw()
+
+    def show_netlist(self, cell_name, opt_in_text):
+        """
+        Shows the cached netlist in the Netlist tab, or requests it from the workers.
+        """
+        self.netlist_shown = opt_in_text
+        netlist = self.netlists.get(opt_in_text)
+        if not netlist:
+            self.text_output.setPlainText('Extracting netlist...')
+            self.netlists.request([(cell_name, opt_in_text)])
+            return
+        text, error = netlist
+        if error:
+            self.text_output.setPlainText(f'No netlist available for this circuit.\n{error}')
+        else:
+            self.text_output.setPlainText(text)
+
+    def on_netlist_ready(self, opt_in_text):
+        """
+        Marks the devices whose netlist extraction failed, and refreshes the Netlist tab.
+        """
+        text, error = self.netlists.get(opt_in_text)
+        if error:
+            for key in self.matches:
+                if self.matches[key][1]['opt_in'] == opt_in_text:
+                    self.device_model.set_error(key, f'Netlist extraction failed: {error}')
+        if self.netlist_shown == opt_in_text:
+            self.show_netlist(None, opt_in_text)
+
+    def closeEvent(self, event):
+        if self.loader and self.loader.isRunning():
+            self.loader.wait()
+        self.netlists.shutdown()
+        self.database.close()
+        super().closeEvent(event)
 
     def toggle_legend(self):
         """
         Toggles the visibility of the legend.
         """
         self.legend_enabled = not self.legend_enabled
-        self.update_tabs()
+        self.update_legend()
+        self.canvas.draw_idle()
     
     def plot_mat_data(self, mat_file_path, title, multi=False):
         """
-        Reads and plots the spectrum data from a .mat file.
-        """
-        mat_data = scipy.io.loadmat(mat_file_path)
-        test_result = mat_data.get("testResult")
-        test_result_inner = test_result[0, 0]
-        rows_data = test_result_inner["rows"]
-        rows_inner = rows_data[0, 0]
-        wavelengths = test_result[0][0][0]['wavelength'].flatten()[0]
+        Plots the spectrum data from a .mat file, reusing the lines already plotted for it.
         
-        for i in range(1, 5):
-            channel_key = f"channel_{i}"
-            if channel_key in rows_inner.dtype.names:
-                spectrum_data = rows_inner[channel_key].flatten()
-                if max(spectrum_data) > CONST_NoiseFloor:
-                    if multi:
-                        self.ax.plot(wavelengths, spectrum_data, label=f"{title}:{i}")
-                    else:
-                        self.ax.plot(wavelengths, spectrum_data, label=f"channel:{i}")
+        Returns:
+            list: The DecimatedLine of each channel above the noise floor.
+        """
+        if mat_file_path not in self.spectra:
+            self.spectra[mat_file_path] = load_mat_spectrum(mat_file_path)
+        wavelengths, channels = self.spectra[mat_file_path]
         
-        self.ax.set_xlabel("Wavelength [nm]")
-        self.ax.set_ylabel("Transmission [dB]")
-        self.ax.set_title(f"Spectrum Data for {title}")
-        self.ax.grid(True)
+        lines = []
+        for i, spectrum_data in channels.items():
+            if max(spectrum_data) > CONST_NoiseFloor:
+                line = self.lines.get((title, i))
+                if not line:
+                    line = DecimatedLine(self.ax, wavelengths, spectrum_data, i)
+                    line.update(self.ax.get_xlim(), max(int(self.ax.bbox.width), 1))
+                line.artist.set_label(f"{title}:{i}" if multi else f"channel:{i}")
+                lines.append(line)
+        return lines
 
     def display_klayout_cell_image(self, cell_name=None, cell=None, width=400):
         """
@@ -197,14 +761,20 @@ class TabbedGUI(QMainWindow):
         """
         layer_optin = [10,0]
         layout = self.layout
+        if not layout:
+            self.imageLabel.setText("Loading layout...")
+            self.cell = None
+            return None
         if cell_name:
             self.cell_name = cell_name
         if not cell_name:
             if 'cell_name' in dir(self):
                 cell_name = self.cell_name
+        opt_in_text = None
         for m in self.matches:
             if cell_name == m:
-                cell = find_text_label(layout, layer_optin, self.matches[m][1]['opt_in'])
+                opt_in_text = self.matches[m][1]['opt_in']
+                cell = find_text_label(layout, layer_optin, opt_in_text)
 #                print(f"is cell const object? 2 {cell._is_const_object()}")
                 break
         if cell:
@@ -215,7 +785,7 @@ class TabbedGUI(QMainWindow):
             while not (iter.at_end()):
                 if iter.shape().is_text():
                     text = iter.shape().text
-                    if self.matches[m][1]['opt_in'] == text.string:
+                    if opt_in_text == text.string:
                         trans = pya.Trans(text.x, text.y)
                 iter.next()
             if trans:
@@ -224,7 +794,8 @@ class TabbedGUI(QMainWindow):
                 print('opt_in label location not found.')
                 arrow_shape = draw_right_facing_arrow(cell, layer_optin)
             # image_path = os.path.join(path,f"{cell_name}.png")
-            image_path = os.path.join(SiEPIC._globals.TEMP_FOLDER, f"{cell_name}.png")
+            from SiEPIC._globals import TEMP_FOLDER  # loaded with the layout
+            image_path = os.path.join(TEMP_FOLDER, f"{cell_name}.png")
             im = cell.image(image_path, width=width, retina=False)
             qp = QPixmap(image_path)
             self.imageLabel.setPixmap(qp)
@@ -237,6 +808,64 @@ class TabbedGUI(QMainWindow):
             self.cell = None
         return None
 
+class DecimatedLine:
+    """
+    A spectrum plotted at screen resolution: within the visible wavelength range, the
+    samples are split into one bin per pixel, and only the minimum and maximum of each
+    bin are drawn, so that the line looks the same as with every sample. When zoomed in
+    to fewer samples than pixels, the samples are drawn as they are.
+    """
+    def __init__(self, ax, x, y, channel):
+        order = np.argsort(x, kind='stable')
+        self.x, self.y = np.asarray(x, float)[order], np.asarray(y, float)[order]
+        self.channel = channel
+        self.artist, = ax.plot([], [])
+
+    def update(self, xlim, pixels):
+        start = max(np.searchsorted(self.x, xlim[0]) - 1, 0)
+        stop = min(np.searchsorted(self.x, xlim[1], side='right') + 1, len(self.x))
+        self.artist.set_data(*minmax_decimate(self.x, self.y, start, stop, pixels))
+
+    def remove(self):
+        self.artist.remove()
+
+    @staticmethod
+    def limits(lines, margin=0.05):
+        """
+        Returns:
+            tuple: The y range of all the samples of the lines, with a margin.
+        """
+        low = min(np.nanmin(line.y) for line in lines)
+        high = max(np.nanmax(line.y) for line in lines)
+        pad = (high - low) * margin or 1
+        return low - pad, high + pad
+
+
+def minmax_decimate(x, y, start, stop, bins):
+    """
+    Min/max decimation of the samples start to stop of a line.
+    
+    Args:
+        x, y (numpy.ndarray): The line, sorted by x.
+        bins (int): Number of bins, typically the width of the plot in pixels.
+    
+    Returns:
+        numpy.ndarray, numpy.ndarray: x and y of the minimum and maximum of each bin, in order.
+    """
+    count = stop - start
+    if count <= 2 * bins:
+        return x[start:stop], y[start:stop]
+    per_bin = count // bins
+    binned = y[start:start + per_bin * bins].reshape(bins, per_bin)
+    low, high = np.argmin(binned, axis=1), np.argmax(binned, axis=1)
+    offsets = start + np.arange(bins) * per_bin
+    index = np.stack([offsets + np.minimum(low, high), offsets + np.maximum(low, high)], axis=1).ravel()
+    tail = np.arange(start + per_bin * bins, stop)
+    if len(tail):
+        index = np.concatenate([index, np.unique([tail[np.argmin(y[tail])], tail[np.argmax(y[tail])]])])
+    return x[index], y[index]
+
+
 def draw_right_facing_arrow(cell, layer, trans=pya.Trans()):
     """
     Draws a right-facing arrow, with a transformed location
@@ -284,68 +913,6 @@ draw_right_facing_arrow(top_cell, [10,0])
 layout.write("left_arrow.gds")
 '''
 
-def disable_libraries():
-    print('Disabling KLayout libraries')
-    for l in pya.Library().library_ids():
-        print(' - %s' % pya.Library().library_by_id(l).name())
-        pya.Library().library_by_id(l).delete()
-    
-def load_layout_and_extract_labels():
-    """
-    Loads the layout file located at ../aggregate/Shuksan.oas and extracts opt_in labels using SiEPIC.
-    
-    Returns:
-        list: Extracted opt_in labels from the layout.
-    """
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    layout_path = os.path.abspath(os.path.join(script_dir, '..', 'aggregate', 'Shuksan.oas'))
-    
-    if not os.path.exists(layout_path):
-        raise FileNotFoundError(f"Layout file not found at expected location: {layout_path}")
-    
-    # Load all the layouts, without the libraries (no PCells)
-    disable_libraries()
-
-    layout = pya.Layout()
-    layout.read(layout_path)
-    layout.technology_name = "SiEPICfab_EBeam_ZEP"
-    
-    top_cell = layout.top_cell()
-    if not top_cell:
-        raise RuntimeError("No top cell found in the layout.")
-    
-    labels = find_automated_measurement_labels(top_cell)
-    print(f"Extracted number of labels: {len(labels[1])}")
-    return layout, labels
-
-
-def match_files_with_labels(mat_files_dir, labels):
-    """
-    Matches .mat files in the mat_files directory with the extracted opt_in labels.
-    
-    Args:
-        mat_files_dir (str): The directory containing .mat files.
-        labels (list): Extracted opt_in labels from the layout.
-    
-    Returns:
-        dict: A mapping of labels to matching .mat files.
-    """
-    matches = {}
-    for root, _, files in os.walk(mat_files_dir):
-        for label in labels[1]:
-            device_id = label.get('deviceID', '')
-            params = "_".join(label.get('params', []))
-            expected_folder_start = f"{device_id}_{params}".strip('_')
-
-            if os.path.basename(root).startswith(expected_folder_start):
-                for file in files:
-                    if file.endswith(".mat"):
-                        matches.setdefault(expected_folder_start, []).append(os.path.join(root, file))
-                        matches[expected_folder_start].append(label)
-    
-    print(f"Matched files: {len(matches)}")
-    return matches
-
 def analyze_mat_file(mat_file_path, opt_in_name=''):
     """
     Analyzes the spectrum data from a .mat file and plots it.
@@ -353,6 +920,7 @@ def analyze_mat_file(mat_file_path, opt_in_name=''):
     Args:
         mat_file_path (str): Path to the .mat file.
     """
+    import scipy.io
     mat_data = scipy.io.loadmat(mat_file_path)
     test_result = mat_data.get("testResult")
     test_result_inner = test_result[0, 0]
@@ -375,36 +943,9 @@ def analyze_mat_file(mat_file_path, opt_in_name=''):
     plt.show()
 
 
-def find_text_label(layout, layer_name, target_text):
-    """
-    Scans a layout file to find a specific text label on a given layer and returns the cell containing that text.
-    
-    Args:
-        layout (pya.Layout): The layout object.
-        layer_name (str): The layer name where the text is expected.
-        target_text (str): The text label to find.
-    
-    Returns:
-        pya.Cell: The cell containing the text, or None if not found.
-    """
-    layer_index = layout.layer(layer_name)
-    if layer_index is None:
-        raise Exception('Layer not found')
-    
-    iter = layout.top_cell().begin_shapes_rec(layer_index)
-    while not iter.at_end():
-        if iter.shape().is_text():
-            text = iter.shape().text.string
-            if text == target_text:
-                # Ensure we return a non-Const cell, see issue: https://github.com/KLayout/klayout/issues/235
-                # return layout.cell(iter.cell().name) 
-                return layout.cell(iter.cell_index())
-        iter.next()
-    return None
-
-
 if __name__ == "__main__":
     script_dir = os.path.dirname(os.path.abspath(__file__))
+    from fetch_measurement_data import extract_measurement_url, download_file, unzip_and_copy_mat_files
     if 0:
         try:
             url = extract_measurement_url()
@@ -425,6 +966,13 @@ if __name__ == "__main__":
             print(f"Error: {e}")
 
     if 1:
+        # the window shows immediately, the layout and matches are loaded in the background
+        app = QApplication(sys.argv)
+        window = TabbedGUI(mat_files_dir=os.path.join(script_dir,'mat_files'))
+        window.show()
+        sys.exit(app.exec())
+
+    if 0:
         layout, labels = load_layout_and_extract_labels()
         mat_path = os.path.join(script_dir,'mat_files')
         matches = match_files_with_labels(mat_path, labels)
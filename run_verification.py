@@ -7,6 +7,8 @@ from SiEPIC.utils import get_technology_by_name
 import siepic_ebeam_pdk
 import os
 import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'aggregate'))
+from submission_profile import profile_layout, check_budgets, summary
 """
 Script to load .gds file passed in through commmand line and run verification using layout_check().
 Ouput lyrdb file is saved to path specified by 'file_lyrdb' variable in the script.
@@ -28,6 +30,17 @@ except:
    print('Error loading layout')
    num_errors = 1
 
+# reject designs that are too large to verify and merge, before running the verification
+profile = profile_layout(layout)
+print('Profile: %s' % summary(profile))
+budget_errors = check_budgets(profile)
+if budget_errors:
+   print('\n'.join(budget_errors))
+   print('Please simplify the design; the budgets are in aggregate/submission_profile.py')
+   # the number of errors is the last line of the output
+   print(len(budget_errors))
+   sys.exit(0)
+
 try:
    # get top cell from layout
    if len(layout.top_cells()) != 1: